@@ -0,0 +1,356 @@
+"""streaming, compressed archiving of the many small files that pile up over a project (annotation images and rotated
+logs). Files are added to a compressed tarball as they arrive, and the tarball streams straight to the storage backend
+as it is built, so that it is never staged on the SD card, and there is no big batch of archiving waiting at the start
+of passive mode."""
+
+import gzip
+import os
+import posixpath
+import re
+import tarfile
+import threading
+import time
+from collections import namedtuple
+from glob import glob
+
+from internet_of_fish.modules import definitions
+from internet_of_fish.modules import mptools
+from internet_of_fish.modules import storage
+from internet_of_fish.modules.utils import file_utils, gen_utils
+
+COMPRESSIONS = ['zstd', 'gzip']
+EXTENSIONS = {'zstd': '.tar.zst', 'gzip': '.tar.gz'}
+
+# a file that has been added to the current archive, along with its size and mtime at the time (and its content hash,
+# if it was archived by content). Once the archive is safely in the cloud, the file is deleted, unless it has changed
+# since it was added
+Member = namedtuple('Member', ['path', 'size', 'mtime', 'content_hash'])
+
+# a set of files to archive: those matching pattern, which are archived into cloud_dir under names starting with
+# prefix. If by_hash is True, files are identified by their content hash (see file_utils.file_hash) rather than their
+# path. Rotated logs are renamed (e.g., from .log.1 to .log.2) each time the log rolls over, so a log that was renamed
+# between being archived and being deleted is recognized by its content, and deleted rather than archived again
+ArchiveSource = namedtuple('ArchiveSource', ['prefix', 'pattern', 'cloud_dir', 'by_hash'])
+# the number that RotatingFileHandler appends to the name of each rotated log
+ROTATION_SUFFIX = re.compile(r'\.\d+$')
+
+
+def default_compression():
+    """:return: "zstd" if the optional zstandard package is installed, otherwise "gzip"
+    :rtype: str"""
+    try:
+        import zstandard
+        return 'zstd'
+    except ImportError:
+        return 'gzip'
+
+
+def archive_sources(proj_id, analysis_state=None):
+    """
+    :return: the files of a project that are archived rather than uploaded individually: the contents of the
+        annotation directory (apart from tarballs made by older versions), and the rotated logs
+    :rtype: list[ArchiveSource]
+    """
+    anno_dir = definitions.PROJ_ANNO_DIR(proj_id, analysis_state)
+    return [
+        ArchiveSource('annotations_', os.path.join(anno_dir, '*'), file_utils.local_to_cloud(anno_dir), False),
+        ArchiveSource('logs_', os.path.join(definitions.LOG_DIR, '*.log.*'),
+                      file_utils.local_to_cloud(definitions.PROJ_LOG_DIR(proj_id, analysis_state)), True),
+    ]
+
+
+class _CountingWriter:
+    """passes writes through to a raw binary file object, counting the bytes written"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.n_bytes = 0
+
+    def write(self, data):
+        self.raw.write(data)
+        self.n_bytes += len(data)
+        return len(data)
+
+    def flush(self):
+        self.raw.flush()
+
+    def close(self):
+        self.raw.close()
+
+
+class StreamingArchiver:
+
+    def __init__(self, storage_backend, cloud_dir, prefix='', compression=None, max_bytes=256 * 1024 ** 2,
+                 max_age_secs=3600, shutdown_event=None, logger=None):
+        """
+        builds compressed tarballs one file at a time, streaming each to the storage backend as it is built (see
+        storage.StorageBackend.put_stream). An archive is finished, and a new one started with the next file, once it
+        reaches max_bytes or max_age_secs. Files are only deleted once the archive holding them has arrived in the cloud
+        intact. If the upload fails, the archive is abandoned, and its files are left in place to be archived again
+        :param storage_backend: backend the archives are uploaded to
+        :type storage_backend: storage.StorageBackend
+        :param cloud_dir: cloud directory the archives are uploaded to
+        :type cloud_dir: str
+        :param prefix: start of the name of each archive, which is followed by the time the archive was started (in ms
+            since the epoch)
+        :type prefix: str
+        :param compression: "zstd" or "gzip", or None to use zstd if it is installed (see default_compression)
+        :type compression: str
+        :param max_bytes: max size of each (compressed) archive. Files are not split between archives, so a single
+            file larger than this gets an archive to itself
+        :type max_bytes: int
+        :param max_age_secs: max time an archive is held open while waiting for more files (see finish_if_stale)
+        :type max_age_secs: float
+        :param shutdown_event: if given, the upload in progress is abandoned once this event is set
+        :type shutdown_event: multiprocessing.Event
+        :param logger: logger to report finished and failed archives to
+        :type logger: logging.Logger
+        """
+        self.storage = storage_backend
+        self.cloud_dir = cloud_dir
+        self.prefix = prefix
+        self.compression = compression if compression else default_compression()
+        if self.compression not in COMPRESSIONS:
+            raise ValueError(f'unknown compression {compression}. Valid options are {", ".join(COMPRESSIONS)}')
+        if self.compression == 'zstd' and default_compression() != 'zstd':
+            raise storage.StorageError('the zstandard package is required for zstd compression')
+        self.max_bytes = max_bytes
+        self.max_age_secs = max_age_secs
+        self.shutdown_event = shutdown_event
+        self.logger = logger
+        self.tar = None
+        self.members = []
+        # content hashes of the files in archives that have already been uploaded
+        self.archived_hashes = set()
+        self.n_archives, self.n_files, self.n_bytes = 0, 0, 0
+
+    @property
+    def pending(self):
+        """:return: paths of the files in the archive currently being built
+        :rtype: set[str]"""
+        return {member.path for member in self.members}
+
+    @property
+    def pending_hashes(self):
+        """:return: content hashes of the files in the archive currently being built (where known)
+        :rtype: set[str]"""
+        return {member.content_hash for member in self.members if member.content_hash}
+
+    def _open(self):
+        self.cloud_path = posixpath.join(self.cloud_dir,
+                                         f'{self.prefix}{gen_utils.current_time_ms()}{EXTENSIONS[self.compression]}')
+        read_fd, write_fd = os.pipe()
+        reader = os.fdopen(read_fd, 'rb')
+        self.upload_error = None
+
+        def upload():
+            try:
+                self.storage.put_stream(reader, self.cloud_path, shutdown_event=self.shutdown_event)
+            except Exception as e:
+                self.upload_error = e
+            finally:
+                # if the upload stopped early, this makes the next write to the pipe fail, rather than block forever
+                reader.close()
+
+        self.upload_thread = threading.Thread(target=upload, daemon=True)
+        self.upload_thread.start()
+        self.writer = _CountingWriter(os.fdopen(write_fd, 'wb'))
+        if self.compression == 'zstd':
+            import zstandard
+            self.compressor = zstandard.ZstdCompressor(level=3).stream_writer(self.writer, closefd=False)
+        else:
+            self.compressor = gzip.GzipFile(fileobj=self.writer, mode='wb', compresslevel=6)
+        self.tar = tarfile.open(fileobj=self.compressor, mode='w|')
+        self.members = []
+        self.started = time.time()
+
+    def add(self, path, arcname=None, content_hash=None):
+        """
+        add a file to the current archive, starting a new archive if necessary
+        :param path: path to the file
+        :type path: str
+        :param arcname: name of the file within the archive. Defaults to the file's name
+        :type arcname: str
+        :param content_hash: content hash of the file, which is recorded in archived_hashes once the archive is uploaded
+        :type content_hash: str
+        :return: True if the file was added, False if it could not be (e.g., because the upload failed)
+        :rtype: bool
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if self.tar is not None and self.members and self.writer.n_bytes + stat.st_size > self.max_bytes:
+            self.finish()
+        if self.tar is None:
+            self._open()
+        try:
+            self.tar.add(path, arcname=arcname if arcname else os.path.basename(path))
+        except OSError as e:
+            # the archive is corrupt once a write has failed part way through a file, so it is abandoned
+            self._abandon(self.upload_error if self.upload_error else e)
+            return False
+        self.members.append(Member(path, stat.st_size, stat.st_mtime, content_hash))
+        if self.writer.n_bytes >= self.max_bytes:
+            self.finish()
+        return True
+
+    def _close_stream(self):
+        """close the archive, and wait for the upload to finish
+        :return: the error that stopped the archive from being written or uploaded, if any"""
+        error = None
+        # each layer is closed even if the one above it failed, so that the pipe is always closed. If the upload stopped
+        # early, the pipe is already broken, and flushing into it fails
+        for stream in [self.tar, self.compressor, self.writer]:
+            try:
+                stream.close()
+            except OSError as e:
+                error = error if error else e
+        self.upload_thread.join()
+        self.tar = None
+        return self.upload_error if self.upload_error else error
+
+    def _abandon(self, error):
+        """give up on the current archive, leaving its files in place. Never raises, so that add and finish can always
+        report the failure by returning False"""
+        if self.tar is not None:
+            self._close_stream()
+        if self.logger:
+            self.logger.warning(f'abandoned {posixpath.basename(self.cloud_path)}: {error}. Its {len(self.members)} '
+                                f'files will be archived again later')
+        self.members = []
+
+    def finish(self):
+        """
+        finish the current archive, and delete its files once it has been confirmed to be in the cloud
+        :return: True if the archive was uploaded intact (or there was nothing to finish)
+        :rtype: bool
+        """
+        if self.tar is None:
+            return True
+        error = self._close_stream()
+        if error is None:
+            try:
+                item = self.storage.stat(self.cloud_path)
+                if item is None or item['Size'] != self.writer.n_bytes:
+                    error = 'archive missing from the cloud (or the wrong size) after upload'
+            except storage.StorageError as e:
+                error = f'could not verify upload: {e}'
+        if error is not None:
+            self._abandon(error)
+            return False
+        for member in self.members:
+            try:
+                stat = os.stat(member.path)
+                if (stat.st_size, stat.st_mtime) == (member.size, member.mtime):
+                    os.remove(member.path)
+            except FileNotFoundError:
+                continue
+        self.archived_hashes.update(self.pending_hashes)
+        self.n_archives += 1
+        self.n_files += len(self.members)
+        self.n_bytes += self.writer.n_bytes
+        if self.logger:
+            self.logger.debug(f'archived {len(self.members)} files into {posixpath.basename(self.cloud_path)} '
+                              f'({self.writer.n_bytes / 1024 ** 2:.1f} MB)')
+        self.members = []
+        return True
+
+    def finish_if_stale(self):
+        """finish the current archive if it has been open for more than max_age_secs. Long-lived uploads are more
+        likely to be cut off, and the files in an unfinished archive cannot be deleted"""
+        if self.tar is not None and time.time() - self.started > self.max_age_secs:
+            return self.finish()
+        return True
+
+    def close(self):
+        return self.finish()
+
+
+def open_archivers(storage_backend, proj_id, analysis_state, defs, shutdown_event=None, logger=None):
+    """
+    :return: an archiver for each of a project's archive sources (see archive_sources), configured by
+        ARCHIVE_COMPRESSION and ARCHIVE_MAX_MB
+    :rtype: list[tuple[ArchiveSource, StreamingArchiver]]
+    """
+    compression = None if defs.ARCHIVE_COMPRESSION == 'auto' else defs.ARCHIVE_COMPRESSION
+    return [(source, StreamingArchiver(storage_backend, source.cloud_dir, source.prefix, compression,
+                                       max_bytes=defs.ARCHIVE_MAX_MB * 1024 ** 2, shutdown_event=shutdown_event,
+                                       logger=logger))
+            for source in archive_sources(proj_id, analysis_state)]
+
+
+def archive_files(archivers, min_age_secs=0):
+    """
+    add each source's files to its archiver, skipping any that are already in the archive being built, or that have
+    been modified in the last min_age_secs (and so may still be being written). Files of sources archived by content
+    hash are named in the archive by their hash, and are deleted instead if their content has already been archived
+    :param archivers: sources and their archivers (see open_archivers)
+    :type archivers: list[tuple[ArchiveSource, StreamingArchiver]]
+    :param min_age_secs: min time since a file was last modified
+    :type min_age_secs: float
+    :return: number of files added
+    :rtype: int
+    """
+    n_added = 0
+    now = time.time()
+    for source, archiver in archivers:
+        pending = archiver.pending
+        for path in sorted(glob(source.pattern)):
+            # a file whose content is archived by hash may have been replaced since its path was added
+            if (path in pending and not source.by_hash) or path.endswith('.tar') or not os.path.isfile(path):
+                continue
+            try:
+                if now - os.path.getmtime(path) < min_age_secs:
+                    continue
+                if not source.by_hash:
+                    n_added += archiver.add(path)
+                    continue
+                content_hash = file_utils.file_hash(path)
+            except FileNotFoundError:
+                continue
+            if content_hash in archiver.archived_hashes:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            elif content_hash not in archiver.pending_hashes:
+                arcname = f'{ROTATION_SUFFIX.sub("", os.path.basename(path))}.{content_hash[:16]}'
+                n_added += archiver.add(path, arcname, content_hash)
+    return n_added
+
+
+class ArchiveWorker(mptools.TimerProcWorker, metaclass=gen_utils.AutologMetaclass):
+    """
+    archives annotation images and rotated logs (see archive_sources) as they appear during active mode, streaming
+    each archive to the storage backend as it is built. Runs at low priority, alongside the collector and detector
+    """
+    INTERVAL_SECS = 60
+    # files are left alone until they have gone unmodified for this long
+    SETTLE_SECS = 60
+    NICENESS = 10
+
+    def init_args(self, args):
+        self.storage, = args
+
+    def startup(self):
+        os.nice(self.NICENESS)
+        # archives are not tied to the shutdown event, so that the archives open at the end of active mode are finished
+        # rather than abandoned
+        self.archivers = open_archivers(self.storage, self.metadata['proj_id'], self.metadata['analysis_state'],
+                                        self.defs, logger=self.logger)
+
+    def main_func(self):
+        n_added = archive_files(self.archivers, self.SETTLE_SECS)
+        if n_added:
+            self.logger.debug(f'added {n_added} files to archives')
+        for _, archiver in self.archivers:
+            archiver.finish_if_stale()
+
+    def shutdown(self):
+        for source, archiver in self.archivers:
+            archiver.close()
+            self.logger.info(f'{source.prefix.strip("_")}: archived {archiver.n_files} files into '
+                             f'{archiver.n_archives} archives ({archiver.n_bytes / 1024 ** 2:.1f} MB)')
+        self.storage.close()
+        self.event_q.close()
@@ -1,8 +1,9 @@
-import logging, os, time
+import logging, os, queue, shutil, tempfile, threading, time
+import subprocess as sp
 from internet_of_fish.modules import mptools
-from internet_of_fish.modules.utils import gen_utils
+from internet_of_fish.modules import recording
+from internet_of_fish.modules.utils import gen_utils, file_utils
 import cv2
-import datetime as dt
 from math import ceil
 import picamera
 import numpy as np
@@ -10,17 +11,19 @@ import numpy as np
 class CollectorWorker(mptools.TimerProcWorker, metaclass=gen_utils.AutologMetaclass):
 
     def init_args(self, args):
-        self.img_q, = args
+        self.img_q, self.frame_ring = args
         self.INTERVAL_SECS = self.defs.INTERVAL_SECS
         self.FRAMERATE = self.defs.FRAMERATE  # pi camera framerate
         self.RESOLUTION = (self.defs.H_RESOLUTION, self.defs.V_RESOLUTION) # pi camera resolution
         self.MAX_VID_LEN = self.defs.MAX_VID_LEN  # max length of an individual video (in hours)
+        self.MAX_SEGMENT_MB = self.defs.MAX_SEGMENT_MB  # max size of an individual video (in MB)
 
     def startup(self):
         self.cam = self.init_camera()
         self.vid_dir = self.defs.PROJ_VID_DIR
-        self.cam.start_recording(self.generate_vid_path())
-        self.last_split = dt.datetime.now().hour
+        self.segments = SegmentManager(self.cam, self.vid_dir, self.FRAMERATE, max_secs=self.MAX_VID_LEN * 3600,
+                                       max_bytes=self.MAX_SEGMENT_MB * 1024 ** 2, logger=self.logger)
+        self.segments.start()
         self.last_det = gen_utils.current_time_ms()
 
     def init_camera(self):
@@ -31,66 +34,445 @@ class CollectorWorker(mptools.TimerProcWorker, metaclass=gen_utils.AutologMetacl
 
     def main_func(self):
         cap_time = gen_utils.current_time_ms()
-        image = np.empty((self.RESOLUTION[1], self.RESOLUTION[0], 3), dtype=np.uint8)
-        self.cam.capture(image, format='rgb', use_video_port=True)
-        self.img_q.safe_put((cap_time, image))
-        if self.MAX_VID_LEN and (dt.datetime.now().hour - self.last_split >= self.MAX_VID_LEN):
-            self.split_recording()
+        shape = (self.RESOLUTION[1], self.RESOLUTION[0], 3)
+        if self.frame_ring:
+            # capture straight into a shared memory slot, and only send the slot reference through the queue
+            slot = self.frame_ring.acquire()
+            if slot is None:
+                self.logger.debug('no free frame slots (detector is falling behind). Skipping capture')
+            else:
+                image = self.frame_ring.view(slot, shape)
+                self.cam.capture(image, format='rgb', use_video_port=True)
+                if not self.img_q.safe_put((cap_time, mptools.FrameRef(slot, shape))):
+                    self.frame_ring.release(slot)
+        else:
+            image = np.empty(shape, dtype=np.uint8)
+            self.cam.capture(image, format='rgb', use_video_port=True)
+            self.img_q.safe_put((cap_time, image))
+        self.segments.update(cap_time)
 
     def shutdown(self):
-        self.cam.stop_recording()
+        self.segments.stop()
         self.cam.close()
         self.img_q.safe_put('END')
         self.img_q.close()
         self.event_q.close()
+        if self.frame_ring:
+            self.frame_ring.close()
+
+
+class SegmentManager:
+    # how often the byte position of the recording is written to the segment index
+    MARK_INTERVAL_MS = 5000
+    # how long stop() waits for an in-progress remux to finish
+    REMUX_WAIT_SECS = 5
+
+    def __init__(self, cam, vid_dir, framerate, max_secs=0, max_bytes=0, logger=None, niceness=10):
+        """
+        runs the camera's continuous recording as a series of segments, and keeps the SegmentIndex up to date. A new
+        segment is started once the current one has been recording for max_secs (measured on the monotonic clock, so
+        that the schedule is unaffected by midnight or by changes to the system clock) or has grown to max_bytes.
+        Splits are aligned with keyframes, so every segment can be decoded on its own. picamera can only record raw
+        .h264 streams, so each segment is remuxed into an .mp4 container in a background thread as soon as it closes,
+        and the .h264 file is removed. The final segment is left as an .h264, since remuxing a large file could
+        outlast the shutdown window; the uploader converts any .h264 files it encounters.
+        :param cam: camera to record from
+        :type cam: picamera.PiCamera
+        :param vid_dir: directory to record into
+        :type vid_dir: str
+        :param framerate: recording framerate
+        :type framerate: float
+        :param max_secs: maximum segment duration, in seconds. 0 disables time-based splitting
+        :type max_secs: float
+        :param max_bytes: maximum segment size, in bytes. 0 disables size-based splitting
+        :type max_bytes: int
+        :param logger: logger to report to
+        :type logger: logging.Logger
+        :param niceness: niceness increment for the remuxing ffmpeg processes, so that they do not compete with the
+            camera and the detector
+        :type niceness: int
+        """
+        self.cam = cam
+        self.vid_dir = vid_dir
+        self.framerate = framerate
+        self.max_secs = max_secs
+        self.max_bytes = max_bytes
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.niceness = niceness
+        self.segment_index = recording.SegmentIndex(vid_dir)
+        self.vid_path = None
+        self.segment_start = None
+        self.last_mark = None
+        self.remux_q = queue.Queue()
+        self.remux_thread = threading.Thread(target=self.run_remuxer, daemon=True)
 
     def generate_vid_path(self):
         return os.path.join(self.vid_dir, f'{gen_utils.current_time_iso()}.h264')
 
-    def split_recording(self):
-        self.cam.split_recording(self.generate_vid_path())
-        self.last_split = dt.datetime.now().hour
+    def start(self):
+        """start recording the first segment"""
+        self.remux_thread.start()
+        self.vid_path = self.generate_vid_path()
+        self.cam.start_recording(self.vid_path)
+        start_ms = gen_utils.current_time_ms()
+        self.segment_index.open_segment(self.vid_path, start_ms, self.framerate, 0)
+        self.segment_start = time.monotonic()
+        self.last_mark = start_ms
+
+    def update(self, time_ms):
+        """
+        mark the recording's current position in the segment index and split the recording when a limit is reached.
+        Should be called regularly while recording
+        :param time_ms: current wall-clock time, in ms since the epoch
+        :type time_ms: int
+        """
+        if time_ms - self.last_mark >= self.MARK_INTERVAL_MS:
+            self.mark(time_ms)
+        if self.should_split():
+            self.split()
+
+    def should_split(self):
+        if self.max_secs and time.monotonic() - self.segment_start >= self.max_secs:
+            return True
+        if self.max_bytes:
+            try:
+                return os.path.getsize(self.vid_path) >= self.max_bytes
+            except OSError:
+                return False
+        return False
+
+    def current_frame_index(self):
+        """index (within the overall recording) of the most recent frame written by the encoder, if known"""
+        try:
+            return self.cam.frame.index
+        except (AttributeError, picamera.PiCameraError):
+            return None
+
+    def first_frame_index(self):
+        """index (within the overall recording) of the first frame of the current segment, if known. Only valid
+        straight after a split, while the most recent frame is still the one at the start of the new file"""
+        try:
+            frame = self.cam.frame
+        except picamera.PiCameraError:
+            return None
+        if frame is None or frame.position != 0:
+            self.logger.debug('unable to determine the first frame of the new segment')
+            return None
+        return frame.index
+
+    def mark(self, time_ms):
+        """note the byte position of the frame currently being recorded in the segment index"""
+        try:
+            frame = self.cam.frame
+        except picamera.PiCameraError:
+            return
+        if frame is not None and frame.position is not None:
+            self.segment_index.mark(self.vid_path, time_ms, frame.position, frame.index)
+        self.last_mark = time_ms
+
+    def split(self):
+        """finish the current segment at the next keyframe, continue recording into a new one, and queue the finished
+        segment for remuxing"""
+        old_path, self.vid_path = self.vid_path, self.generate_vid_path()
+        # picamera always splits at a keyframe. Requesting one means the split happens at the next frame, rather than
+        # whenever the encoder next produces a keyframe on its own
+        self.cam.request_key_frame()
+        self.cam.split_recording(self.vid_path)
+        split_ms = gen_utils.current_time_ms()
+        self.segment_start = time.monotonic()
+        # the encoder can still take up to a GOP to produce the keyframe, so the boundary is only known once
+        # split_recording returns, which it does as soon as that keyframe has been written to the new file
+        start_frame = self.first_frame_index()
+        self.segment_index.close_segment(old_path, split_ms, start_frame - 1 if start_frame is not None else None)
+        self.segment_index.open_segment(self.vid_path, split_ms, self.framerate, start_frame)
+        self.logger.debug(f'split recording. Now recording to {os.path.basename(self.vid_path)}')
+        self.remux_q.put(old_path)
+
+    def run_remuxer(self):
+        while True:
+            h264_path = self.remux_q.get()
+            if h264_path is None:
+                return
+            self.remux(h264_path)
+
+    def remux(self, h264_path):
+        """
+        stream copy a closed .h264 segment into an .mp4 container, then delete the .h264
+        :param h264_path: path to the segment
+        :type h264_path: str
+        :return: path to the new .mp4 file, or None if the remux failed (in which case the .h264 is kept)
+        :rtype: str
+        """
+        if os.path.getsize(h264_path) < 100:
+            # tiny fragments (~1 frame long) are occasionally produced, and will choke ffmpeg
+            os.remove(h264_path)
+            return None
+        start = time.time()
+        try:
+            mp4_path = file_utils.h264_to_mp4(h264_path, self.framerate, niceness=self.niceness)
+        except Exception as e:
+            self.logger.warning(f'failed to remux {os.path.basename(h264_path)}. It will be converted before upload\n'
+                                f'{e}')
+            return None
+        self.segment_index.rename_segment(h264_path, mp4_path)
+        self.logger.debug(f'remuxed {os.path.basename(h264_path)} to mp4 in {time.time() - start:.1f} seconds')
+        return mp4_path
+
+    def stop(self):
+        """stop recording, close the final segment, and stop the remuxing thread. Segments still waiting to be remuxed
+        are left as .h264 files"""
+        end_frame = self.current_frame_index()
+        self.cam.stop_recording()
+        self.segment_index.close_segment(self.vid_path, gen_utils.current_time_ms(), end_frame)
+        while True:
+            try:
+                self.remux_q.get_nowait()
+            except queue.Empty:
+                break
+        self.remux_q.put(None)
+        self.remux_thread.join(self.REMUX_WAIT_SECS)
+
+
+class FrameSampler:
+    # stride (in frames) beyond which seeking to each sampled frame is cheaper than decoding the frames in between.
+    # Seeking decodes everything from the preceding keyframe, so this should be comfortably above the keyframe interval
+    SEEK_MIN_STRIDE = 150
+    STRATEGIES = ['auto', 'grab', 'seek', 'ffmpeg']
+
+    def __init__(self, video_file, interval_secs, strategy='auto', logger=None):
+        """
+        sequential reader that returns every cap_rate-th frame of a video file, where cap_rate is the number of frames
+        per interval_secs. Depending on the strategy, unwanted frames are either dropped with cv2's grab() (decoded
+        but never retrieved or converted), skipped by seeking, or filtered out by an ffmpeg process that writes only the
+        sampled frames to a rawvideo pipe. Frames are returned in BGR order regardless of strategy. If the ffmpeg
+        process fails, the sampler falls back to the grab strategy from the frame where ffmpeg stopped.
+        :param video_file: path to the video file
+        :type video_file: str
+        :param interval_secs: time between sampled frames, in seconds of video
+        :type interval_secs: float
+        :param strategy: one of 'grab', 'seek', 'ffmpeg', or 'auto' (default), which picks the cheapest option for the
+            current cap_rate
+        :type strategy: str
+        :param logger: logger to report to
+        :type logger: logging.Logger
+        """
+        self.video_file = video_file
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.cap = cv2.VideoCapture(self.video_file)
+        self.resolution = (int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self.framerate = int(self.cap.get(cv2.CAP_PROP_FPS))
+        self.cap_rate = max(1, int(ceil(self.framerate * interval_secs)))
+        self.strategy = self.choose_strategy() if strategy == 'auto' else strategy
+        self.proc = None
+        self.proc_stderr = None
+        if self.strategy == 'ffmpeg':
+            self.cap.release()
+            self.proc = self.open_ffmpeg_pipe()
+        self.frame_count = 0
+        self.decoded_count = 0
+        self.sampled_count = 0
+        self.pos_msec = 0.0
+        self.start_time = time.time()
+
+    def choose_strategy(self):
+        """pick the cheapest way to sample frames at the current cap_rate"""
+        if self.cap_rate >= self.SEEK_MIN_STRIDE:
+            return 'seek'
+        if self.cap_rate > 1 and shutil.which('ffmpeg'):
+            return 'ffmpeg'
+        return 'grab'
+
+    def open_ffmpeg_pipe(self):
+        # the select filter keeps exactly every cap_rate-th frame, so sampled frames line up with the other strategies.
+        # -vsync is deprecated in favor of -fps_mode from ffmpeg 5.1, but is still accepted there, whereas older
+        # versions (e.g., the 4.1 shipped with Raspbian Buster) reject -fps_mode
+        cmnd = ['ffmpeg', '-loglevel', 'error', '-i', self.video_file,
+                '-vf', f'select=not(mod(n\\,{self.cap_rate}))', '-vsync', 'passthrough',
+                '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-']
+        # stderr goes to a file rather than a pipe, so that it can never fill up and stall ffmpeg
+        self.proc_stderr = tempfile.TemporaryFile()
+        return sp.Popen(cmnd, stdout=sp.PIPE, stderr=self.proc_stderr, bufsize=10**8)
+
+    def close_ffmpeg_pipe(self):
+        """stop the ffmpeg process, and return its exit code and any error output"""
+        self.proc.stdout.close()
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        returncode = self.proc.wait()
+        self.proc_stderr.seek(0)
+        stderr = self.proc_stderr.read().decode(errors='replace').strip()
+        self.proc_stderr.close()
+        self.proc, self.proc_stderr = None, None
+        return returncode, stderr
+
+    def fall_back_to_grab(self):
+        """continue with the grab strategy, starting from the next frame that ffmpeg would have returned"""
+        self.strategy = 'grab'
+        self.cap = cv2.VideoCapture(self.video_file)
+        if self.frame_count:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.frame_count)
+
+    def read(self):
+        """
+        return the next sampled frame. After a successful read, self.pos_msec holds the frame's position in the video
+        :return: success flag and frame, like cv2.VideoCapture.read(). The frame is None once the video is exhausted
+        :rtype: tuple[bool, np.ndarray]
+        """
+        if self.strategy == 'ffmpeg':
+            ret, img = self._read_ffmpeg()
+        elif self.strategy == 'seek':
+            ret, img = self._read_seek()
+        else:
+            ret, img = self._read_grab()
+        if ret:
+            self.sampled_count += 1
+        return ret, img
+
+    def _update_pos_msec(self):
+        # raw h264 streams carry no timestamps, in which case cv2 reports 0 and the position is derived from the frame
+        # index instead
+        pos_msec = self.cap.get(cv2.CAP_PROP_POS_MSEC) if self.cap.isOpened() else 0.0
+        if pos_msec <= 0 and self.frame_count:
+            pos_msec = self.frame_msec(self.frame_count)
+        self.pos_msec = pos_msec
+
+    def frame_msec(self, frame_index):
+        """position of a frame in the video, in ms. Some containers do not report a framerate, in which case the frame
+        index itself is used, so that positions still increase from one frame to the next"""
+        return frame_index * 1000 / self.framerate if self.framerate else float(frame_index)
+
+    def _read_grab(self):
+        ret, img = self.cap.read()
+        self.decoded_count += 1
+        if ret:
+            self._update_pos_msec()
+            for _ in range(self.cap_rate - 1):
+                if not self.cap.grab():
+                    break
+                self.decoded_count += 1
+            self.frame_count += self.cap_rate
+        return ret, img
+
+    def _read_seek(self):
+        ret, img = self.cap.read()
+        self.decoded_count += 1
+        if ret:
+            self._update_pos_msec()
+            self.frame_count += self.cap_rate
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.frame_count)
+        return ret, img
+
+    def _read_ffmpeg(self):
+        width, height = self.resolution
+        nbytes = width * height * 3
+        raw = self.proc.stdout.read(nbytes)
+        if len(raw) < nbytes:
+            # a short read means ffmpeg has exited. Only a clean exit marks the end of the video
+            returncode, stderr = self.close_ffmpeg_pipe()
+            if not returncode:
+                return False, None
+            self.logger.warning(f'ffmpeg exited with code {returncode} after {self.frame_count} frames of '
+                                f'{os.path.basename(self.video_file)}. Falling back to the grab strategy\n{stderr}')
+            self.fall_back_to_grab()
+            return self._read_grab()
+        self.decoded_count += self.cap_rate
+        self.pos_msec = self.frame_msec(self.frame_count)
+        self.frame_count += self.cap_rate
+        return True, np.frombuffer(raw, dtype=np.uint8).reshape((height, width, 3))
+
+    @property
+    def decoded_fps(self):
+        """approximate number of frames decoded per second of wall-clock time since the sampler was opened"""
+        elapsed = time.time() - self.start_time
+        return self.decoded_count / elapsed if elapsed else 0.0
+
+    @property
+    def sampled_fps(self):
+        """number of frames returned by read() per second of wall-clock time since the sampler was opened"""
+        elapsed = time.time() - self.start_time
+        return self.sampled_count / elapsed if elapsed else 0.0
+
+    def release(self):
+        if self.proc:
+            self.close_ffmpeg_pipe()
+        self.cap.release()
 
 
 class SourceCollectorWorker(CollectorWorker):
 
-    """functions like a CollectorWorker, but gathers images from an existing file rather than a camera"""
+    """functions like a CollectorWorker, but gathers images from an existing file rather than a camera. In the
+    default "fast" replay mode, frames are pushed as quickly as the detector consumes them (the full image queue or
+    frame ring provides backpressure) and are stamped with their position in the video rather than the wall-clock
+    time. In "realtime" replay mode, frames are paced by INTERVAL_SECS like a live camera."""
 
     def init_args(self, args):
-        self.img_q, self.video_file = args
+        self.img_q, self.video_file, self.frame_ring = args
         self.INTERVAL_SECS = self.defs.INTERVAL_SECS
         self.INTERVAL_MSECS = self.INTERVAL_SECS * 1000
+        self.REPLAY_MODE = self.defs.REPLAY_MODE
+
+    def main_loop(self):
+        if self.REPLAY_MODE == 'realtime':
+            super().main_loop()
+        else:
+            mptools.ProcWorker.main_loop(self)
 
     def startup(self):
         if not os.path.exists(self.video_file):
             self.locate_video()
-        self.cap = cv2.VideoCapture(self.video_file)
-        self.RESOLUTION = (int(self.cap.get(3)), int(self.cap.get(4)))
-        self.FRAMERATE = int(self.cap.get(cv2.CAP_PROP_FPS))
-        self.cap_rate = max(1, int(ceil(self.FRAMERATE * self.INTERVAL_SECS)))
-        self.logger.log(logging.INFO, f"Collector will add an image to the queue every {self.cap_rate} frame(s)")
-        self.frame_count = 0
+        self.sampler = FrameSampler(self.video_file, self.INTERVAL_SECS, self.defs.FRAME_SAMPLER, logger=self.logger)
+        self.RESOLUTION = self.sampler.resolution
+        self.FRAMERATE = self.sampler.framerate
+        self.cap_rate = self.sampler.cap_rate
+        self.logger.log(logging.INFO, f"Collector will add an image to the queue every {self.cap_rate} frame(s) "
+                                      f"using the {self.sampler.strategy} sampling strategy")
         self.active = True
 
     def main_func(self):
         if not self.active:
             time.sleep(1)
             return
-        ret, img = self.cap.read()
-        cap_time = gen_utils.current_time_ms()
+        ret, img = self.sampler.read()
+        if self.REPLAY_MODE == 'realtime':
+            cap_time = gen_utils.current_time_ms()
+        else:
+            cap_time = int(round(self.sampler.pos_msec))
         if ret:
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            put_result = self.img_q.safe_put((cap_time, img))
+            item = self.to_queue_item(img)
+            if item is None:
+                return
+            put_result = self.img_q.safe_put((cap_time, item))
             while not put_result:
-                time.sleep(1)
-                put_result = self.img_q.safe_put((cap_time, img))
-            self.frame_count += self.cap_rate
-            self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.frame_count)
+                if self.shutdown_event.is_set():
+                    return
+                time.sleep(1 if self.REPLAY_MODE == 'realtime' else self.MAX_SLEEP_SECS)
+                put_result = self.img_q.safe_put((cap_time, item))
+            if not self.sampler.sampled_count % 1000:
+                self.print_info()
         else:
             self.active = False
+            self.print_info()
             self.logger.log(logging.INFO, "VideoCollector entering sleep mode (no more frames to process)")
             self.img_q.safe_put('END')
 
+    def print_info(self):
+        self.logger.info(f'{self.sampler.sampled_count} frames sampled ({self.sampler.frame_count} frames into the '
+                         f'video). Decoding at {self.sampler.decoded_fps:.1f} fps, sampling at '
+                         f'{self.sampler.sampled_fps:.1f} fps')
+
+    def to_queue_item(self, img):
+        """convert a BGR frame to RGB, writing it into a shared memory slot if possible. Blocks until a slot frees
+        up, so that the collector cannot outrun the detector. Returns None if shutdown was requested while waiting"""
+        if not self.frame_ring or not self.frame_ring.fits(img.shape):
+            return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        slot = self.frame_ring.acquire(timeout=1)
+        while slot is None:
+            if self.shutdown_event.is_set():
+                return None
+            slot = self.frame_ring.acquire(timeout=1)
+        cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=self.frame_ring.view(slot, img.shape))
+        return mptools.FrameRef(slot, img.shape)
+
     def locate_video(self):
         path_elements = [self.defs.HOME_DIR,
                          * os.path.relpath(self.defs.DATA_DIR, self.defs.HOME_DIR).split(os.sep),
@@ -109,9 +491,11 @@ class SourceCollectorWorker(CollectorWorker):
             raise FileNotFoundError
 
     def shutdown(self):
-        self.cap.release()
+        self.sampler.release()
         self.img_q.close()
         self.event_q.close()
+        if self.frame_ring:
+            self.frame_ring.close()
 
 
 class SimpleCollectorWorker(CollectorWorker):
@@ -123,15 +507,14 @@ class SimpleCollectorWorker(CollectorWorker):
         self.RESOLUTION = (self.defs.H_RESOLUTION, self.defs.V_RESOLUTION)  # pi camera resolution
         self.FRAMERATE = self.defs.FRAMERATE  # pi camera framerate
         self.MAX_VID_LEN = self.defs.MAX_VID_LEN
+        self.MAX_SEGMENT_MB = self.defs.MAX_SEGMENT_MB
 
     def main_func(self):
         time.sleep(5)
-        if self.MAX_VID_LEN and (dt.datetime.now().hour - self.last_split >= self.MAX_VID_LEN):
-            self.split_recording()
-            self.last_split = dt.datetime.now().hour
+        self.segments.update(gen_utils.current_time_ms())
 
     def shutdown(self):
-        self.cam.stop_recording()
+        self.segments.stop()
         self.cam.close()
         self.event_q.close()
 
@@ -15,6 +15,7 @@ CREDENTIALS_DIR = os.path.join(BASE_DIR, 'credentials')
 RESOURCES_DIR = os.path.join(BASE_DIR, 'resources')
 HOME_DIR = os.path.expanduser('~')
 DATA_DIR = os.path.join(HOME_DIR, 'CichlidPiData', '__ProjectData')
+UPLOAD_JOURNAL_FILE = os.path.join(HOME_DIR, 'CichlidPiData', 'upload_journal.sqlite')
 CLOUD_HOME_DIR = 'cichlidVideo:COS/BioSci/BioSci-McGrath/Apps'
 CLOUD_DATA_DIR = posixpath.join(CLOUD_HOME_DIR, 'CichlidPiData', '__ProjectData')
 END_FILE = os.path.join(HOME_DIR, 'ENTER_END_MODE')
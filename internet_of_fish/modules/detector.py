@@ -1,20 +1,23 @@
-import os, logging, time
-from collections import namedtuple
+import os, logging, time, threading, queue
+from collections import Counter, namedtuple
 
 from glob import glob
 import cv2
-from math import sqrt
 import numpy as np
 
-from pycoral.adapters import common
-from pycoral.adapters import detect
-from pycoral.utils.edgetpu import make_interpreter, run_inference
-
 import internet_of_fish.modules.utils.advanced_utils
 from internet_of_fish.modules import mptools
+from internet_of_fish.modules import inference
+from internet_of_fish.modules import recording
 from internet_of_fish.modules.utils import gen_utils
 
 BufferEntry = namedtuple('BufferEntry', ['cap_time', 'img', 'fish_dets'])
+PipeROI = namedtuple('PipeROI', ['box', 'score', 'center', 'radius'])
+# skipped_by is None for frames that go through the fish model, and otherwise says what skipped them: 'motion' (the
+# motion gate judged the frame static) or 'tracker' (the tracker was not due a fresh detection)
+Frame = namedtuple('Frame', ['cap_time', 'crop', 'run_model', 'roi', 'skipped_by'])
+PipelineBatch = namedtuple('PipelineBatch', ['frames', 'tensor', 'scales', 'dets'])
+ClipRequest = namedtuple('ClipRequest', ['entries', 'pipe_center', 'pipe_radius', 'fps', 'msg', 'time_range'])
 
 class HitCounter:
 
@@ -33,66 +36,848 @@ class HitCounter:
         self.hits = 0.0
 
 
+class MotionGate:
+
+    def __init__(self, threshold, max_skip=20, size=(64, 64), learning_rate=0.05):
+        """
+        cheap pre-filter that decides whether a frame differs enough from the recent past to be worth running the fish
+        model on. Each frame is downsampled to a small grayscale image and compared against a running-average
+        background. Frames whose mean absolute difference from the background falls below the threshold are considered
+        static.
+        :param threshold: mean absolute difference (in 0-255 gray levels) below which a frame is static. 0 disables
+            the gate, so that every frame is treated as changed
+        :type threshold: float
+        :param max_skip: max number of consecutive static frames before a frame is treated as changed anyway, which
+            bounds how stale reused detections can get
+        :type max_skip: int
+        :param size: size (width, height) that frames are downsampled to before comparison
+        :type size: tuple[int, int]
+        :param learning_rate: weight given to each new frame when updating the background
+        :type learning_rate: float
+        """
+        self.threshold = threshold
+        self.max_skip = max_skip
+        self.size = tuple(size)
+        self.learning_rate = learning_rate
+        self.background = None
+        self.n_skipped = 0
+        self.last_score = None
+
+    def check(self, img):
+        """
+        compare an RGB image against the background, then fold it into the background
+        :param img: RGB image
+        :type img: np.ndarray
+        :return: True if the frame should be processed, False if it is static
+        :rtype: bool
+        """
+        gray = cv2.cvtColor(cv2.resize(img, self.size, interpolation=cv2.INTER_AREA), cv2.COLOR_RGB2GRAY)
+        gray = gray.astype(np.float32)
+        if self.background is None:
+            self.background = gray
+            self.last_score = None
+            return True
+        self.last_score = float(cv2.mean(cv2.absdiff(gray, self.background))[0])
+        cv2.accumulateWeighted(gray, self.background, self.learning_rate)
+        if not self.threshold or self.last_score >= self.threshold or self.n_skipped >= self.max_skip:
+            self.n_skipped = 0
+            return True
+        self.n_skipped += 1
+        return False
+
+    def reset(self):
+        self.background = None
+        self.n_skipped = 0
+
+
+class Track:
+
+    def __init__(self, track_id, box, score):
+        """
+        single fish tracked across frames. Boxes are stored as floats so that sub-pixel optical flow displacements
+        accumulate properly between detections
+        :param track_id: unique id of the track
+        :type track_id: int
+        :param box: (xmin, ymin, xmax, ymax) box of the detection that started the track
+        :type box: np.ndarray
+        :param score: score of the detection that started the track
+        :type score: float
+        """
+        self.id = track_id
+        self.box = np.array(box, dtype=np.float32)
+        self.score = float(score)
+        self.hits = 1
+        self.missed = 0
+
+    def update(self, box, score):
+        self.box = np.array(box, dtype=np.float32)
+        self.score = float(score)
+        self.hits += 1
+        self.missed = 0
+
+
+class FishTracker:
+
+    def __init__(self, detect_every, min_hits=2, max_missed=2, iou_thresh=0.3, grid_size=4):
+        """
+        lightweight SORT-style tracker. Detections are associated with existing tracks by IoU (greedy, highest IoU
+        first), with a centroid-distance fallback for fast-moving fish whose boxes no longer overlap. On frames where
+        the fish model is not run, tracks are moved along by sparse Lucas-Kanade optical flow on a grid of points
+        inside each box. The fish model then only needs to run every detect_every frames, or sooner if a track goes
+        stale (i.e., optical flow loses it).
+        :param detect_every: run the fish model on every Nth frame
+        :type detect_every: int
+        :param min_hits: number of detections a track needs before it counts towards the stable fish count
+        :type min_hits: int
+        :param max_missed: number of consecutive detection frames a track can go unmatched before it is dropped
+        :type max_missed: int
+        :param iou_thresh: minimum IoU for a detection to be matched to a track
+        :type iou_thresh: float
+        :param grid_size: optical flow is computed on a grid_size x grid_size grid of points within each box
+        :type grid_size: int
+        """
+        self.detect_every = detect_every
+        self.min_hits = min_hits
+        self.max_missed = max_missed
+        self.iou_thresh = iou_thresh
+        self.grid_size = grid_size
+        self.tracks = []
+        self.next_id = 0
+        self.prev_gray = None
+        self.stale = True
+        self.frames_since_scheduled = 0
+
+    def schedule_detection(self):
+        """
+        decide whether the fish model should run on the next frame. Must be called once per frame, in capture order
+        :return: True if the frame should be run through the fish model
+        :rtype: bool
+        """
+        self.frames_since_scheduled += 1
+        if self.stale or self.frames_since_scheduled >= self.detect_every:
+            self.frames_since_scheduled = 0
+            self.stale = False
+            return True
+        return False
+
+    def update(self, dets, gray):
+        """
+        associate a fresh set of detections with the current tracks
+        :param dets: detections for the current frame
+        :type dets: inference.Detections
+        :param gray: grayscale version of the current frame, used as the reference for the next optical flow step
+        :type gray: np.ndarray
+        """
+        unmatched_dets = list(range(len(dets)))
+        unmatched_tracks = list(range(len(self.tracks)))
+        if self.tracks and len(dets):
+            track_boxes = np.stack([t.box for t in self.tracks])
+            ious = inference.box_iou(track_boxes, dets.boxes)
+            for ti, di in zip(*np.unravel_index(np.argsort(-ious, axis=None), ious.shape)):
+                if ious[ti, di] < self.iou_thresh:
+                    break
+                if ti in unmatched_tracks and di in unmatched_dets:
+                    self.tracks[ti].update(dets.boxes[di], dets.scores[di])
+                    unmatched_tracks.remove(ti)
+                    unmatched_dets.remove(di)
+            # fall back to centroid distance for whatever is left
+            track_centers = (track_boxes[:, :2] + track_boxes[:, 2:]) / 2
+            dists = np.linalg.norm(track_centers[:, None, :] - dets.centers[None, :, :], axis=2)
+            max_dists = np.hypot(*(track_boxes[:, 2:] - track_boxes[:, :2]).T) / 2
+            for ti, di in zip(*np.unravel_index(np.argsort(dists, axis=None), dists.shape)):
+                if ti in unmatched_tracks and di in unmatched_dets and dists[ti, di] < max_dists[ti]:
+                    self.tracks[ti].update(dets.boxes[di], dets.scores[di])
+                    unmatched_tracks.remove(ti)
+                    unmatched_dets.remove(di)
+        for ti in unmatched_tracks:
+            self.tracks[ti].missed += 1
+        for di in unmatched_dets:
+            self.tracks.append(Track(self.next_id, dets.boxes[di], dets.scores[di]))
+            self.next_id += 1
+        self.tracks = [t for t in self.tracks if t.missed <= self.max_missed]
+        self.prev_gray = gray
+
+    def propagate(self, gray):
+        """
+        move each track along by the median optical flow of the points inside its box. Marks the tracker as stale (so
+        that the fish model runs on the next frame) if any track loses most of its points
+        :param gray: grayscale version of the current frame
+        :type gray: np.ndarray
+        """
+        if self.prev_gray is None or self.prev_gray.shape != gray.shape:
+            self.prev_gray = gray
+            self.stale = True
+            return
+        if self.tracks:
+            steps = (np.arange(self.grid_size) + 0.5) / self.grid_size
+            grids = []
+            for track in self.tracks:
+                xs = track.box[0] + steps * (track.box[2] - track.box[0])
+                ys = track.box[1] + steps * (track.box[3] - track.box[1])
+                grids.append(np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2))
+            pts = np.concatenate(grids).astype(np.float32).reshape(-1, 1, 2)
+            new_pts, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, pts, None, winSize=(15, 15),
+                                                          maxLevel=2)
+            flow = (new_pts - pts).reshape(len(self.tracks), -1, 2)
+            status = status.reshape(len(self.tracks), -1).astype(bool)
+            for track, track_flow, track_status in zip(self.tracks, flow, status):
+                if track_status.sum() < track_status.size / 2:
+                    self.stale = True
+                    continue
+                track.box += np.tile(np.median(track_flow[track_status], axis=0), 2)
+        self.prev_gray = gray
+
+    def stable_count(self):
+        """number of tracks that have been confirmed by at least min_hits detections"""
+        return sum(1 for t in self.tracks if t.hits >= self.min_hits)
+
+    def detections(self):
+        """current track boxes and scores, as an inference.Detections instance"""
+        if not self.tracks:
+            return inference.Detections()
+        return inference.Detections(np.stack([t.box for t in self.tracks]), [t.score for t in self.tracks])
+
+    def reset(self):
+        self.tracks = []
+        self.prev_gray = None
+        self.stale = True
+
+
+class PipeLocator:
+
+    def __init__(self, detect_fn, logger, iou_thresh=0.95, niceness=10):
+        """
+        runs the pipe model in a background thread so that localizing the pipe never stalls fish detection. The fish
+        loop occasionally hands over a full frame (only the most recent one is kept), and reads the published ROI,
+        which is replaced as a whole (never modified in place) so that readers always see a consistent location. A new
+        location is only published once two consecutive localizations agree (IoU >= iou_thresh); until then, the
+        locator keeps asking for frames and the fish loop keeps using the last good ROI.
+        :param detect_fn: function that runs the pipe model on a full RGB frame and returns a list of detections
+        :type detect_fn: Callable[[np.ndarray], inference.Detections]
+        :param logger: logger of the owning worker
+        :type logger: logging.Logger
+        :param iou_thresh: min IoU between consecutive localizations for a new location to be accepted
+        :type iou_thresh: float
+        :param niceness: niceness increment applied to the locator thread (Linux only)
+        :type niceness: int
+        """
+        self.detect_fn = detect_fn
+        self.logger = logger
+        self.iou_thresh = iou_thresh
+        self.niceness = niceness
+        self.roi = None
+        self.candidate = None
+        self.requested = True
+        self.pending_frame = None
+        self.lock = threading.Lock()
+        self.frame_event = threading.Event()
+        self.roi_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='PipeLocator', daemon=True)
+        self.thread.start()
+
+    def request(self):
+        """ask the locator to relocalize the pipe using the next frame it is offered"""
+        self.requested = True
+
+    def wants_frame(self):
+        return self.requested and self.pending_frame is None
+
+    def submit(self, img):
+        """
+        offer a full frame to the locator. The frame is copied, since it may live in a shared memory slot
+        :param img: full RGB frame
+        :type img: np.ndarray
+        """
+        with self.lock:
+            self.pending_frame = img.copy()
+            self.requested = False
+        self.frame_event.set()
+
+    def wait_for_roi(self, timeout=None):
+        """block until a ROI has been published. Returns the ROI, or None if the timeout expired first"""
+        self.roi_event.wait(timeout)
+        return self.roi
+
+    def run(self):
+        if self.niceness:
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.niceness)
+            except (AttributeError, OSError):
+                pass
+        while not self.stop_event.is_set():
+            if not self.frame_event.wait(timeout=0.5):
+                continue
+            with self.lock:
+                img, self.pending_frame = self.pending_frame, None
+                self.frame_event.clear()
+            if img is None:
+                continue
+            try:
+                self.localize(img)
+            except Exception as e:
+                self.logger.warning(f'pipe localization failed with {e.__class__.__name__}: {e}')
+                self.requested = True
+
+    def localize(self, img):
+        self.logger.debug('updating pipe location')
+        dets = self.detect_fn(img)
+        if not dets:
+            self.logger.debug('attempted to update pipe location but pipe was not detected. Will try again on next frame')
+            self.requested = True
+            return
+        det = dets.top_k(1)
+        old_candidate, self.candidate = self.candidate, det
+        if self.roi is None:
+            # nothing to fall back on yet, so use the first location straight away, then confirm it
+            self.publish(det)
+            self.requested = True
+            return
+        iou = float(det.iou(old_candidate)[0, 0]) if old_candidate is not None else 0.0
+        if iou < self.iou_thresh:
+            self.logger.info(f'low IOU score detected. Pipe locator will rerun until IOU is above {self.iou_thresh}')
+            self.requested = True
+            return
+        score = float(det.scores[0])
+        self.logger.debug(f'pipe location updated. Confidence of {score}. IOU with previous location of {iou}')
+        if det.int_box(0) != self.roi.box:
+            self.publish(det)
+
+    def publish(self, det):
+        """publish a single-detection inference.Detections instance as the new pipe ROI"""
+        width, height = det.sizes[0]
+        # the center is relative to the crop, which is where fish detections live
+        center = [float(width) / 2, float(height) / 2]
+        radius = float(min(width, height)) / 2
+        self.roi = PipeROI(det.int_box(0), float(det.scores[0]), center, radius)
+        self.roi_event.set()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join(timeout=5)
+
+
+class FrameBuffer:
+
+    def __init__(self, capacity, max_bytes, mode='raw', jpeg_quality=90):
+        """
+        ring buffer of the most recent frames (and their detections), held in reserve for event clips. Memory use is
+        bounded by max_bytes: in raw mode, frames are copied into a single preallocated array, sized to fit the budget
+        when the first frame arrives. In jpeg mode, frames are stored as in-memory jpeg-encoded bytes, and the oldest
+        frames are evicted whenever the total size exceeds the budget.
+        :param capacity: max number of frames to hold
+        :type capacity: int
+        :param max_bytes: memory budget for the stored frames, in bytes
+        :type max_bytes: int
+        :param mode: 'raw' or 'jpeg'
+        :type mode: str
+        :param jpeg_quality: jpeg quality (0-100) used in jpeg mode
+        :type jpeg_quality: int
+        """
+        if mode not in ['raw', 'jpeg']:
+            raise ValueError(f'unknown frame buffer mode {mode}. Valid options are raw, jpeg')
+        self.capacity = max(1, int(capacity))
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.jpeg_quality = jpeg_quality
+        self.frames = None
+        self.shapes = [None] * self.capacity
+        self.cap_times = [None] * self.capacity
+        self.dets = [None] * self.capacity
+        self.n_slots = self.capacity
+        self.start = 0
+        self.count = 0
+        self.evicted = False
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def full(self):
+        """True once the buffer is holding as many frames as its capacity or memory budget allows"""
+        return self.count >= self.n_slots or self.evicted
+
+    @property
+    def nbytes(self):
+        """memory currently used by the stored frames, in bytes"""
+        if self.mode == 'raw':
+            return self.frames.nbytes if self.frames is not None else 0
+        return sum(len(self.frames[self.slot(i)]) for i in range(self.count))
+
+    def slot(self, i):
+        return (self.start + i) % self.n_slots
+
+    def allocate(self, shape):
+        """(re)allocate the raw frame array, with as many slots as fit in the budget. Clears the buffer"""
+        frame_bytes = int(np.prod(shape))
+        self.n_slots = max(1, min(self.capacity, self.max_bytes // frame_bytes))
+        self.frames = np.empty((self.n_slots, *shape), dtype=np.uint8)
+        self.clear()
+
+    def append(self, cap_time, img, fish_dets):
+        """
+        add a frame to the buffer, overwriting the oldest frame if the buffer is full
+        :param cap_time: capture time of the frame
+        :type cap_time: int
+        :param img: RGB image
+        :type img: np.ndarray
+        :param fish_dets: detections for the frame
+        :type fish_dets: inference.Detections
+        """
+        if self.mode == 'raw':
+            if self.frames is None or any(a > b for a, b in zip(img.shape, self.frames.shape[1:])):
+                # crops only grow when the pipe location changes, at which point older frames no longer line up anyway
+                self.allocate(img.shape)
+            data = None
+        else:
+            data = cv2.imencode('.jpg', cv2.cvtColor(img, cv2.COLOR_RGB2BGR),
+                                [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])[1].tobytes()
+            if self.frames is None:
+                self.frames = [None] * self.n_slots
+        if self.count == self.n_slots:
+            self.start = (self.start + 1) % self.n_slots
+            self.count -= 1
+        i = self.slot(self.count)
+        if self.mode == 'raw':
+            self.frames[i, :img.shape[0], :img.shape[1]] = img
+        else:
+            self.frames[i] = data
+        self.shapes[i] = img.shape
+        self.cap_times[i] = cap_time
+        self.dets[i] = fish_dets
+        self.count += 1
+        if self.mode == 'jpeg':
+            while self.count > 1 and self.nbytes > self.max_bytes:
+                self.frames[self.start] = None
+                self.start = (self.start + 1) % self.n_slots
+                self.count -= 1
+                self.evicted = True
+
+    def drain(self):
+        """
+        remove and return everything in the buffer, oldest first. In raw mode the images are copied out of the
+        preallocated array; in jpeg mode they are returned as encoded bytes
+        :return: buffered frames
+        :rtype: list[BufferEntry]
+        """
+        entries = []
+        for i in range(self.count):
+            j = self.slot(i)
+            if self.mode == 'raw':
+                height, width = self.shapes[j][:2]
+                img = self.frames[j, :height, :width].copy()
+            else:
+                img = self.frames[j]
+            entries.append(BufferEntry(self.cap_times[j], img, self.dets[j]))
+        self.clear()
+        return entries
+
+    def clear(self):
+        if self.mode == 'jpeg' and self.frames is not None:
+            self.frames = [None] * self.n_slots
+        self.start = 0
+        self.count = 0
+        self.evicted = False
+
+
+class ClipBuilder:
+
+    def __init__(self, dest_dir, notify_fn, logger, max_pending=4, segment_index=None):
+        """
+        encodes event clips in a background thread, so that detection carries on while a clip is written. Buffered
+        frames are annotated and fed to the video encoder straight from memory, and the event notification is sent once
+        the clip is complete. If a segment index is provided, clips are instead cut from the camera's own recording
+        (at full framerate, and without re-encoding) whenever the recording covers the requested time range
+        :param dest_dir: directory where clips are written
+        :type dest_dir: str
+        :param notify_fn: called with (msg, vid_path) after each clip has been written
+        :type notify_fn: Callable[[str, str], None]
+        :param logger: logger of the owning worker
+        :type logger: logging.Logger
+        :param max_pending: max number of clips waiting to be encoded before submit blocks
+        :type max_pending: int
+        :param segment_index: index of the camera's recording, or None to always build clips from buffered frames
+        :type segment_index: recording.SegmentIndex
+        """
+        self.dest_dir = dest_dir
+        self.segment_index = segment_index
+        self.notify_fn = notify_fn
+        self.logger = logger
+        self.clip_q = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self.run, name='ClipBuilder', daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        """
+        queue a clip for encoding. The request takes ownership of its buffer entries, which must not be modified after
+        :param request: clip to build
+        :type request: ClipRequest
+        """
+        self.clip_q.put(request)
+
+    def run(self):
+        while True:
+            request = self.clip_q.get()
+            if request is None:
+                break
+            try:
+                vid_path = self.build(request)
+            except Exception as e:
+                self.logger.error(f'failed to build event clip: {e.__class__.__name__}: {e}')
+                continue
+            self.notify_fn(request.msg, vid_path)
+
+    def build(self, request):
+        start = time.time()
+        vid_path = os.path.join(self.dest_dir, f'{request.entries[0].cap_time}_event.mp4')
+        if self.segment_index and request.time_range:
+            try:
+                cut_path = self.segment_index.cut_clip(*request.time_range, vid_path)
+            except Exception as e:
+                self.logger.warning(f'failed to cut event clip from the recording ({e.__class__.__name__}: {e}). '
+                                    f'Building it from buffered frames instead')
+                cut_path = None
+            if cut_path:
+                self.logger.debug(f'cut {vid_path} from the recording in {time.time() - start:.2f}s')
+                return cut_path
+        frames = self.annotated_frames(request)
+        vid_path = internet_of_fish.modules.utils.advanced_utils.frames_to_mp4(frames, vid_path, request.fps)
+        self.logger.debug(f'wrote {len(request.entries)} frames to {vid_path} in {time.time() - start:.2f}s')
+        return vid_path
+
+    def annotated_frames(self, request):
+        """annotate the frames of a request one at a time. Frames are resized to match the first, since the video
+        encoder needs a fixed frame size and the pipe location may have shifted slightly partway through the buffer"""
+        size = None
+        for be in request.entries:
+            img = self.overlay_boxes(be, request.pipe_center, request.pipe_radius)
+            if size is None:
+                size = (img.shape[1], img.shape[0])
+            elif (img.shape[1], img.shape[0]) != size:
+                img = cv2.resize(img, size)
+            yield img
+
+    @staticmethod
+    def overlay_boxes(buffer_entry, pipe_center, pipe_radius):
+        """draw the detection boxes and the pipe onto a copy of a buffered frame, and return it in BGR order. The frame
+        may be an RGB array, or jpeg-encoded bytes (see FrameBuffer)"""
+
+        def overlay_box(img_, box_, score_, color_):
+            xmin, ymin, xmax, ymax = box_
+            cv2.rectangle(img_, (xmin, ymin), (xmax, ymax), color_, 2)
+            label = '%s\n%.2f' % ('fish', score_)
+            cv2.putText(img_, label,(xmin + 10, ymin + 10), cv2.FONT_HERSHEY_SIMPLEX, 1.0, color_, 2)
+        if isinstance(buffer_entry.img, bytes):
+            img = cv2.imdecode(np.frombuffer(buffer_entry.img, np.uint8), cv2.IMREAD_COLOR)
+        else:
+            img = cv2.cvtColor(buffer_entry.img, cv2.COLOR_RGB2BGR)
+        fish_dets = buffer_entry.fish_dets
+        for i in range(len(fish_dets)):
+            overlay_box(img, fish_dets.int_box(i), fish_dets.scores[i], (0, 255, 0))
+        int_pipe_center = [int(np.round(coord)) for coord in pipe_center]
+        int_pipe_radius = int(np.round(pipe_radius))
+        cv2.circle(img, int_pipe_center, int_pipe_radius, (0, 255, 0), 2)
+        return img
+
+    def stop(self):
+        """finish any clips that are still queued, then stop the thread"""
+        self.clip_q.put(None)
+        self.thread.join()
+
+
 class DetectorWorker(mptools.QueueProcWorker, metaclass=gen_utils.AutologMetaclass):
 
 
     def init_args(self, args):
-        self.work_q, = args
+        self.work_q, self.frame_ring, self.detect_lag = args
         self.MODELS_DIR = self.defs.MODELS_DIR
         self.DATA_DIR = self.defs.DATA_DIR
         self.HIT_THRESH = self.defs.HIT_THRESH_SECS // self.defs.INTERVAL_SECS
         self.IMG_BUFFER = self.defs.IMG_BUFFER_SECS // self.defs.INTERVAL_SECS
         self.INTERVAL_SECS = self.defs.INTERVAL_SECS
         self.MIN_EVENT_INTERVAL = 30 # minimum number of seconds between events
+        self.MAX_BATCH_SIZE = max(1, self.defs.MAX_BATCH_SIZE)
+        self.PIPE_UPDATE_INTERVAL = 100  # number of frames between routine pipe relocalizations
+        self.PIPE_EMPTY_STREAK = 50  # relocalize the pipe if this many consecutive detection frames contain no fish
+        self.PIPELINE_DEPTH = 2  # max number of batches waiting between each pair of pipeline stages
+        self.PIPELINE_STAGES = ['preprocess', 'inference', 'postprocess']
 
     def startup(self):
-        self.pipe_det = None
+        self.pipe_roi = None
         self.pipe_center = None
         self.pipe_radius = None
-        self.force_pipe_update = True
+        self.pipe_locator = None
         self.max_fish = self.metadata['n_fish'] if self.metadata['n_fish'] else self.defs.MAX_DETS
         self.img_dir = self.defs.PROJ_IMG_DIR
         self.anno_dir = self.defs.PROJ_ANNO_DIR
         self.count_record = open(os.path.join(self.defs.PROJ_HIT_RECORD_DIR, f'{gen_utils.current_time_iso()}.csv'), 'w')
         self.count_buffer = ['time_ms,count\n']
         self.mock_hit_flag = False
+        # stays False if the models could not be loaded, in which case main_loop waits to be shut down
+        self.models_loaded = False
 
+        self.backend = self.defs.INFERENCE_BACKEND
         model_paths = glob(os.path.join(self.MODELS_DIR, self.metadata['model_id'], '*.tflite'))
-        fish_model = [m for m in model_paths if 'ooi' in os.path.basename(m)]
-        pipe_model = [m for m in model_paths if 'roi' in os.path.basename(m)]
-        if not fish_model or not pipe_model:
-            self.logger.error(f'multiple tflite files encountered in {self.metadata["model_id"]}, but unable to'
-                              f'determine which is the pipe model and which is the fish model. Ensure one model'
-                              f'contains "pipe" in its file name, and the other contains "fish"')
-            self.event_q.safe_put(mptools.EventMessage(self.name, 'HARD_SHUTDOWN', 'bad model(s)'))
-            return
-        self.logger.debug(f'using {fish_model[0]} as fish model')
-        self.interpreter = make_interpreter(fish_model[0])
-        self.interpreter.allocate_tensors()
-        self.logger.debug(f'using {pipe_model[0]} as pipe model')
-        self.pipe_interpreter = make_interpreter(pipe_model[0])
-        self.pipe_interpreter.allocate_tensors()
+        fish_model = inference.select_model(model_paths, 'ooi', self.backend)
+        pipe_model = inference.select_model(model_paths, 'roi', self.backend)
+        if self.backend == 'mock':
+            self.fish_backend = inference.make_backend(self.backend, fish_model, self.defs, n_dets=self.max_fish)
+            self.pipe_backend = inference.make_backend(self.backend, pipe_model, self.defs, n_dets=1, box_size=0.4)
+        else:
+            if not fish_model or not pipe_model:
+                self.logger.error(f'multiple tflite files encountered in {self.metadata["model_id"]}, but unable to'
+                                  f'determine which is the pipe model and which is the fish model (for the '
+                                  f'{self.backend} backend). Ensure the fish model contains "ooi" in its file name, '
+                                  f'and the pipe model contains "roi"')
+                self.event_q.safe_put(mptools.EventMessage(self.name, 'HARD_SHUTDOWN', 'bad model(s)'))
+                return
+            self.logger.debug(f'using {fish_model} as fish model')
+            self.fish_backend = inference.make_backend(self.backend, fish_model, self.defs)
+            self.logger.debug(f'using {pipe_model} as pipe model')
+            self.pipe_backend = inference.make_backend(self.backend, pipe_model, self.defs)
+        self.models_loaded = True
+        self.logger.info(f'running inference with the {self.backend} backend')
+        self.pipe_locator = PipeLocator(lambda img: self.detect(img, backend=self.pipe_backend), self.logger)
+        self.empty_streak = 0
+        self.frame_counter = 0
+        segment_index = None
+        if self.defs.EVENT_CLIP_SOURCE == 'recording' and not self.metadata['source']:
+            segment_index = recording.SegmentIndex(self.defs.PROJ_VID_DIR)
+        self.clip_builder = ClipBuilder(self.defs.PROJ_VID_DIR, self.notify_event, self.logger,
+                                        segment_index=segment_index)
 
         self.hit_counter = HitCounter()
-        self.avg_timer = gen_utils.Averager()
-        self.buffer = []
+        self.stage_timers = {stage: gen_utils.Averager() for stage in self.PIPELINE_STAGES}
+        self.batch_size_averager = gen_utils.Averager()
+        # a batch tensor stays in use until its batch clears the inference stage, so there must be enough of them to
+        # cover every batch that can be queued for, or undergoing, inference, plus the one being filled
+        self.batch_tensors = [None] * (self.PIPELINE_DEPTH + 2)
+        self.tensor_index = 0
+        self.crop_roi = None
+        self.pipeline_error = None
+        self.pipeline_failed = threading.Event()
+        self.motion_gate = MotionGate(self.defs.MOTION_THRESH, self.defs.MOTION_MAX_SKIP)
+        self.tracker = None
+        if self.defs.TRACKER_DETECT_EVERY:
+            self.tracker = FishTracker(self.defs.TRACKER_DETECT_EVERY, self.defs.TRACKER_MIN_HITS)
+        self.last_fish_dets = inference.Detections()
+        # number of frames on which inference was skipped since the last print_info, by what skipped them (see Frame)
+        self.skip_counters = Counter()
+        self.buffer = FrameBuffer(self.IMG_BUFFER, self.defs.IMG_BUFFER_MAX_MB * 1024 ** 2, self.defs.IMG_BUFFER_MODE)
         self.loop_counter = 0
         self.last_event = None
 
-    def main_func(self, q_item):
-        cap_time, img = q_item
-        if isinstance(img, str) and (img == 'MOCK_HIT'):
-            self.mock_hit_flag = True
+    def main_loop(self):
+        """feed batches from the work queue through a staged pipeline. Preprocessing (cropping, motion gating, and
+        resizing), inference, and postprocessing (filtering, tracking, hit counting, and events) each run in their own
+        thread, connected by bounded queues, so that the CPU-bound stages overlap with inference. cv2 and the tflite
+        interpreter both release the GIL while they work"""
+        if not self.models_loaded:
+            # startup already requested a hard shutdown, and the pipeline was never built
+            self.shutdown_event.wait()
             return
-        if not self.loop_counter % 100 or not self.pipe_det or self.force_pipe_update:
-            self.update_pipe_location(img)
-            if not self.pipe_det:
-                return
-        img = img[self.pipe_det.bbox.ymin:self.pipe_det.bbox.ymax, self.pipe_det.bbox.xmin: self.pipe_det.bbox.xmax]
-        fish_dets = sorted(self.detect(img), reverse=True, key=lambda x: x.score)
-        fish_dets = self.filter_fish_dets(fish_dets)
-        self.buffer.append(BufferEntry(cap_time, img, fish_dets))
-        hit_flag = len(fish_dets) >= 2
+        stage_qs = [queue.Queue(maxsize=self.PIPELINE_DEPTH) for _ in self.PIPELINE_STAGES]
+        stage_funcs = [self.preprocess_stage, self.inference_stage, self.postprocess_stage]
+        threads = []
+        for i, (stage, func) in enumerate(zip(self.PIPELINE_STAGES, stage_funcs)):
+            out_q = stage_qs[i + 1] if i + 1 < len(stage_qs) else None
+            threads.append(threading.Thread(target=self.run_stage, args=(stage, func, stage_qs[i], out_q),
+                                            name=f'{self.name}-{stage}', daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            while not self.shutdown_event.is_set() and not self.pipeline_failed.is_set():
+                q_items = self.next_batch()
+                if not q_items:
+                    continue
+                end_flag = q_items[-1] == 'END'
+                if end_flag:
+                    q_items = q_items[:-1]
+                if q_items:
+                    self.put_stage(stage_qs[0], q_items)
+                if end_flag:
+                    break
+        finally:
+            # None marks the end of the stream. Each stage passes it on once it has finished everything before it
+            self.put_stage(stage_qs[0], None)
+            for thread in threads:
+                thread.join()
+        if self.pipeline_error:
+            raise self.pipeline_error
+
+    def run_stage(self, stage, func, in_q, out_q):
+        """
+        target of each pipeline thread. Applies func to every item from in_q and passes the result (if not None) to
+        out_q, until the end of the stream is reached or another stage fails
+        :param stage: name of the stage, as it appears in self.PIPELINE_STAGES
+        :type stage: str
+        :param func: function applied to each item
+        :type func: Callable
+        :param in_q: queue the stage reads from
+        :type in_q: queue.Queue
+        :param out_q: queue the stage writes to, or None for the final stage
+        :type out_q: queue.Queue
+        """
+        try:
+            while not self.pipeline_failed.is_set():
+                try:
+                    item = in_q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    break
+                start = time.time()
+                result = func(item)
+                self.stage_timers[stage].update(time.time() - start)
+                if out_q is not None and result is not None:
+                    self.put_stage(out_q, result)
+        except Exception as exc:
+            self.logger.error(f'{stage} stage failed with {exc.__class__.__name__}: {exc}')
+            self.pipeline_error = exc
+            self.pipeline_failed.set()
+        finally:
+            if out_q is not None:
+                self.put_stage(out_q, None)
+
+    def put_stage(self, stage_q, item):
+        """put an item into a pipeline queue, waiting for space unless the pipeline has failed"""
+        while not self.pipeline_failed.is_set():
+            try:
+                stage_q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def next_batch(self):
+        """get the next item from the work queue, plus as many of the items already waiting behind it as will fit in
+        a batch. Never waits for additional items, so the batch size tracks the queue depth: a shallow queue (e.g., a
+        live camera that the detector is keeping up with) gives single-frame batches and no added latency, while a
+        backlog (e.g., fast replay of a source video) is processed in full batches"""
+        item = self.work_q.safe_get()
+        if not item:
+            return []
+        q_items = [item]
+        while len(q_items) < self.MAX_BATCH_SIZE and q_items[-1] != 'END':
+            item = self.work_q.safe_get(timeout=None)
+            if not item:
+                break
+            q_items.append(item)
+        return q_items
+
+    def preprocess_stage(self, q_items):
+        """crop each frame in the batch to the pipe and decide which crops need to go through the fish model, then
+        resize those into a batch tensor"""
+        frames = []
+        for cap_time, img in q_items:
+            if isinstance(img, str) and (img == 'MOCK_HIT'):
+                self.mock_hit_flag = True
+                continue
+            if isinstance(img, mptools.FrameRef):
+                frame_ref = img
+                try:
+                    crop = self.preprocess(self.frame_ring.resolve(frame_ref))
+                finally:
+                    self.frame_ring.release(frame_ref)
+            else:
+                crop = self.preprocess(img)
+            if crop is not None:
+                run_model = self.motion_gate.check(crop)
+                score = self.motion_gate.last_score
+                if self.defs.PIPE_MOTION_THRESH and score is not None and score >= self.defs.PIPE_MOTION_THRESH:
+                    # most of the crop changed at once, which is more likely a bumped camera than a fish
+                    self.logger.debug(f'large frame-wide change detected (score {score:.1f}). '
+                                      f'Requesting pipe relocalization')
+                    self.pipe_locator.request()
+                    # start the background over from this frame, so that a single camera move only triggers once
+                    self.motion_gate.reset()
+                skipped_by = None if run_model else 'motion'
+                if self.tracker and not self.tracker.schedule_detection() and run_model:
+                    run_model, skipped_by = False, 'tracker'
+                frames.append(Frame(cap_time, crop, run_model, self.crop_roi, skipped_by))
+        if not frames:
+            return None
+        # only frames that passed the motion gate (and, if tracking, that are due a detection) are run through the
+        # model. For the rest, detections are carried over from the previous frame during postprocessing, since that
+        # frame may be in the same batch
+        tensor, scales = self.prepare_batch([frame.crop for frame in frames if frame.run_model])
+        return PipelineBatch(frames, tensor, scales, None)
+
+    def inference_stage(self, batch):
+        """run the fish model on the batch tensor, if any of the frames in the batch need it"""
+        if not batch.scales:
+            return batch._replace(tensor=None, dets=[])
+        dets = self.fish_backend.infer_batch(batch.tensor, self.defs.CONF_THRESH, batch.scales)
+        self.batch_size_averager.update(len(batch.scales))
+        return batch._replace(tensor=None, dets=dets)
+
+    def postprocess_stage(self, batch):
+        """postprocess the frames of a batch in capture order"""
+        batch_dets = iter(batch.dets)
+        for frame in batch.frames:
+            if frame.roi is not self.pipe_roi:
+                self.pipe_roi = frame.roi
+                self.pipe_center, self.pipe_radius = frame.roi.center, frame.roi.radius
+                # the detections and tracks no longer line up with the crop
+                self.last_fish_dets = inference.Detections()
+                if self.tracker:
+                    self.tracker.reset()
+            self.postprocess(frame.cap_time, frame.crop, next(batch_dets) if frame.run_model else None,
+                             frame.skipped_by)
+
+    def preprocess(self, img):
+        """hand the frame to the pipe locator if it wants one, then crop the frame to the most recent pipe location.
+        Returns None if the pipe location is still unknown"""
+        self.frame_counter += 1
+        if not self.frame_counter % self.PIPE_UPDATE_INTERVAL:
+            self.pipe_locator.request()
+        if self.pipe_locator.wants_frame():
+            self.pipe_locator.submit(img)
+        roi = self.pipe_locator.roi
+        if roi is None:
+            # there is no previous location to fall back on, so wait (briefly) for the first localization
+            roi = self.pipe_locator.wait_for_roi(timeout=5)
+            if roi is None:
+                return None
+        if roi is not self.crop_roi:
+            # the crop no longer lines up with the motion gate's background
+            self.crop_roi = roi
+            self.motion_gate.reset()
+        xmin, ymin, xmax, ymax = roi.box
+        # copy the crop so that the buffer does not hold onto the full frame, which may live in a shared memory slot
+        # that the collector will reuse once it is released
+        return img[ymin:ymax, xmin:xmax].copy()
+
+    def postprocess(self, cap_time, img, fish_dets, skipped_by=None):
+        """filter the detections for a single frame, then update the hit counter and buffer, and trigger an event if
+        warranted. If fish_dets is None (i.e., inference was skipped because the frame was static, or because the
+        tracker did not need a fresh detection, as given by skipped_by), the previous frame's detections are reused, or
+        if tracking, the tracks are moved along by optical flow. Frames must be postprocessed in the order they were
+        captured"""
+        if fish_dets is None:
+            fish_dets = self.last_fish_dets
+            self.skip_counters[skipped_by] += 1
+            if self.tracker:
+                self.tracker.propagate(cv2.cvtColor(img, cv2.COLOR_RGB2GRAY))
+        else:
+            fish_dets = self.filter_fish_dets(fish_dets).top_k(self.max_fish)
+            self.last_fish_dets = fish_dets
+            self.empty_streak = 0 if fish_dets else self.empty_streak + 1
+            if self.empty_streak >= self.PIPE_EMPTY_STREAK:
+                self.logger.debug(f'no fish detected in {self.empty_streak} consecutive frames. Requesting pipe '
+                                  f'relocalization')
+                self.pipe_locator.request()
+                self.empty_streak = 0
+            if self.tracker:
+                self.tracker.update(fish_dets, cv2.cvtColor(img, cv2.COLOR_RGB2GRAY))
+        if self.tracker:
+            # only count fish that have been seen consistently, which smooths over single-frame false positives
+            fish_count = self.tracker.stable_count()
+            fish_dets = self.tracker.detections()
+        else:
+            fish_count = len(fish_dets)
+        self.buffer.append(cap_time, img, fish_dets)
+        hit_flag = fish_count >= 2
         if hit_flag:
             # modifier = sum([(det.score - self.defs.CONF_THRESH) / (1 - self.defs.CONF_THRESH) for det in fish_dets])
             modifier = 1.0
@@ -101,126 +886,132 @@ class DetectorWorker(mptools.QueueProcWorker, metaclass=gen_utils.AutologMetacla
         else:
             self.hit_counter.decrement()
         self.count_buffer.append(f'{cap_time},{self.hit_counter.hits:0.2f}\n')
+        if self.detect_lag is not None and not self.metadata['source']:
+            # how far detection is running behind the camera, which the trickle uploader uses to gauge the load
+            self.detect_lag.value = (gen_utils.current_time_ms() - cap_time) / 1000
         if (
             ((self.hit_counter.hits >= self.HIT_THRESH) or self.mock_hit_flag) and
-            len(self.buffer) >= self.IMG_BUFFER and
-            (not self.last_event or (time.time() - self.last_event) >= self.MIN_EVENT_INTERVAL))
+            self.buffer.full and
+            (self.last_event is None or (cap_time - self.last_event) / 1000 >= self.MIN_EVENT_INTERVAL)
         ):
             self.logger.info(f"Hit counter reached {self.hit_counter.hits}, possible spawning event")
-            img_paths = []
-            for be in self.buffer:
-                img_paths.append(self.overlay_boxes(be))
-            vid_path = self.jpgs_to_mp4(img_paths, 1//self.INTERVAL_SECS)
-
-            # comment the next two lines to disable spawning notifications
-            msg = f'possible spawning event in {self.metadata["tank_id"]} at {gen_utils.current_time_iso()}'
-            self.event_q.safe_put(mptools.EventMessage(self.name, 'NOTIFY', ['SPAWNING_EVENT', msg, vid_path]))
-            self.last_event = time.time()
+            msg = f'possible spawning event in {self.metadata["tank_id"]} at {self.describe_time(cap_time)}'
+            # the clip is written (and the notification sent) in the background
+            entries = self.buffer.drain()
+            # frames are buffered once every INTERVAL_SECS, which may be longer than a second
+            framerate = max(1, round(1 / self.INTERVAL_SECS))
+            self.clip_builder.submit(ClipRequest(entries, self.pipe_center, self.pipe_radius, framerate,
+                                                 msg, (entries[0].cap_time, cap_time)))
+            self.last_event = cap_time
             self.mock_hit_flag = False
             self.hit_counter.reset()
-            self.buffer = []
-        if len(self.buffer) > self.IMG_BUFFER:
-            self.buffer.pop(0)
         self.loop_counter += 1
         self.print_info()
 
-    def filter_fish_dets(self, fish_dets):
-        valid_dets = []
-        for det in fish_dets:
-            det_center = [(det.bbox.xmax + det.bbox.xmin) / 2, (det.bbox.ymax + det.bbox.ymin) / 2]
-            radial_dist = sqrt((det_center[0] - self.pipe_center[0])**2 + (det_center[1] - self.pipe_center[1])**2)
-            if radial_dist < self.pipe_radius:
-                valid_dets.append(det)
-        return valid_dets
+    def describe_time(self, cap_time):
+        """human-readable form of a frame timestamp. When replaying a source video quickly, timestamps are positions
+        within the video rather than wall-clock times"""
+        if self.metadata['source'] and self.defs.REPLAY_MODE == 'fast':
+            return f'{cap_time / 1000:.1f}s into {os.path.basename(self.metadata["source"])}'
+        return gen_utils.current_time_iso()
 
+    def filter_fish_dets(self, fish_dets):
+        """drop detections whose centers fall outside the pipe radius"""
+        return fish_dets.within_radius(self.pipe_center, self.pipe_radius)
 
     def print_info(self):
         if self.loop_counter == 1 or self.loop_counter == 10 or not self.loop_counter % 100:
-            self.logger.info(f'{self.loop_counter} detection loops completed. average deteciton time for last '
-                             f'{self.avg_timer.count} loops was {self.avg_timer.avg * 1000}ms')
-            self.avg_timer.reset()
+            self.logger.info(f'{self.loop_counter} detection loops completed. {self.describe_stage_timers()}. Average '
+                             f'batch size was {self.batch_size_averager.avg}. Inference was skipped on '
+                             f'{self.skip_counters["motion"]} static frames (motion gate) and '
+                             f'{self.skip_counters["tracker"]} frames between tracker detections. '
+                             f'{self.describe_buffer()}')
+            # the timers are updated from the other pipeline threads, so replace them rather than resetting in place
+            self.stage_timers = {stage: gen_utils.Averager() for stage in self.PIPELINE_STAGES}
+            self.batch_size_averager = gen_utils.Averager()
+            self.skip_counters = Counter()
             self.write_hit_buffer_to_file()
 
+    def describe_buffer(self):
+        """summarize the memory used by the frame buffer, and warn if the budget is cutting clips short"""
+        buf = self.buffer
+        description = (f'Frame buffer ({buf.mode}) holds {len(buf)} frames in {buf.nbytes / 1024 ** 2:.1f}MB of '
+                       f'{buf.max_bytes / 1024 ** 2:.0f}MB')
+        if buf.n_slots < buf.capacity or buf.evicted:
+            description += (f', which is not enough for the {buf.capacity} frames of IMG_BUFFER_SECS. Consider raising '
+                            f'IMG_BUFFER_MAX_MB or switching IMG_BUFFER_MODE to jpeg')
+        return description
+
+    def describe_stage_timers(self):
+        """summarize the average time per batch spent in each pipeline stage. Since the stages overlap, throughput is
+        limited by the slowest stage rather than by their sum"""
+        timers = self.stage_timers
+        descriptions = [f'{stage} {timers[stage].avg * 1000:.2f}ms' for stage in self.PIPELINE_STAGES
+                        if timers[stage].avg is not None]
+        if not descriptions:
+            return 'no batches timed'
+        slowest = max([s for s in self.PIPELINE_STAGES if timers[s].avg is not None], key=lambda s: timers[s].avg)
+        return f'average time per batch: {", ".join(descriptions)} (bottleneck: {slowest})'
+
     def write_hit_buffer_to_file(self):
         self.count_record.writelines(self.count_buffer)
         self.count_buffer = []
 
-    def update_pipe_location(self, img):
-        self.logger.debug('updating pipe location')
-        new_loc = self.detect(img, interp=self.pipe_interpreter, update_timer=False)
-        if not new_loc:
-            self.logger.debug('attempted to update pipe location but pipe was not detected. Will try again on next frame')
-            self.force_pipe_update = True
-            return
-        old_loc = self.pipe_det
-        self.pipe_det = sorted(new_loc, reverse=True, key=lambda x: x.score)[0]
-        self.pipe_center = [(self.pipe_det.bbox.xmax - self.pipe_det.bbox.xmin) / 2,
-                            (self.pipe_det.bbox.ymax - self.pipe_det.bbox.ymin) / 2]
-        self.pipe_radius = min(self.pipe_det.bbox.width, self.pipe_det.bbox.height) / 2
-        if not old_loc:
-            self.force_pipe_update = True
-            return
-        iou = detect.BBox.iou(old_loc.bbox, self.pipe_det.bbox)
-        if iou < 0.95:
-            self.logger.info(f'low IOU score detected. Pipe locator will rerun until IOU is above 0.95')
-            self.force_pipe_update = True
-        else:
-            self.logger.debug(f'pipe location updated. Confidence of {self.pipe_det.score}.'
-                              f' IOU with previous location of {iou}')
-            self.force_pipe_update = False
-
-    def detect(self, img, interp=None, update_timer=True):
+    def detect(self, img, backend=None):
         """run detection on a single image"""
-        if not interp:
-            interp = self.interpreter
-        start = time.time()
-        inf_size = common.input_size(interp)
-        scale = (inf_size[1]/img.shape[1], inf_size[0]/img.shape[0])
+        if not backend:
+            backend = self.fish_backend
+        inf_size = backend.input_size()
+        scale = (inf_size[0]/img.shape[1], inf_size[1]/img.shape[0])
         img = cv2.resize(img, inf_size)
-        run_inference(interp, img.tobytes())
-        dets = detect.get_objects(interp, self.defs.CONF_THRESH, scale)
-        if update_timer:
-            self.avg_timer.update(time.time() - start)
-        return dets
-
-    def overlay_boxes(self, buffer_entry: BufferEntry):
-        """open an image, draw detection boxes, and replace the original image"""
-        
-        def overlay_box(img_, det_, color_):
-            bbox = det_.bbox
-            cv2.rectangle(img_, (bbox.xmin, bbox.ymin), (bbox.xmax, bbox.ymax), color_, 2)
-            label = '%s\n%.2f' % ('fish', det_.score)
-            cv2.putText(img_, label,(bbox.xmin + 10, bbox.ymin + 10), cv2.FONT_HERSHEY_SIMPLEX, 1.0, color_, 2)
-        img = cv2.cvtColor(buffer_entry.img, cv2.COLOR_RGB2BGR)
-        for det in buffer_entry.fish_dets:
-            overlay_box(img, det, (0, 255, 0))
-        int_pipe_center = [int(np.round(coord)) for coord in self.pipe_center]
-        int_pipe_radius = int(np.round(self.pipe_radius))
-        cv2.circle(img, int_pipe_center, int_pipe_radius, (0, 255, 0), 2)
-        img_path = os.path.join(self.img_dir, f'{buffer_entry.cap_time}.jpg')
-        cv2.imwrite(img_path, img)
-        return img_path
-
-    def jpgs_to_mp4(self, img_paths, fps=30, delete_jpgs=True):
-        """convert a series of jpgs to a single mp4, and (if delete_jpgs) delete the original images"""
-        self.logger.debug(f'converting {len(img_paths)} images to a clip at {fps} fps')
-        if not img_paths:
-            return
-        dest_dir = self.defs.PROJ_VID_DIR
-        vid_path = internet_of_fish.modules.utils.advanced_utils.jpgs_to_mp4(img_paths, dest_dir, fps)
-        if delete_jpgs:
-            [os.remove(x) for x in img_paths]
-        return vid_path
+        backend.invoke(img)
+        return backend.get_detections(self.defs.CONF_THRESH, scale)
+
+    def prepare_batch(self, imgs):
+        """
+        resize a list of images into one contiguous input tensor for the fish model. Tensors are drawn from a small
+        pool, so that they can be reused once the batch they belonged to has cleared the inference stage
+        :param imgs: RGB images
+        :type imgs: list[np.ndarray]
+        :return: the batch tensor (a view with one entry per image) and the resize scale factors of each image
+        :rtype: tuple[np.ndarray, list[tuple[float, float]]]
+        """
+        if not imgs:
+            return None, []
+        inf_size = self.fish_backend.input_size()
+        tensor_shape = (self.MAX_BATCH_SIZE, inf_size[1], inf_size[0], 3)
+        tensor = self.batch_tensors[self.tensor_index]
+        if tensor is None or tensor.shape != tensor_shape:
+            tensor = self.batch_tensors[self.tensor_index] = np.empty(tensor_shape, dtype=np.uint8)
+        self.tensor_index = (self.tensor_index + 1) % len(self.batch_tensors)
+        scales = []
+        for i, img in enumerate(imgs):
+            scales.append((inf_size[0]/img.shape[1], inf_size[1]/img.shape[0]))
+            cv2.resize(img, inf_size, dst=tensor[i])
+        return tensor[:len(imgs)], scales
+
+    def notify_event(self, msg, vid_path):
+        # comment the next line to disable spawning notifications
+        self.event_q.safe_put(mptools.EventMessage(self.name, 'NOTIFY', ['SPAWNING_EVENT', msg, vid_path]))
 
     def shutdown(self):
-        if self.avg_timer.avg:
-            self.logger.log(logging.INFO, f'average time for detection loop: {self.avg_timer.avg * 1000}ms')
-        if self.metadata['source']:
+        if hasattr(self, 'stage_timers'):
+            self.logger.log(logging.INFO, self.describe_stage_timers())
+        if getattr(self, 'clip_builder', None):
+            self.clip_builder.stop()
+        if self.metadata['source'] and self.models_loaded:
             self.event_q.safe_put(
                 mptools.EventMessage(self.name, 'ENTER_PASSIVE_MODE', f'detection complete, entering passive mode'))
         self.work_q.close()
         self.event_q.close()
         self.count_record.close()
+        if getattr(self, 'pipe_locator', None):
+            self.pipe_locator.stop()
+        for backend in [getattr(self, 'fish_backend', None), getattr(self, 'pipe_backend', None)]:
+            if backend:
+                backend.close()
+        if self.frame_ring:
+            self.frame_ring.close()
 
 
 
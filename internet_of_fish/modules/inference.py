@@ -0,0 +1,433 @@
+"""inference backends used by the DetectorWorker. Each backend wraps a single detection model and exposes the same
+small interface (input_size, invoke, get_detections), so that the detector can run on an EdgeTPU, on the CPU through
+tflite-runtime, or against a deterministic mock when benchmarking or testing on a machine without a Coral."""
+
+import json
+import os
+import time
+
+import numpy as np
+
+BACKENDS = ['edgetpu', 'cpu', 'mock']
+# (mean, std) used to normalize the input of float models that carry no normalization metadata. This maps pixel values
+# to [-1, 1], which is what the float SSD models from the tensorflow object detection api expect
+DEFAULT_INPUT_NORM = (127.5, 127.5)
+
+
+class Detections:
+
+    def __init__(self, boxes=None, scores=None, class_ids=None):
+        """
+        array-backed set of detections for a single image. Boxes, scores, and class ids are stored as parallel arrays,
+        so that sorting, filtering, and IoU calculations are vectorized, and so that detections are cheap to pickle or
+        store
+        :param boxes: bounding boxes in pixel coordinates, as (xmin, ymin, xmax, ymax) rows
+        :type boxes: np.ndarray
+        :param scores: score of each detection
+        :type scores: np.ndarray
+        :param class_ids: class id of each detection
+        :type class_ids: np.ndarray
+        """
+        self.boxes = np.zeros((0, 4), np.float32) if boxes is None else np.asarray(boxes, np.float32).reshape(-1, 4)
+        self.scores = np.zeros(0, np.float32) if scores is None else np.asarray(scores, np.float32).reshape(-1)
+        self.class_ids = np.zeros(len(self.scores), np.int32) if class_ids is None else \
+            np.asarray(class_ids, np.int32).reshape(-1)
+
+    @classmethod
+    def from_tensors(cls, boxes, class_ids, scores, count, input_size, score_threshold, image_scale=(1.0, 1.0)):
+        """
+        build detections from the raw output tensors of a detection model (for a single image), in the same way as
+        pycoral's detect.get_objects
+        :param boxes: normalized boxes, as (ymin, xmin, ymax, xmax) rows
+        :param class_ids: class id of each box
+        :param scores: score of each box
+        :param count: number of valid boxes
+        :param input_size: model input size, as (width, height)
+        :param score_threshold: detections with scores below this value are dropped
+        :param image_scale: (x, y) scale factors that were applied when resizing the original image to the input size
+        :return: detections, with bounding boxes in the coordinates of the original image
+        :rtype: Detections
+        """
+        count = int(count)
+        scores = np.asarray(scores[:count], np.float32)
+        keep = scores >= score_threshold
+        sx, sy = input_size[0] / image_scale[0], input_size[1] / image_scale[1]
+        # reorder to (xmin, ymin, xmax, ymax) and scale to pixels of the original image
+        boxes = np.asarray(boxes[:count], np.float32)[keep][:, [1, 0, 3, 2]] * np.array([sx, sy, sx, sy], np.float32)
+        return cls(np.floor(boxes), scores[keep], np.asarray(class_ids[:count])[keep])
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __getitem__(self, index):
+        """index with an int, slice, boolean mask, or array of indices. Always returns a Detections instance"""
+        if isinstance(index, (int, np.integer)):
+            index = [index]
+        return Detections(self.boxes[index], self.scores[index], self.class_ids[index])
+
+    def __repr__(self):
+        rows = ', '.join(f'{score:.2f}@({xmin:.0f},{ymin:.0f},{xmax:.0f},{ymax:.0f})'
+                         for (xmin, ymin, xmax, ymax), score in zip(self.boxes, self.scores))
+        return f'Detections([{rows}])'
+
+    @property
+    def centers(self):
+        return (self.boxes[:, :2] + self.boxes[:, 2:]) / 2
+
+    @property
+    def sizes(self):
+        """(width, height) of each box"""
+        return self.boxes[:, 2:] - self.boxes[:, :2]
+
+    def sorted(self):
+        """copy of the detections, in descending order of score"""
+        return self[np.argsort(-self.scores, kind='stable')]
+
+    def top_k(self, k):
+        """the k highest-scoring detections, in descending order of score"""
+        return self.sorted()[:k]
+
+    def within_radius(self, center, radius):
+        """
+        keep only the detections whose box centers fall within a circle
+        :param center: (x, y) center of the circle
+        :type center: Sequence[float]
+        :param radius: radius of the circle
+        :type radius: float
+        :rtype: Detections
+        """
+        dists = np.hypot(*(self.centers - np.asarray(center, np.float32)).T)
+        return self[dists < radius]
+
+    def iou(self, other):
+        """
+        pairwise intersection over union with another set of detections
+        :param other: detections (or an array of (xmin, ymin, xmax, ymax) boxes) to compare against
+        :type other: Detections | np.ndarray
+        :return: IoU matrix with shape (len(self), len(other))
+        :rtype: np.ndarray
+        """
+        other_boxes = other.boxes if isinstance(other, Detections) else np.asarray(other, np.float32).reshape(-1, 4)
+        return box_iou(self.boxes, other_boxes)
+
+    def int_box(self, index):
+        """box of a single detection as a tuple of ints, for cropping and drawing"""
+        return tuple(int(v) for v in np.round(self.boxes[index]))
+
+
+def box_iou(boxes_a, boxes_b):
+    """
+    pairwise intersection over union between two arrays of (xmin, ymin, xmax, ymax) boxes
+    :return: IoU matrix with shape (len(boxes_a), len(boxes_b))
+    :rtype: np.ndarray
+    """
+    top_left = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(boxes_a[:, 2:] - boxes_a[:, :2], axis=1)
+    area_b = np.prod(boxes_b[:, 2:] - boxes_b[:, :2], axis=1)
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+class InferenceBackend:
+
+    def __init__(self, model_path):
+        """
+        base class for inference backends
+        :param model_path: path to the .tflite model file
+        :type model_path: str
+        """
+        self.model_path = model_path
+
+    def input_size(self):
+        """
+        get the input size expected by the model
+        :return: model input size as (width, height)
+        :rtype: tuple[int, int]
+        """
+        raise NotImplementedError(f"{self.__class__.__name__}.input_size is not implemented")
+
+    def invoke(self, img):
+        """
+        run the model on a single image that has already been resized to self.input_size()
+        :param img: RGB image with shape (height, width, 3)
+        :type img: np.ndarray
+        """
+        raise NotImplementedError(f"{self.__class__.__name__}.invoke is not implemented")
+
+    def get_detections(self, score_threshold, image_scale=(1.0, 1.0)):
+        """
+        get the detections produced by the last call to invoke
+        :param score_threshold: detections with scores below this value are dropped
+        :type score_threshold: float
+        :param image_scale: (x, y) scale factors that were applied when resizing the original image to the input size
+        :type image_scale: tuple[float, float]
+        :return: detections, with bounding boxes in the coordinates of the original image
+        :rtype: Detections
+        """
+        raise NotImplementedError(f"{self.__class__.__name__}.get_detections is not implemented")
+
+    def infer_batch(self, batch, score_threshold, image_scales):
+        """
+        run the model on a batch of images and return the detections for each. The default implementation invokes the
+        model once per image; backends that can run a whole batch in a single invocation override this.
+        :param batch: contiguous array of images with shape (n, height, width, 3), already resized to self.input_size()
+        :type batch: np.ndarray
+        :param score_threshold: detections with scores below this value are dropped
+        :type score_threshold: float
+        :param image_scales: (x, y) resize scale factors for each image in the batch (see get_detections)
+        :type image_scales: list[tuple[float, float]]
+        :return: detections for each image, in batch order
+        :rtype: list[Detections]
+        """
+        results = []
+        for img, scale in zip(batch, image_scales):
+            self.invoke(img)
+            results.append(self.get_detections(score_threshold, scale))
+        return results
+
+    def close(self):
+        pass
+
+
+class TFLiteBackend(InferenceBackend):
+    """shared logic for backends built around a tflite interpreter"""
+
+    def __init__(self, model_path):
+        super().__init__(model_path)
+        self.interpreter = self.make_interpreter()
+        self.interpreter.allocate_tensors()
+
+    def make_interpreter(self):
+        raise NotImplementedError(f"{self.__class__.__name__}.make_interpreter is not implemented")
+
+    def input_size(self):
+        # the input tensor has shape (batch, height, width, channels)
+        _, height, width, _ = self.interpreter.get_input_details()[0]['shape']
+        return int(width), int(height)
+
+    def get_detections(self, score_threshold, image_scale=(1.0, 1.0)):
+        boxes, class_ids, scores, count = self.output_tensors(1)
+        return Detections.from_tensors(boxes[0], class_ids[0], scores[0], count[0], self.input_size(), score_threshold,
+                                       image_scale)
+
+    def output_tensors(self, batch_size):
+        """get the (boxes, class_ids, scores, count) output tensors, each with a leading batch dimension. Mirrors the
+        output layouts understood by pycoral's detect.get_objects"""
+        signature_list = self.interpreter._get_full_signature_list()
+        if signature_list:
+            outputs = signature_list[next(iter(signature_list))]['outputs']
+            count, scores, class_ids, boxes = [self.interpreter.tensor(outputs[f'output_{i}'])() for i in range(4)]
+        else:
+            tensors = [self.interpreter.get_tensor(d['index']) for d in self.interpreter.get_output_details()]
+            if tensors[3].size == batch_size:
+                boxes, class_ids, scores, count = tensors
+            else:
+                scores, boxes, count, class_ids = tensors
+        return boxes, class_ids, scores, count.reshape(batch_size)
+
+
+class EdgeTPUBackend(TFLiteBackend):
+    """runs an EdgeTPU-compiled model on a Coral accelerator"""
+
+    def make_interpreter(self):
+        from pycoral.utils.edgetpu import make_interpreter
+        return make_interpreter(self.model_path)
+
+    def invoke(self, img):
+        from pycoral.utils.edgetpu import run_inference
+        run_inference(self.interpreter, img.tobytes())
+
+
+class CPUBackend(TFLiteBackend):
+    """runs a standard (not EdgeTPU-compiled) model on the CPU using tflite-runtime, which applies the XNNPACK
+    delegate by default. Falls back to the full tensorflow package if tflite-runtime is not installed"""
+
+    def __init__(self, model_path, num_threads=0, input_norm=None):
+        """
+        :param model_path: path to the .tflite model file
+        :type model_path: str
+        :param num_threads: number of CPU threads the interpreter may use. 0 (default) uses every available core
+        :type num_threads: int
+        :param input_norm: (mean, std) applied to the pixel values of float models, i.e., (pixel - mean) / std. By
+            default, this is read from the model's metadata (see read_input_norm), falling back to DEFAULT_INPUT_NORM.
+            Ignored for quantized models
+        :type input_norm: tuple[float, float]
+        """
+        self.num_threads = num_threads if num_threads else os.cpu_count()
+        super().__init__(model_path)
+        self.input_details = self.interpreter.get_input_details()[0]
+        if input_norm is None:
+            input_norm = read_input_norm(model_path) or DEFAULT_INPUT_NORM
+        self.input_mean, self.input_std = (np.asarray(v, np.float32) for v in input_norm)
+        self.batch_size = 1
+        self.supports_batching = True
+
+    def make_interpreter(self):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+        return Interpreter(model_path=self.model_path, num_threads=self.num_threads)
+
+    def prepare_input(self, batch):
+        dtype = self.input_details['dtype']
+        if dtype == np.int8:
+            # fully quantized models take int8 input, offset by the input tensor's zero point
+            scale, zero_point = self.input_details['quantization']
+            batch = (batch.astype(np.float32) / scale + zero_point).clip(-128, 127)
+        elif np.issubdtype(dtype, np.floating):
+            # float models expect normalized pixel values, rather than raw 0-255 values
+            batch = (batch.astype(np.float32) - self.input_mean) / self.input_std
+        return batch.astype(dtype, copy=False)
+
+    def resize_batch(self, batch_size):
+        if batch_size != self.batch_size:
+            width, height = self.input_size()
+            # if allocation fails, the input tensor is left at neither size, so the next call must resize it again
+            self.batch_size = None
+            self.interpreter.resize_tensor_input(self.input_details['index'], [batch_size, height, width, 3])
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch_size
+
+    def invoke(self, img):
+        self.resize_batch(1)
+        self.interpreter.set_tensor(self.input_details['index'], self.prepare_input(img[np.newaxis]))
+        self.interpreter.invoke()
+
+    def infer_batch(self, batch, score_threshold, image_scales):
+        if len(batch) == 1 or not self.supports_batching:
+            return super().infer_batch(batch, score_threshold, image_scales)
+        try:
+            self.resize_batch(len(batch))
+            self.interpreter.set_tensor(self.input_details['index'], self.prepare_input(batch))
+            self.interpreter.invoke()
+            boxes, class_ids, scores, counts = self.output_tensors(len(batch))
+        except (RuntimeError, ValueError):
+            # some models (e.g., those ending in a detection post-processing op) only run with a batch size of 1
+            self.supports_batching = False
+            self.resize_batch(1)
+            return super().infer_batch(batch, score_threshold, image_scales)
+        return [Detections.from_tensors(boxes[i], class_ids[i], scores[i], counts[i], self.input_size(),
+                                        score_threshold, image_scales[i])
+                for i in range(len(batch))]
+
+
+class MockBackend(InferenceBackend):
+    """stands in for a real model. Sleeps for a fixed latency on every invocation and always returns the same
+    detections, clustered around the center of the image. Useful for benchmarking the rest of the pipeline"""
+
+    def __init__(self, model_path=None, latency_ms=10, n_dets=1, size=(320, 320), box_size=0.1):
+        """
+        :param model_path: ignored, but accepted for consistency with the other backends
+        :type model_path: str
+        :param latency_ms: simulated inference time, in milliseconds
+        :type latency_ms: float
+        :param n_dets: number of detections to return from each invocation
+        :type n_dets: int
+        :param size: simulated model input size, as (width, height)
+        :type size: tuple[int, int]
+        :param box_size: width and height of each detection, as a fraction of the image size
+        :type box_size: float
+        """
+        super().__init__(model_path)
+        self.latency_ms = latency_ms
+        self.n_dets = n_dets
+        self.size = tuple(size)
+        self.box_size = box_size
+
+    def input_size(self):
+        return self.size
+
+    def invoke(self, img):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def infer_batch(self, batch, score_threshold, image_scales):
+        # simulate a backend that runs the whole batch in a single invocation
+        self.invoke(batch)
+        return [self.get_detections(score_threshold, scale) for scale in image_scales]
+
+    def get_detections(self, score_threshold, image_scale=(1.0, 1.0)):
+        width, height = self.size[0] / image_scale[0], self.size[1] / image_scale[1]
+        # boxes fanned out slightly from the center of the image so they do not fully overlap
+        offsets = 0.5 - self.box_size / 2 + (np.arange(self.n_dets) - (self.n_dets - 1) / 2) * 0.05
+        boxes = np.stack([width * offsets, height * offsets, width * (offsets + self.box_size),
+                          height * (offsets + self.box_size)], axis=1)
+        scores = 0.9 - 0.01 * np.arange(self.n_dets)
+        keep = scores >= score_threshold
+        return Detections(np.floor(boxes[keep]), scores[keep])
+
+
+def read_input_norm(model_path):
+    """
+    read the input normalization of a float model from its tflite metadata, if it has any. Needs the optional
+    tflite-support package
+    :param model_path: path to the .tflite model file
+    :type model_path: str
+    :return: (mean, std) of the model's input, each a float or a per-channel list, or None if the model has no
+        normalization metadata (or it cannot be read)
+    :rtype: tuple
+    """
+    try:
+        from tflite_support import metadata
+        model_metadata = json.loads(metadata.MetadataDisplayer.with_model_file(model_path).get_metadata_json())
+    except (ImportError, ValueError, OSError):
+        return None
+    for subgraph in model_metadata.get('subgraph_metadata', []):
+        for tensor in subgraph.get('input_tensor_metadata', []):
+            for unit in tensor.get('process_units', []):
+                if unit.get('options_type') == 'NormalizationOptions':
+                    return unit['options']['mean'], unit['options']['std']
+    return None
+
+
+def select_model(model_paths, role, backend='edgetpu'):
+    """
+    pick the model file for a given role from a list of candidate .tflite files. The fish model is identified by
+    "ooi" in its file name, and the pipe model by "roi". EdgeTPU-compiled models (with "edgetpu" in their name) are
+    preferred for the edgetpu backend, and avoided for the cpu backend, which cannot run them.
+    :param model_paths: paths to candidate .tflite files
+    :type model_paths: list[str]
+    :param role: either 'ooi' (fish model) or 'roi' (pipe model)
+    :type role: str
+    :param backend: name of the backend that will run the model
+    :type backend: str
+    :return: path to the selected model, or None if no suitable model was found
+    :rtype: str
+    """
+    candidates = sorted([m for m in model_paths if role in os.path.basename(m)])
+    compiled = [m for m in candidates if 'edgetpu' in os.path.basename(m)]
+    uncompiled = [m for m in candidates if m not in compiled]
+    if backend == 'cpu':
+        candidates = uncompiled
+    elif backend == 'edgetpu':
+        candidates = compiled + uncompiled
+    return candidates[0] if candidates else None
+
+
+def make_backend(backend, model_path, defs=None, **kwargs):
+    """
+    instantiate an inference backend by name
+    :param backend: one of 'edgetpu', 'cpu', or 'mock'
+    :type backend: str
+    :param model_path: path to the .tflite model file. May be None for the mock backend
+    :type model_path: str
+    :param defs: frozen definitions (see gen_utils.freeze_definitions), used to fill in backend-specific settings
+    :type defs: types.SimpleNamespace
+    :param kwargs: additional keyword arguments passed to the backend constructor, overriding values from defs
+    :return: the new backend
+    :rtype: InferenceBackend
+    """
+    if backend == 'edgetpu':
+        return EdgeTPUBackend(model_path, **kwargs)
+    if backend == 'cpu':
+        if defs is not None:
+            kwargs.setdefault('num_threads', defs.CPU_THREADS)
+        return CPUBackend(model_path, **kwargs)
+    if backend == 'mock':
+        if defs is not None:
+            kwargs.setdefault('latency_ms', defs.MOCK_LATENCY_MS)
+        return MockBackend(model_path, **kwargs)
+    raise ValueError(f'unknown inference backend {backend}. Valid options are {", ".join(BACKENDS)}')
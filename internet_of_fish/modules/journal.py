@@ -0,0 +1,578 @@
+"""persistent record of the files that are waiting to be uploaded, being uploaded, or already uploaded from this device.
+The journal is a small sqlite database shared by the runner (which registers files) and the upload workers (which claim
+and upload them), so that uploads survive restarts, and no file is uploaded twice."""
+
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from internet_of_fish.modules import definitions
+from internet_of_fish.modules.utils import file_utils
+
+JournalEntry = namedtuple('JournalEntry', ['path', 'size', 'mtime', 'hash', 'state', 'attempts', 'last_error',
+                                           'claimed_by', 'added', 'updated', 'upload_class', 'priority',
+                                           'next_attempt', 'error_class'])
+
+# entry states
+PENDING = 'pending'  # waiting to be claimed by an upload worker
+CONVERTING = 'converting'  # an h264 that is being converted to mp4. Its mp4 gets an entry of its own once converted
+CONVERTED = 'converted'  # an h264 that has been replaced by an mp4
+UPLOADING = 'uploading'  # claimed by an upload worker
+UPLOADED = 'uploaded'
+FAILED = 'failed'  # ran out of upload attempts. Reset to pending if the file is registered again
+MISSING = 'missing'  # the file disappeared before it could be uploaded
+STATES = [PENDING, CONVERTING, CONVERTED, UPLOADING, UPLOADED, FAILED, MISSING]
+
+# upload classes, checked in order against each file name. Lower priorities are uploaded first, so that small,
+# high-value files are never stuck behind a multi-GB video
+UploadClass = namedtuple('UploadClass', ['name', 'priority', 'pattern'])
+UPLOAD_CLASSES = [
+    UploadClass('clip', 0, r'.*_event\.mp4'),
+    UploadClass('record', 0, r'.*\.csv'),
+    UploadClass('metadata', 1, r'.*\.json'),
+    UploadClass('log', 2, r'.*\.log(\.\d+)?'),
+    UploadClass('annotation', 2, r'.*\.tar'),
+    UploadClass('video', 3, r'.*\.(mp4|h264|avi)'),
+]
+DEFAULT_CLASS = UploadClass('other', 2, None)
+# classes of files that only ever grow by having data appended (until they are rotated or replaced), which are hashed
+# incrementally, and uploaded as tails of new data when possible (see HashIndex)
+APPEND_ONLY_CLASSES = ['log', 'record']
+
+# retry policies for failed uploads, checked in order against each error message. A failed upload is handed back to the
+# journal, and only claimed again once a delay has passed, which grows exponentially with the number of failed attempts
+# from base_secs up to max_secs. Auth failures and full disks will not fix themselves in a minute, so they back off
+# further than the network blips that make up most failures
+RetryPolicy = namedtuple('RetryPolicy', ['name', 'base_secs', 'max_secs', 'pattern'])
+RETRY_POLICIES = [
+    RetryPolicy('auth', 600, 4 * 3600,
+                r'unauthori[sz]ed|forbidden|access ?denied|invalid.{0,10}token|expired|credentials|\b40[13]\b'),
+    RetryPolicy('disk', 300, 3600, r'no space left|input/output error|read-only file system|quota|\[errno (5|28|30)\]'),
+    RetryPolicy('network', 30, 1800,
+                r'timed? ?out|connection|network|unreachable|name resolution|no such host|temporary failure|'
+                r'broken pipe|could not reach|\beof\b'),
+]
+DEFAULT_POLICY = RetryPolicy('other', 60, 1800, None)
+
+HashEntry = namedtuple('HashEntry', ['path', 'size', 'mtime', 'hash', 'remote_size', 'remote_hash'])
+
+
+def retry_policy(error):
+    """
+    :return: the retry policy for an upload error
+    :rtype: RetryPolicy
+    """
+    for policy in RETRY_POLICIES:
+        if re.search(policy.pattern, str(error), re.IGNORECASE):
+            return policy
+    return DEFAULT_POLICY
+
+
+def retry_delay(policy, attempts):
+    """
+    :param policy: retry policy for the error
+    :type policy: RetryPolicy
+    :param attempts: number of failed attempts so far, including the latest
+    :type attempts: int
+    :return: seconds to wait before the next attempt. The exponential delay is jittered (between half and all of it),
+        so that files that failed together, such as every upload in flight when the network dropped, do not all retry
+        at the same moment
+    :rtype: float
+    """
+    delay = min(policy.max_secs, policy.base_secs * 2 ** max(0, attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def classify(path):
+    """
+    :return: the upload class of a file
+    :rtype: UploadClass
+    """
+    name = os.path.basename(path)
+    for upload_class in UPLOAD_CLASSES:
+        if re.fullmatch(upload_class.pattern, name):
+            return upload_class
+    return DEFAULT_CLASS
+
+
+class UploadJournal:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS uploads (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            hash TEXT,
+            state TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            claimed_by TEXT,
+            added REAL NOT NULL,
+            updated REAL NOT NULL,
+            upload_class TEXT,
+            priority INTEGER,
+            next_attempt REAL,
+            error_class TEXT
+        )"""
+
+    def __init__(self, db_path=definitions.UPLOAD_JOURNAL_FILE, max_tries=3):
+        """
+        on-device journal of uploads. Each process should open its own UploadJournal; within a process, a single
+        journal can be shared between threads. Work is handed out by claim(), which atomically moves a pending entry to
+        the uploading state, so concurrent workers never receive the same file
+        :param db_path: path to the sqlite database. Created if it does not exist
+        :type db_path: str
+        :param max_tries: number of failed upload attempts after which an entry is marked as failed
+        :type max_tries: int
+        """
+        self.db_path = db_path
+        self.max_tries = max_tries
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # autocommit mode, so that transactions are only ever opened explicitly (see transaction())
+        self.conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.lock:
+            # write-ahead logging lets readers (e.g., the ui) work alongside a writer
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(self.SCHEMA)
+            self._migrate()
+
+    def _migrate(self):
+        """bring a journal created by an older version up to date"""
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(uploads)')]
+        if 'upload_class' not in columns:
+            self.conn.execute('ALTER TABLE uploads ADD COLUMN upload_class TEXT')
+            self.conn.execute('ALTER TABLE uploads ADD COLUMN priority INTEGER')
+            for path, in self.conn.execute('SELECT path FROM uploads').fetchall():
+                upload_class = classify(path)
+                self.conn.execute('UPDATE uploads SET upload_class = ?, priority = ? WHERE path = ?',
+                                  (upload_class.name, upload_class.priority, path))
+        if 'next_attempt' not in columns:
+            self.conn.execute('ALTER TABLE uploads ADD COLUMN next_attempt REAL')
+            self.conn.execute('ALTER TABLE uploads ADD COLUMN error_class TEXT')
+
+    @contextmanager
+    def transaction(self):
+        """hold the database's write lock for the duration of the block, committing on success"""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def _get(self, conn, path):
+        row = conn.execute(f'SELECT {", ".join(JournalEntry._fields)} FROM uploads WHERE path = ?',
+                           (path,)).fetchone()
+        return JournalEntry(*row) if row else None
+
+    def _set(self, conn, path, **fields):
+        fields['updated'] = time.time()
+        assignments = ', '.join(f'{key} = ?' for key in fields)
+        conn.execute(f'UPDATE uploads SET {assignments} WHERE path = ?', (*fields.values(), path))
+
+    def get(self, path):
+        """
+        :return: the journal entry for path, or None if the path has never been registered
+        :rtype: JournalEntry
+        """
+        with self.lock:
+            return self._get(self.conn, os.path.abspath(path))
+
+    def add(self, path, state=PENDING):
+        """
+        register a file for upload. Files that have already been uploaded, and have not changed since, are skipped, as
+        are files that are currently being uploaded or converted. Files that previously failed (or changed since they
+        were uploaded) are queued again with a fresh set of attempts
+        :param path: path to the file
+        :type path: str
+        :param state: initial state of the entry. Use CONVERTING for an h264 that is about to be converted
+        :type state: str
+        :return: True if the file was queued, False if it was skipped
+        :rtype: bool
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        upload_class = classify(path)
+        now = time.time()
+        with self.transaction() as conn:
+            entry = self._get(conn, path)
+            if entry is None:
+                conn.execute('INSERT INTO uploads (path, size, mtime, state, added, updated, upload_class, priority) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (path, stat.st_size, stat.st_mtime, state, now, now, upload_class.name,
+                              upload_class.priority))
+                return True
+            unchanged = entry.size == stat.st_size and entry.mtime == stat.st_mtime
+            if entry.state in (UPLOADING, CONVERTING) or (entry.state in (UPLOADED, PENDING) and unchanged):
+                return False
+            self._set(conn, path, size=stat.st_size, mtime=stat.st_mtime, hash=None, state=state, attempts=0,
+                      last_error=None, claimed_by=None, next_attempt=None, error_class=None)
+            return True
+
+    def claim(self, worker_name, class_limits=None):
+        """
+        atomically claim the next pending entry for upload. Entries are handed out in order of their class priority
+        (see UPLOAD_CLASSES), then smallest first, then oldest first. Entries waiting to be retried (see
+        record_failure()) are passed over until their retry comes due. Entries whose files no longer exist are marked
+        as missing and passed over
+        :param worker_name: name of the claiming worker, recorded in the entry
+        :type worker_name: str
+        :param class_limits: max number of simultaneous uploads for particular upload classes, e.g., {'video': 1}.
+            Entries of a class that is at its limit are left for later
+        :type class_limits: dict[str, int]
+        :return: the claimed entry, or None if nothing is ready (i.e., nothing is pending, or everything pending is
+            held back by its limit or waiting to be retried)
+        :rtype: JournalEntry
+        """
+        class_limits = {name: limit for name, limit in (class_limits or {}).items() if limit}
+        while True:
+            with self.transaction() as conn:
+                uploading = dict(conn.execute('SELECT upload_class, COUNT(*) FROM uploads WHERE state = ? '
+                                              'GROUP BY upload_class', (UPLOADING,)).fetchall())
+                full = [name for name, limit in class_limits.items() if uploading.get(name, 0) >= limit]
+                row = conn.execute(f'SELECT path FROM uploads WHERE state = ? '
+                                   f'AND (next_attempt IS NULL OR next_attempt <= ?) '
+                                   f'AND upload_class NOT IN ({", ".join("?" * len(full))}) '
+                                   f'ORDER BY priority, size, added LIMIT 1', (PENDING, time.time(), *full)).fetchone()
+                if row is None:
+                    return None
+                path, = row
+                if not os.path.exists(path):
+                    self._set(conn, path, state=MISSING, claimed_by=None)
+                    continue
+                self._set(conn, path, state=UPLOADING, claimed_by=worker_name)
+                return self._get(conn, path)
+
+    def start_conversion(self, path):
+        """
+        move a pending h264 back into the converting state, e.g., one whose conversion was cancelled at shutdown and
+        released by release_claims(), so that it goes back to the conversion pool rather than to an upload worker
+        :param path: path to the h264
+        :type path: str
+        :return: True if the entry was pending and is now converting
+        :rtype: bool
+        """
+        with self.transaction() as conn:
+            cursor = conn.execute('UPDATE uploads SET state = ?, updated = ? WHERE path = ? AND state = ?',
+                                  (CONVERTING, time.time(), os.path.abspath(path), PENDING))
+            return cursor.rowcount > 0
+
+    def finish_conversion(self, h264_path, mp4_path, claimed_by=None):
+        """
+        record that an h264 has been converted to an mp4, and register the mp4 in its place. The mp4 inherits the
+        h264's claim (if any), so a worker that converts a file it has claimed can go on to upload the result
+        :param h264_path: path to the original h264
+        :type h264_path: str
+        :param mp4_path: path to the new mp4
+        :type mp4_path: str
+        :param claimed_by: name of the worker holding the claim, or None if the mp4 should be queued for any worker
+        :type claimed_by: str
+        """
+        h264_path, mp4_path = os.path.abspath(h264_path), os.path.abspath(mp4_path)
+        stat = os.stat(mp4_path)
+        now = time.time()
+        with self.transaction() as conn:
+            entry = self._get(conn, h264_path)
+            added = entry.added if entry else now
+            if entry:
+                self._set(conn, h264_path, state=CONVERTED, claimed_by=None)
+            upload_class = classify(mp4_path)
+            conn.execute('INSERT OR REPLACE INTO uploads (path, size, mtime, state, claimed_by, added, updated, '
+                         'upload_class, priority) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (mp4_path, stat.st_size, stat.st_mtime, UPLOADING if claimed_by else PENDING, claimed_by,
+                          added, now, upload_class.name, upload_class.priority))
+
+    def complete(self, path, file_hash=None):
+        """
+        record a successful upload
+        :param path: path to the uploaded file
+        :type path: str
+        :param file_hash: hash of the uploaded file's contents
+        :type file_hash: str
+        """
+        with self.transaction() as conn:
+            self._set(conn, os.path.abspath(path), state=UPLOADED, hash=file_hash, claimed_by=None, last_error=None,
+                      next_attempt=None, error_class=None)
+
+    def record_failure(self, path, error, retry=False):
+        """
+        record a failed upload attempt. Once max_tries attempts have failed, the entry is marked as failed and its claim
+        is released
+        :param path: path to the file
+        :type path: str
+        :param error: description of the failure
+        :type error: str
+        :param retry: if True, the claim is also released after attempts that leave tries remaining, and the entry is
+            scheduled for retry after a delay set by the error's retry policy (see RETRY_POLICIES). Otherwise the
+            claimant keeps the entry, and is expected to retry it itself
+        :type retry: bool
+        :return: number of attempts remaining
+        :rtype: int
+        """
+        path = os.path.abspath(path)
+        policy = retry_policy(error)
+        with self.transaction() as conn:
+            entry = self._get(conn, path)
+            if entry is None:
+                return 0
+            attempts = entry.attempts + 1
+            if attempts >= self.max_tries:
+                self._set(conn, path, attempts=attempts, last_error=str(error), error_class=policy.name, state=FAILED,
+                          claimed_by=None, next_attempt=None)
+            elif retry:
+                self._set(conn, path, attempts=attempts, last_error=str(error), error_class=policy.name, state=PENDING,
+                          claimed_by=None, next_attempt=time.time() + retry_delay(policy, attempts))
+            else:
+                self._set(conn, path, attempts=attempts, last_error=str(error), error_class=policy.name)
+            return max(0, self.max_tries - attempts)
+
+    def release(self, path, state=PENDING):
+        """
+        give up a claim (or end a conversion) without completing the upload, returning the entry to the pending state
+        so that it will be picked up again
+        """
+        with self.transaction() as conn:
+            self._set(conn, os.path.abspath(path), state=state, claimed_by=None)
+
+    def forget(self, path):
+        """remove a file from the journal entirely (e.g., a fragment that was deleted rather than uploaded)"""
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM uploads WHERE path = ?', (os.path.abspath(path),))
+
+    def release_claims(self):
+        """
+        return every claimed or converting entry to the pending state. Used to recover after a restart, and must only
+        be called while no upload workers or conversions are running
+        :return: number of entries released
+        :rtype: int
+        """
+        with self.transaction() as conn:
+            cursor = conn.execute('UPDATE uploads SET state = ?, claimed_by = NULL, updated = ? WHERE state IN (?, ?)',
+                                  (PENDING, time.time(), UPLOADING, CONVERTING))
+            return cursor.rowcount
+
+    def entries(self, state=None):
+        """
+        :param state: if given, only return entries in this state
+        :type state: str
+        :return: journal entries, in the order claim() would hand them out
+        :rtype: list[JournalEntry]
+        """
+        query = f'SELECT {", ".join(JournalEntry._fields)} FROM uploads'
+        params = ()
+        if state:
+            query += ' WHERE state = ?'
+            params = (state,)
+        with self.lock:
+            return [JournalEntry(*row) for row in self.conn.execute(query + ' ORDER BY priority, size, added', params)]
+
+    def counts(self):
+        """
+        :return: number of entries in each state
+        :rtype: dict[str, int]
+        """
+        with self.lock:
+            counts = dict(self.conn.execute('SELECT state, COUNT(*) FROM uploads GROUP BY state').fetchall())
+        return {state: counts.get(state, 0) for state in STATES}
+
+    def next_retry(self):
+        """
+        :return: time at which the soonest scheduled retry comes due (which may be in the past), or None if no entries
+            are waiting to be retried
+        :rtype: float
+        """
+        with self.lock:
+            return self.conn.execute('SELECT MIN(next_attempt) FROM uploads '
+                                     'WHERE state = ? AND next_attempt IS NOT NULL', (PENDING,)).fetchone()[0]
+
+    def retry_stats(self):
+        """
+        :return: the number of entries waiting to be retried, by the class of error that they last failed with (see
+            RETRY_POLICIES), and the number of entries that ran out of attempts, by the same
+        :rtype: dict[str, dict[str, int]]
+        """
+        with self.lock:
+            rows = self.conn.execute('SELECT state, error_class, COUNT(*) FROM uploads WHERE error_class IS NOT NULL '
+                                     'AND state IN (?, ?) GROUP BY state, error_class', (PENDING, FAILED)).fetchall()
+        stats = {'retrying': {}, 'failed': {}}
+        for state, error_class, count in rows:
+            stats['retrying' if state == PENDING else 'failed'][error_class] = count
+        return stats
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class HashIndex:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS file_hashes (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            blocks BLOB NOT NULL,
+            hash TEXT NOT NULL,
+            remote_size INTEGER,
+            remote_hash TEXT
+        )"""
+    DIGEST_SIZE = 32
+
+    def __init__(self, db_path=definitions.UPLOAD_JOURNAL_FILE):
+        """
+        on-device index of the content hash (see file_utils.file_hash) of each file we upload, along with the size and
+        mtime it was computed at, so that a file is only rehashed after it changes. The per-block digests are kept as
+        well, so that an append-only file can be rehashed from its old end onwards rather than from the start. The
+        index also records how much of each file is already in the cloud, which lets the uploader send just the new
+        tail of an append-only file. Lives alongside the upload journal, in the same database
+        :param db_path: path to the sqlite database. Created if it does not exist
+        :type db_path: str
+        """
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(self.SCHEMA)
+
+    def _row(self, key):
+        return self.conn.execute('SELECT size, mtime, blocks, hash, remote_size, remote_hash FROM file_hashes '
+                                 'WHERE path = ?', (key,)).fetchone()
+
+    def get(self, path, append_only=False, key=None):
+        """
+        get the content hash of a file, rehashing it only if its size or mtime has changed since it was last hashed
+        :param path: path to the file
+        :type path: str
+        :param append_only: if True, the file is assumed to only ever have been appended to since it was last hashed,
+            so blocks that ended before the old end of the file are not hashed again. If the file has shrunk, it is
+            rehashed in full
+        :type append_only: bool
+        :param key: path the file is indexed under, if not path itself (e.g., when hashing a snapshot of a log file that
+            is still being written)
+        :type key: str
+        :return: the index entry for the file
+        :rtype: HashEntry
+        """
+        key = os.path.abspath(key if key else path)
+        stat = os.stat(path)
+        with self.lock:
+            row = self._row(key)
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return HashEntry(key, row[0], row[1], row[3], row[4], row[5])
+        blocks, start_block = b'', 0
+        if row and append_only and stat.st_size >= row[0]:
+            # keep the digests of the blocks that were already complete, and rehash from the block holding the old end
+            start_block = row[0] // file_utils.CONTENT_HASH_BLOCK_SIZE
+            blocks = row[2][:start_block * self.DIGEST_SIZE]
+        digests = [blocks[i:i + self.DIGEST_SIZE] for i in range(0, len(blocks), self.DIGEST_SIZE)]
+        digests += file_utils.block_hashes(path, start_block, n_bytes=stat.st_size)
+        content_hash = file_utils.combine_block_hashes(digests)
+        remote_size, remote_hash = (row[4], row[5]) if row else (None, None)
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO file_hashes (path, size, mtime, blocks, hash, remote_size, '
+                              'remote_hash) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (key, stat.st_size, stat.st_mtime, b''.join(digests), content_hash, remote_size,
+                               remote_hash))
+        return HashEntry(key, stat.st_size, stat.st_mtime, content_hash, remote_size, remote_hash)
+
+    def prefix_hash(self, path, n_bytes, key=None):
+        """
+        get the content hash of the first n_bytes of a file, reusing the indexed digests of the blocks that lie entirely
+        within them. Call get() first, so that the indexed digests are current
+        :return: hex digest
+        :rtype: str
+        """
+        with self.lock:
+            row = self._row(os.path.abspath(key if key else path))
+        n_full = min(n_bytes // file_utils.CONTENT_HASH_BLOCK_SIZE, len(row[2]) // self.DIGEST_SIZE) if row else 0
+        digests = [row[2][i * self.DIGEST_SIZE:(i + 1) * self.DIGEST_SIZE] for i in range(n_full)]
+        digests += file_utils.block_hashes(path, n_full, n_bytes=n_bytes)
+        return file_utils.combine_block_hashes(digests)
+
+    def record_upload(self, path, size, content_hash):
+        """
+        record that the first size bytes of a file, with the given content hash, are now in the cloud
+        :param path: path the file is indexed under
+        :type path: str
+        """
+        with self.lock:
+            self.conn.execute('UPDATE file_hashes SET remote_size = ?, remote_hash = ? WHERE path = ?',
+                              (size, content_hash, os.path.abspath(path)))
+
+    def forget(self, path):
+        with self.lock:
+            self.conn.execute('DELETE FROM file_hashes WHERE path = ?', (os.path.abspath(path),))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class ChunkCheckpoint:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS upload_chunks (
+            path TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            start INTEGER NOT NULL,
+            chunk_hash TEXT NOT NULL,
+            PRIMARY KEY (path, start)
+        )"""
+
+    def __init__(self, db_path=definitions.UPLOAD_JOURNAL_FILE):
+        """
+        on-device record of which chunks of each chunked upload (see storage.StorageBackend.put_resumable) have been
+        confirmed in the cloud, so that an interrupted upload resumes from where it left off, even after a restart.
+        Lives alongside the upload journal, in the same database
+        :param db_path: path to the sqlite database. Created if it does not exist
+        :type db_path: str
+        """
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(self.SCHEMA)
+
+    def confirmed(self, path, content_hash, chunk_size):
+        """
+        :param path: path to the local file
+        :type path: str
+        :param content_hash: current content hash of the file (see file_utils.file_hash). Chunks confirmed for a
+            different version of the file, or with a different chunk size, are forgotten
+        :type content_hash: str
+        :param chunk_size: chunk size of the upload, in bytes
+        :type chunk_size: int
+        :return: content hash of each confirmed chunk, keyed by the chunk's starting offset
+        :rtype: dict[int, str]
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            self.conn.execute('DELETE FROM upload_chunks WHERE path = ? AND (hash != ? OR chunk_size != ?)',
+                              (path, content_hash, chunk_size))
+            rows = self.conn.execute('SELECT start, chunk_hash FROM upload_chunks WHERE path = ?', (path,)).fetchall()
+        return dict(rows)
+
+    def confirm(self, path, content_hash, chunk_size, start, chunk_hash):
+        """record that the chunk of a file starting at offset start is in the cloud, intact"""
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO upload_chunks (path, hash, chunk_size, start, chunk_hash) '
+                              'VALUES (?, ?, ?, ?, ?)',
+                              (os.path.abspath(path), content_hash, chunk_size, start, chunk_hash))
+
+    def clear(self, path):
+        with self.lock:
+            self.conn.execute('DELETE FROM upload_chunks WHERE path = ?', (os.path.abspath(path),))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -204,6 +204,64 @@ class AdvancedConfigDict(MetaDataDictBase):
                           value='0.5',
                           pattern=my_regexes.any_float_less_than_1,
                           help_str='detector score threshold'),
+            'INFERENCE_BACKEND':
+                MetaValue(key='INFERENCE_BACKEND',
+                          value='edgetpu',
+                          options=['edgetpu', 'cpu', 'mock'],
+                          help_str='hardware used to run the detection models. "edgetpu" requires a Coral '
+                                   'accelerator, "cpu" runs the uncompiled models with tflite-runtime, and "mock" '
+                                   'returns fixed detections after MOCK_LATENCY_MS (for testing and benchmarking)'),
+            'CPU_THREADS':
+                MetaValue(key='CPU_THREADS',
+                          value='0',
+                          pattern=my_regexes.any_int,
+                          help_str='number of threads used by the cpu inference backend. Set to 0 to use all cores'),
+            'MOCK_LATENCY_MS':
+                MetaValue(key='MOCK_LATENCY_MS',
+                          value='10',
+                          pattern=my_regexes.any_float,
+                          help_str='simulated inference time, in milliseconds, for the mock inference backend'),
+            'MAX_BATCH_SIZE':
+                MetaValue(key='MAX_BATCH_SIZE',
+                          value='4',
+                          pattern=my_regexes.any_int,
+                          help_str='maximum number of queued frames the detector will run through the fish model in '
+                                   'a single batch. Batches only fill up when frames are waiting in the queue, so '
+                                   'this does not add latency when the detector is keeping up'),
+            'MOTION_THRESH':
+                MetaValue(key='MOTION_THRESH',
+                          value='2.0',
+                          pattern=my_regexes.any_float,
+                          help_str='mean change in brightness (0-255 gray levels) within the pipe region below which a '
+                                   'frame is considered static, and the previous detections are reused instead of '
+                                   'running the fish model. Set to 0 to run the fish model on every frame'),
+            'MOTION_MAX_SKIP':
+                MetaValue(key='MOTION_MAX_SKIP',
+                          value='20',
+                          pattern=my_regexes.any_int,
+                          help_str='max number of consecutive static frames that can reuse previous detections before '
+                                   'the fish model is run again regardless'),
+            'PIPE_MOTION_THRESH':
+                MetaValue(key='PIPE_MOTION_THRESH',
+                          value='40.0',
+                          pattern=my_regexes.any_float,
+                          help_str='mean absolute difference (in gray levels, see MOTION_THRESH) between a frame and '
+                                   'the recent background above which the camera is assumed to have moved, and the '
+                                   'pipe is relocalized. Set to 0 to only relocalize the pipe on a fixed schedule'),
+            'TRACKER_DETECT_EVERY':
+                MetaValue(key='TRACKER_DETECT_EVERY',
+                          value='0',
+                          pattern=my_regexes.any_int,
+                          help_str='if greater than 0, fish are tracked between frames using optical flow, and the '
+                                   'fish model is only run on every Nth frame (or sooner if a track is lost). This '
+                                   'allows a shorter INTERVAL_SECS at the same inference cost. Set to 0 to disable '
+                                   'tracking'),
+            'TRACKER_MIN_HITS':
+                MetaValue(key='TRACKER_MIN_HITS',
+                          value='2',
+                          pattern=my_regexes.any_int,
+                          help_str='number of times a fish track must be matched to a detection before it counts '
+                                   'towards the hit counter. Only used if TRACKER_DETECT_EVERY is greater than 0'),
             'INTERVAL_SECS':
                 MetaValue(key='INTERVAL_SECS',
                           value='0.25',
@@ -219,6 +277,27 @@ class AdvancedConfigDict(MetaDataDictBase):
                           value='10',
                           pattern=my_regexes.any_int,
                           help_str='length of video, in seconds, that will be saved when a hit occurs'),
+            'IMG_BUFFER_MAX_MB':
+                MetaValue(key='IMG_BUFFER_MAX_MB',
+                          value='256',
+                          pattern=my_regexes.any_int,
+                          help_str='memory budget, in MB, for the frames held in reserve for event clips. If the '
+                                   'frames for IMG_BUFFER_SECS do not fit, clips will be shorter than IMG_BUFFER_SECS'),
+            'IMG_BUFFER_MODE':
+                MetaValue(key='IMG_BUFFER_MODE',
+                          value='raw',
+                          options=['raw', 'jpeg'],
+                          help_str='how frames are held in reserve for event clips. "raw" keeps uncompressed copies in '
+                                   'a preallocated array, which is fastest. "jpeg" keeps in-memory jpeg-encoded '
+                                   'frames, which fits roughly 10x as many frames in the same IMG_BUFFER_MAX_MB'),
+            'EVENT_CLIP_SOURCE':
+                MetaValue(key='EVENT_CLIP_SOURCE',
+                          value='frames',
+                          options=['frames', 'recording'],
+                          help_str='source of the video clips attached to event notifications. "frames" builds an '
+                                   'annotated clip from the frames the detector sampled. "recording" cuts a '
+                                   'full-framerate clip out of the camera\'s continuous recording (without '
+                                   're-encoding), falling back to "frames" when the recording is unavailable'),
             'START_HOUR':
                 MetaValue(key='START_HOUR',
                           value='7',
@@ -234,6 +313,12 @@ class AdvancedConfigDict(MetaDataDictBase):
                           value='3',
                           pattern=my_regexes.any_int_less_than_24,
                           help_str='maximum video length in hours. Set to 0 to disable video splitting'),
+            'MAX_SEGMENT_MB':
+                MetaValue(key='MAX_SEGMENT_MB',
+                          value='0',
+                          pattern=my_regexes.any_int,
+                          help_str='maximum video size in MB. The recording is split when either this or MAX_VID_LEN '
+                                   'is reached. Set to 0 to split on time alone'),
             'MIN_NOTIFICATION_INTERVAL':
                 MetaValue(key='MIN_NOTIFICATION_INTERVAL',
                           value='120',
@@ -254,6 +339,28 @@ class AdvancedConfigDict(MetaDataDictBase):
                           value='30',
                           pattern=my_regexes.any_int,
                           help_str='picamera framerate'),
+            'FRAME_SAMPLER':
+                MetaValue(key='FRAME_SAMPLER',
+                          value='auto',
+                          options=['auto', 'grab', 'seek', 'ffmpeg'],
+                          help_str='strategy used to sample frames when processing an existing video (source). '
+                                   '"grab" decodes every frame but only converts the sampled ones, "seek" jumps to '
+                                   'each sampled frame, "ffmpeg" filters frames in a separate ffmpeg process, and '
+                                   '"auto" picks whichever should be cheapest for the current INTERVAL_SECS'),
+            'REPLAY_MODE':
+                MetaValue(key='REPLAY_MODE',
+                          value='fast',
+                          options=['fast', 'realtime'],
+                          help_str='how an existing video (source) is replayed. "fast" processes frames as quickly as '
+                                   'the detector allows and timestamps them by their position in the video. '
+                                   '"realtime" paces frames by INTERVAL_SECS and timestamps them by the clock'),
+            'FRAME_RING_SLOTS':
+                MetaValue(key='FRAME_RING_SLOTS',
+                          value='8',
+                          pattern=my_regexes.any_int,
+                          help_str='number of full-resolution frames that can be passed from the collector to the '
+                                   'detector through shared memory at once. Set to 0 to send frames through the image '
+                                   'queue instead'),
             'BOT_EMAIL':
                 MetaValue(key='BOT_EMAIL',
                           value='themcgrathlab@gmail.com',
@@ -264,6 +371,108 @@ class AdvancedConfigDict(MetaDataDictBase):
                           value='2',
                           pattern=my_regexes.any_int,
                           help_str='max number of simultaneous upload processes to spawn'),
+            'MAX_VIDEO_UPLOAD_WORKERS':
+                MetaValue(key='MAX_VIDEO_UPLOAD_WORKERS',
+                          value='1',
+                          pattern=my_regexes.any_int,
+                          help_str='max number of upload processes that can be uploading full-length videos at once. '
+                                   'The remaining processes keep working through smaller files (event clips, hit '
+                                   'records, logs, etc.). Set to 0 for no limit'),
+            'TRICKLE_UPLOADS':
+                MetaValue(key='TRICKLE_UPLOADS',
+                          value='False',
+                          pattern=my_regexes.any_bool,
+                          help_str='if True, finished video segments and event clips are uploaded during active mode '
+                                   'by a single throttled upload process, rather than waiting for passive mode'),
+            'TRICKLE_BWLIMIT_KBPS':
+                MetaValue(key='TRICKLE_BWLIMIT_KBPS',
+                          value='512',
+                          pattern=my_regexes.any_int,
+                          help_str='max upload bandwidth, in KB/s, used by trickle uploads. Set to 0 for no limit'),
+            'TRICKLE_NICENESS':
+                MetaValue(key='TRICKLE_NICENESS',
+                          value='15',
+                          pattern=my_regexes.any_int,
+                          help_str='cpu niceness (0-19) of the trickle upload process and the rclone daemon. Higher '
+                                   'values leave more cpu for collection and detection'),
+            'TRICKLE_MAX_DETECT_LAG_SECS':
+                MetaValue(key='TRICKLE_MAX_DETECT_LAG_SECS',
+                          value='5',
+                          pattern=my_regexes.any_float,
+                          help_str='trickle uploads pause while the detector is running more than this many seconds '
+                                   'behind the camera'),
+            'TRICKLE_MAX_QUEUE_DEPTH':
+                MetaValue(key='TRICKLE_MAX_QUEUE_DEPTH',
+                          value='10',
+                          pattern=my_regexes.any_int,
+                          help_str='trickle uploads pause while more than this many frames are waiting for the '
+                                   'detector'),
+            'TRICKLE_MAX_CPU_TEMP':
+                MetaValue(key='TRICKLE_MAX_CPU_TEMP',
+                          value='70',
+                          pattern=my_regexes.any_float,
+                          help_str='trickle uploads pause while the cpu is hotter than this (in degrees C)'),
+            'ACTIVE_ARCHIVING':
+                MetaValue(key='ACTIVE_ARCHIVING',
+                          value='True',
+                          pattern=my_regexes.any_bool,
+                          help_str='if True, annotation images and rotated logs are added to compressed archives, '
+                                   'which stream to storage as they are built, during active mode. Otherwise (and for '
+                                   'anything left over), they are archived at the start of passive mode'),
+            'ARCHIVE_COMPRESSION':
+                MetaValue(key='ARCHIVE_COMPRESSION',
+                          value='auto',
+                          options=['auto', 'zstd', 'gzip'],
+                          help_str='compression used for archives of annotation images and logs. "zstd" requires the '
+                                   'zstandard package, and "auto" uses it if it is installed, or gzip otherwise'),
+            'ARCHIVE_MAX_MB':
+                MetaValue(key='ARCHIVE_MAX_MB',
+                          value='256',
+                          pattern=my_regexes.any_int,
+                          help_str='max size, in MB, of each archive of annotation images or logs. Files are only '
+                                   'deleted once the archive holding them is in the cloud, so smaller archives free '
+                                   'space sooner'),
+            'MAX_CONVERSION_WORKERS':
+                MetaValue(key='MAX_CONVERSION_WORKERS',
+                          value='0',
+                          pattern=my_regexes.any_int,
+                          help_str='max number of h264 files to convert to mp4 simultaneously before upload. Set to 0 '
+                                   'to use one per cpu core'),
+            'STORAGE_BACKEND':
+                MetaValue(key='STORAGE_BACKEND',
+                          value='rclone',
+                          options=['rclone', 'local', 's3'],
+                          help_str='where uploads are stored. "rclone" uploads to Dropbox (or whichever remote '
+                                   'CLOUD_HOME_DIR points to) through rclone, "local" copies files into '
+                                   'STORAGE_LOCAL_DIR (e.g., a mounted NAS share), and "s3" uploads to S3_BUCKET on an '
+                                   'S3-compatible object store (requires boto3)'),
+            'STORAGE_LOCAL_DIR':
+                MetaValue(key='STORAGE_LOCAL_DIR',
+                          value='None',
+                          simplify=False,
+                          help_str='directory that stands in for the cloud when STORAGE_BACKEND is "local"'),
+            'S3_BUCKET':
+                MetaValue(key='S3_BUCKET',
+                          value='None',
+                          simplify=False,
+                          help_str='bucket that uploads are stored in when STORAGE_BACKEND is "s3". Credentials are '
+                                   'read from the usual boto3 locations (environment variables, ~/.aws, etc.)'),
+            'S3_ENDPOINT_URL':
+                MetaValue(key='S3_ENDPOINT_URL',
+                          value='None',
+                          simplify=False,
+                          help_str='url of the S3-compatible object store used when STORAGE_BACKEND is "s3". Leave as '
+                                   'None for AWS'),
+            'CHUNKED_UPLOAD_MB':
+                MetaValue(key='CHUNKED_UPLOAD_MB',
+                          value='64',
+                          pattern=my_regexes.any_int,
+                          help_str='files larger than this many MB are uploaded in chunks of this size, so that an '
+                                   'interrupted upload resumes from the last confirmed chunk rather than starting '
+                                   'over. Rounded up to a multiple of 4 MB (and must be at least 8 for the s3 storage '
+                                   'backend). Only applies to the local and s3 storage backends, which join the chunks '
+                                   'back together in storage. The rclone backend always uploads files in one piece. '
+                                   'Set to 0 to upload every file in one piece'),
             'MAX_TRIES':
                 MetaValue(key='MAX_TRIES',
                           value='3',
@@ -4,8 +4,11 @@ import multiprocessing as mp
 import multiprocessing.queues as mpq
 import signal
 import time
+from collections import namedtuple
+from multiprocessing import shared_memory
 from queue import Empty, Full
 from internet_of_fish.modules.utils import gen_utils
+import numpy as np
 import re
 
 """adapted from https://github.com/PamelaM/mptools"""
@@ -94,6 +97,135 @@ class MPQueue(mpq.Queue):
         return num_left
 
 
+# -- Shared memory frame transport
+
+FrameRef = namedtuple('FrameRef', ['slot', 'shape'])
+
+
+class SharedFrameRing:
+
+    def __init__(self, slot_shape, n_slots, dtype=np.uint8):
+        """
+        fixed pool of frame-sized slots in shared memory, used to pass images between processes without pickling them.
+        A producer acquires a free slot, writes a frame into it in place, and sends a small FrameRef through an
+        ordinary queue. The consumer resolves the FrameRef to a numpy view of the same memory and releases the slot
+        once it no longer needs the pixels. The process that creates the ring owns it, and is responsible for calling
+        unlink() once all other processes are done with it.
+        :param slot_shape: shape of the largest frame that can be stored in a single slot, e.g. (height, width, 3)
+        :type slot_shape: tuple[int]
+        :param n_slots: number of slots in the ring, i.e., the max number of frames that can be in flight at once
+        :type n_slots: int
+        :param dtype: numpy dtype of the stored frames. Defaults to np.uint8
+        :type dtype: type
+        """
+        self.slot_shape = tuple(slot_shape)
+        self.n_slots = n_slots
+        self.dtype = np.dtype(dtype)
+        self.slot_nbytes = int(np.prod(self.slot_shape)) * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slot_nbytes * self.n_slots)
+        self.free_q = MPQueue(maxsize=self.n_slots)
+        for slot in range(self.n_slots):
+            self.free_q.put(slot)
+        self._closed = False
+
+    def fits(self, shape):
+        """
+        check whether a frame of the given shape can be stored in a single slot
+        :param shape: shape of the frame
+        :type shape: tuple[int]
+        :return: True if the frame fits, False otherwise
+        :rtype: bool
+        """
+        return int(np.prod(shape)) * self.dtype.itemsize <= self.slot_nbytes
+
+    def acquire(self, timeout=0.02):
+        """
+        claim a free slot for writing. Returns None if no slot became free within the timeout, which usually means the
+        consumer has fallen behind.
+        :param timeout: max time to wait for a free slot, in seconds
+        :type timeout: float
+        :return: index of the claimed slot, or None
+        :rtype: int
+        """
+        if self._closed:
+            return None
+        return self.free_q.safe_get(timeout)
+
+    def release(self, slot):
+        """
+        return a slot to the pool once the frame it holds is no longer needed
+        :param slot: slot index (or FrameRef) to release
+        :type slot: Union[int, FrameRef]
+        """
+        if isinstance(slot, FrameRef):
+            slot = slot.slot
+        self.free_q.safe_put(slot)
+
+    def view(self, slot, shape=None):
+        """
+        get a numpy array backed directly by the shared memory of a slot. No data is copied, so the array contents
+        are only valid until the slot is released.
+        :param slot: slot index
+        :type slot: int
+        :param shape: shape of the frame stored in the slot. Defaults to the full slot shape
+        :type shape: tuple[int]
+        :return: array view of the slot
+        :rtype: np.ndarray
+        """
+        shape = self.slot_shape if shape is None else tuple(shape)
+        return np.ndarray(shape, dtype=self.dtype, buffer=self.shm.buf, offset=slot * self.slot_nbytes)
+
+    def put(self, img, timeout=0.02):
+        """
+        copy an image into a free slot and return a FrameRef pointing to it. Returns None if no slot was free or if
+        the image is too large for a slot.
+        :param img: image to store
+        :type img: np.ndarray
+        :param timeout: max time to wait for a free slot, in seconds
+        :type timeout: float
+        :return: reference to the slot holding the image, or None
+        :rtype: FrameRef
+        """
+        if not self.fits(img.shape):
+            return None
+        slot = self.acquire(timeout)
+        if slot is None:
+            return None
+        np.copyto(self.view(slot, img.shape), img)
+        return FrameRef(slot, img.shape)
+
+    def resolve(self, frame_ref):
+        """
+        convert a FrameRef into a numpy view of the frame it refers to
+        :param frame_ref: reference returned by put(), or constructed by a producer after writing into an acquired slot
+        :type frame_ref: FrameRef
+        :return: array view of the frame
+        :rtype: np.ndarray
+        """
+        return self.view(frame_ref.slot, frame_ref.shape)
+
+    def close(self):
+        """detach this process from the shared memory block without destroying it"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self.shm.close()
+        except BufferError:
+            # a numpy view into the block is still alive in this process. The mapping will be released when it is
+            # garbage collected instead
+            pass
+
+    def unlink(self):
+        """detach from and destroy the shared memory block. Should only be called by the owning process"""
+        self.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+        self.free_q.safe_close()
+
+
 # -- useful function
 def sleep_secs(max_sleep, end_time=999999999999999.9):
     """
@@ -346,6 +478,7 @@ class MainContext(metaclass=gen_utils.AutologMetaclass):
         self.STOP_WAIT_SECS = self.defs.DEFAULT_SHUTDOWN_WAIT_SECS
         self.procs = []
         self.queues = []
+        self.rings = []
         self.shutdown_event = mp.Event()
         self.event_queue = self.MPQueue()
         self._init_specials()
@@ -363,6 +496,7 @@ class MainContext(metaclass=gen_utils.AutologMetaclass):
             self.logger.log(logging.ERROR, f"Exception: {exc_val}", exc_info=(exc_type, exc_val, exc_tb))
         self._stopped_procs_result = self.stop_all_procs()
         self._stopped_queues_result = self.stop_all_queues()
+        self.stop_all_rings()
         self.logger.info('.'*40)
 
         # -- Don't eat exceptions that reach here.
@@ -378,6 +512,11 @@ class MainContext(metaclass=gen_utils.AutologMetaclass):
         self.queues.append(q)
         return q
 
+    def FrameRing(self, *args, **kwargs):
+        ring = SharedFrameRing(*args, **kwargs)
+        self.rings.append(ring)
+        return ring
+
     def stop_procs(self, procs, stop_wait_secs=None):
         stop_wait_secs = stop_wait_secs if stop_wait_secs else self.STOP_WAIT_SECS
         end_time = time.time() + stop_wait_secs
@@ -439,6 +578,12 @@ class MainContext(metaclass=gen_utils.AutologMetaclass):
             q.join_thread()
         return num_items_left
 
+    def stop_all_rings(self):
+        # -- Free the shared memory held by any frame rings. Should only be called after the procs using them stop
+        while self.rings:
+            ring = self.rings.pop(0)
+            ring.unlink()
+
 
 class SecondaryContext(MainContext, metaclass=gen_utils.AutologMetaclass):
 
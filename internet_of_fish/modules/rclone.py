@@ -0,0 +1,462 @@
+"""interface to a long-lived rclone daemon (rclone rcd). Rather than starting a new rclone process (which re-reads the
+rclone config and re-authenticates with the remote) for every file, uploads, stats, and listings are submitted to the
+daemon over rclone's HTTP remote control API. See https://rclone.org/rc/ for the API itself"""
+
+import base64
+import http.client
+import json
+import os
+import posixpath
+import secrets
+import shutil
+import socket
+import subprocess as sp
+import threading
+import time
+import urllib.parse
+
+from internet_of_fish.modules.storage import StorageError
+
+
+class RcloneError(StorageError):
+    """raised when the rclone daemon cannot be reached, or reports that a call or job failed"""
+
+
+def split_remote_path(path):
+    """
+    split a local path or rclone remote path (e.g., "remote:dir/file.txt") into the (fs, remote) pair expected by the rc
+    api, where fs is the parent directory and remote is the file name
+    :param path: local or remote path
+    :type path: str
+    :return: fs and remote strings
+    :rtype: tuple[str, str]
+    """
+    if ':' in path and not os.path.isabs(path):
+        return posixpath.dirname(path) or path.split(':', 1)[0] + ':', posixpath.basename(path)
+    return os.path.dirname(path), os.path.basename(path)
+
+
+class RcloneClient:
+    # methods without side effects (or that set an absolute value), which can safely be repeated if the connection
+    # drops after the request may already have reached the daemon
+    IDEMPOTENT_METHODS = {'rc/noop', 'operations/list', 'operations/stat', 'job/status', 'core/stats', 'core/bwlimit'}
+
+    def __init__(self, addr, user=None, password=None, timeout=60):
+        """
+        thread-safe client for the rclone remote control api. Each thread keeps its own persistent (keep-alive) http
+        connection to the daemon, which is re-established automatically if it drops. Clients can be passed to other
+        processes, which open connections of their own
+        :param addr: host:port the daemon is listening on
+        :type addr: str
+        :param user: rc username, if the daemon requires authentication
+        :type user: str
+        :param password: rc password, if the daemon requires authentication
+        :type password: str
+        :param timeout: socket timeout for individual api calls, in seconds. Long transfers run as jobs, and are not
+            subject to this timeout
+        :type timeout: float
+        """
+        self.addr = addr
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            host, port = self.addr.rsplit(':', 1)
+            conn = http.client.HTTPConnection(host, int(port), timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def _headers(self, content_type='application/json'):
+        headers = {'Content-Type': content_type}
+        if self.user:
+            token = base64.b64encode(f'{self.user}:{self.password}'.encode()).decode()
+            headers['Authorization'] = f'Basic {token}'
+        return headers
+
+    def call(self, method, **params):
+        """
+        call an rc api method
+        :param method: method name, e.g., "operations/copyfile"
+        :type method: str
+        :param params: method parameters
+        :return: the method's output
+        :rtype: dict
+        """
+        body = json.dumps(params)
+        for retry in (True, False):
+            conn = self._connection()
+            sent = False
+            try:
+                conn.request('POST', f'/{method}', body=body, headers=self._headers())
+                sent = True
+                response = conn.getresponse()
+                payload = response.read()
+                break
+            except (http.client.HTTPException, OSError) as e:
+                # the daemon closes idle keep-alive connections, so reconnect and retry once before giving up. Once the
+                # request has been sent, the daemon may already be acting on it (e.g., an async copy may have started a
+                # job), so only idempotent methods are repeated
+                conn.close()
+                self._local.conn = None
+                if not retry or (sent and method not in self.IDEMPOTENT_METHODS):
+                    raise RcloneError(f'could not reach the rclone daemon at {self.addr}: {e}')
+        try:
+            output = json.loads(payload) if payload else {}
+        except json.JSONDecodeError:
+            output = {'error': payload.decode(errors='replace')}
+        if response.status != 200:
+            raise RcloneError(output.get('error', f'{method} failed with status {response.status}'))
+        return output
+
+    def noop(self):
+        """check that the daemon is responding"""
+        return self.call('rc/noop')
+
+    def submit_copy(self, local_path, cloud_path):
+        """
+        start copying a local file to a remote path in the background. Several copies can be in flight at once
+        :param local_path: path to the local file
+        :type local_path: str
+        :param cloud_path: destination path, including the remote name (see file_utils.local_to_cloud)
+        :type cloud_path: str
+        :return: id of the copy job, for use with wait() and progress()
+        :rtype: int
+        """
+        src_fs, src_remote = split_remote_path(os.path.abspath(local_path))
+        dst_fs, dst_remote = split_remote_path(cloud_path)
+        return self.call('operations/copyfile', srcFs=src_fs, srcRemote=src_remote, dstFs=dst_fs,
+                         dstRemote=dst_remote, _async=True)['jobid']
+
+    def job_status(self, job_id):
+        return self.call('job/status', jobid=job_id)
+
+    def progress(self, job_id):
+        """
+        :return: transfer statistics for a job, including bytes, totalBytes, and speed (in bytes per second)
+        :rtype: dict
+        """
+        return self.call('core/stats', group=f'job/{job_id}')
+
+    def stop_job(self, job_id):
+        self.call('job/stop', jobid=job_id)
+
+    def set_bwlimit(self, rate):
+        """
+        cap the total bandwidth used by the daemon's transfers, including those already in flight
+        :param rate: limit in rclone's notation (e.g., "512k" or "2M" for bytes per second), or "off" to remove the cap
+        :type rate: str
+        :return: the new limit, in bytes per second (-1 if there is no limit)
+        :rtype: int
+        """
+        return self.call('core/bwlimit', rate=rate)['bytesPerSecond']
+
+    def wait(self, job_id, progress_fn=None, poll_secs=1, shutdown_event=None):
+        """
+        block until a job finishes. Polling starts out fast, so that small transfers return promptly, and slows down
+        to once every poll_secs for long ones
+        :param job_id: id of the job
+        :type job_id: int
+        :param progress_fn: if given, called with the job's transfer statistics (see progress()) on every poll
+        :type progress_fn: Callable[[dict], None]
+        :param poll_secs: max time between polls
+        :type poll_secs: float
+        :param shutdown_event: if given, the job is stopped (and RcloneError raised) as soon as this event is set
+        :type shutdown_event: multiprocessing.Event
+        :return: the job's final status
+        :rtype: dict
+        """
+        delay = 0.01
+        while True:
+            status = self.job_status(job_id)
+            if status['finished']:
+                if not status['success']:
+                    raise RcloneError(status.get('error') or f'job {job_id} failed')
+                return status
+            if shutdown_event is not None and shutdown_event.is_set():
+                self.stop_job(job_id)
+                raise RcloneError(f'job {job_id} stopped by shutdown')
+            if progress_fn:
+                progress_fn(self.progress(job_id))
+            time.sleep(delay)
+            delay = min(poll_secs, delay * 2)
+
+    def copyfile(self, local_path, cloud_path, progress_fn=None, poll_secs=1, shutdown_event=None):
+        """copy a local file to a remote path, blocking until the copy finishes. See submit_copy() and wait()"""
+        return self.wait(self.submit_copy(local_path, cloud_path), progress_fn, poll_secs, shutdown_event)
+
+    def fetchfile(self, cloud_path, local_path):
+        """copy a remote file to a local path, blocking until the copy finishes"""
+        src_fs, src_remote = split_remote_path(cloud_path)
+        dst_fs, dst_remote = split_remote_path(os.path.abspath(local_path))
+        self.call('operations/copyfile', srcFs=src_fs, srcRemote=src_remote, dstFs=dst_fs, dstRemote=dst_remote)
+
+    def uploadfile(self, fileobj, cloud_path, shutdown_event=None, chunk_size=1 << 20):
+        """
+        stream the contents of a readable binary file object to a remote path, without it ever existing as a local
+        file. The upload is sent to the daemon on a connection of its own, and blocks until the stream is exhausted
+        :param fileobj: object to read from (e.g., the read end of a pipe). Read until it returns b''
+        :type fileobj: io.BufferedIOBase
+        :param cloud_path: destination path, including the remote name (see file_utils.local_to_cloud)
+        :type cloud_path: str
+        :param shutdown_event: if given, the upload is abandoned (and RcloneError raised) once this event is set
+        :type shutdown_event: multiprocessing.Event
+        :param chunk_size: max number of bytes read from fileobj at a time
+        :type chunk_size: int
+        """
+        # operations/uploadfile takes the destination directory as its remote, and the file name from the form data
+        fs, name = split_remote_path(cloud_path)
+        remote, _, path = fs.partition(':')
+        query = urllib.parse.urlencode({'fs': remote + ':', 'remote': path})
+        boundary = secrets.token_hex(16)
+
+        def body():
+            yield (f'--{boundary}\r\nContent-Disposition: form-data; name="file0"; filename="{name}"\r\n'
+                   f'Content-Type: application/octet-stream\r\n\r\n').encode()
+            for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+                if shutdown_event is not None and shutdown_event.is_set():
+                    raise RcloneError(f'upload of {cloud_path} stopped by shutdown')
+                yield chunk
+            yield f'\r\n--{boundary}--\r\n'.encode()
+
+        host, port = self.addr.rsplit(':', 1)
+        conn = http.client.HTTPConnection(host, int(port))
+        try:
+            conn.request('POST', f'/operations/uploadfile?{query}', body=body(), encode_chunked=True,
+                         headers=self._headers(f'multipart/form-data; boundary={boundary}'))
+            response = conn.getresponse()
+            payload = response.read()
+        except (http.client.HTTPException, OSError) as e:
+            raise RcloneError(f'upload of {cloud_path} failed: {e}')
+        finally:
+            conn.close()
+        if response.status != 200:
+            raise RcloneError(f'upload of {cloud_path} failed: {payload.decode(errors="replace").strip()}')
+
+    def movefile(self, src_cloud_path, dst_cloud_path):
+        """move a remote file to another remote path. Moves within a remote happen server-side where it supports them"""
+        src_fs, src_remote = split_remote_path(src_cloud_path)
+        dst_fs, dst_remote = split_remote_path(dst_cloud_path)
+        self.call('operations/movefile', srcFs=src_fs, srcRemote=src_remote, dstFs=dst_fs, dstRemote=dst_remote)
+
+    def deletefile(self, cloud_path):
+        fs, remote = split_remote_path(cloud_path)
+        self.call('operations/deletefile', fs=fs, remote=remote)
+
+    def stat(self, cloud_path, hash_type=None):
+        """
+        :param cloud_path: path to the remote file
+        :type cloud_path: str
+        :param hash_type: if given (e.g., "dropbox"), include the file's hash of this type under Hashes, if the remote
+            supports it
+        :type hash_type: str
+        :return: details of a remote file (Path, Name, Size, ModTime, etc.), or None if it does not exist
+        :rtype: dict
+        """
+        fs, remote = split_remote_path(cloud_path)
+        opt = {'showHash': True, 'hashTypes': [hash_type]} if hash_type else {}
+        try:
+            return self.call('operations/stat', fs=fs, remote=remote, opt=opt)['item']
+        except RcloneError as e:
+            if 'not found' in str(e):
+                return None
+            raise
+
+    def exists(self, cloud_path):
+        return self.stat(cloud_path) is not None
+
+    def list(self, cloud_dir, recurse=False, files_only=True):
+        """
+        list a remote directory in a single call
+        :param cloud_dir: remote directory
+        :type cloud_dir: str
+        :param recurse: if True, list subdirectories as well
+        :type recurse: bool
+        :param files_only: if True, omit directory entries
+        :type files_only: bool
+        :return: details of each entry (see stat()), with paths relative to cloud_dir
+        :rtype: list[dict]
+        """
+        try:
+            return self.call('operations/list', fs=cloud_dir, remote='',
+                             opt={'recurse': recurse, 'filesOnly': files_only})['list']
+        except RcloneError as e:
+            if 'not found' in str(e):
+                return []
+            raise
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class RemoteListingCache:
+
+    def __init__(self, lister, max_age_secs=600):
+        """
+        answers existence and equality queries for remote files from in-memory listings of their parent directories.
+        Each directory is listed at most once per max_age_secs, no matter how many of its files are queried, and the
+        listing for a directory is dropped whenever we upload to it (see note_upload), so that the next query sees the
+        new file. Files are compared by size alone, which keeps the listings cheap. Where content matters, the
+        uploader compares content hashes instead, which are computed locally in the same way as Dropbox's (see
+        file_utils.file_hash and UploaderWorker.in_cloud)
+        :param lister: function that takes a remote directory and returns the details of the files directly inside it,
+            such as RcloneClient.list
+        :type lister: Callable[[str], list[dict]]
+        :param max_age_secs: how long a listing remains valid
+        :type max_age_secs: float
+        """
+        self.lister = lister
+        self.max_age_secs = max_age_secs
+        self.listings = {}
+        self.lock = threading.Lock()
+        self.n_listings = 0
+
+    def listing(self, cloud_dir):
+        """
+        :return: details of the files in a remote directory, keyed by file name
+        :rtype: dict[str, dict]
+        """
+        with self.lock:
+            cached = self.listings.get(cloud_dir)
+            if cached and time.time() - cached[0] < self.max_age_secs:
+                return cached[1]
+        items = {item['Name']: item for item in self.lister(cloud_dir)}
+        with self.lock:
+            self.listings[cloud_dir] = (time.time(), items)
+            self.n_listings += 1
+        return items
+
+    def get(self, cloud_path):
+        """
+        :return: details of a remote file (see RcloneClient.stat), or None if it does not exist
+        :rtype: dict
+        """
+        cloud_dir, name = split_remote_path(cloud_path)
+        return self.listing(cloud_dir).get(name)
+
+    def exists(self, cloud_path):
+        return self.get(cloud_path) is not None
+
+    def matches(self, cloud_path, size):
+        """
+        :return: True if the remote file exists and has the given size
+        :rtype: bool
+        """
+        item = self.get(cloud_path)
+        return item is not None and item['Size'] == size
+
+    def note_upload(self, cloud_path):
+        """record that a file has been (or is being) uploaded to cloud_path, invalidating its directory's listing"""
+        self.invalidate(split_remote_path(cloud_path)[0])
+
+    def invalidate(self, cloud_dir=None):
+        """drop the cached listing of a remote directory, or of all directories if cloud_dir is None"""
+        with self.lock:
+            if cloud_dir is None:
+                self.listings.clear()
+            else:
+                self.listings.pop(cloud_dir, None)
+
+
+class RcloneDaemon:
+
+    def __init__(self, addr=None, log_file=None, extra_args=None, startup_secs=10):
+        """
+        manages a single rclone rcd process. The daemon only listens on localhost, and requires a password generated
+        afresh each time it starts
+        :param addr: host:port to listen on. Defaults to a free port on localhost
+        :type addr: str
+        :param log_file: file that the daemon's own log is appended to. If None, the log is discarded
+        :type log_file: str
+        :param extra_args: additional command line arguments for rclone rcd (e.g., ["--transfers", "4"])
+        :type extra_args: list[str]
+        :param startup_secs: how long to wait for the daemon to start responding
+        :type startup_secs: float
+        """
+        self.addr = addr if addr else f'127.0.0.1:{self.free_port()}'
+        self.log_file = log_file
+        self.extra_args = extra_args if extra_args else []
+        self.startup_secs = startup_secs
+        self.user = 'iof'
+        self.password = secrets.token_urlsafe(16)
+        self.proc = None
+
+    @staticmethod
+    def free_port():
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            return s.getsockname()[1]
+
+    @property
+    def running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def client(self):
+        """
+        :return: a new client for this daemon
+        :rtype: RcloneClient
+        """
+        return RcloneClient(self.addr, self.user, self.password)
+
+    def start(self):
+        """start the daemon (if it is not already running) and wait until it responds"""
+        if self.running:
+            return
+        if not shutil.which('rclone'):
+            raise FileNotFoundError('rclone is required for uploads')
+        cmnd = ['rclone', 'rcd', '--rc-addr', self.addr, '--rc-user', self.user, '--rc-pass', self.password]
+        if self.log_file:
+            cmnd.extend(['--log-file', self.log_file])
+        self.proc = sp.Popen(cmnd + self.extra_args, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+        client = self.client()
+        end_time = time.time() + self.startup_secs
+        while True:
+            if self.proc.poll() is not None:
+                raise RcloneError(f'rclone daemon exited during startup with code {self.proc.returncode}'
+                                  + (f'. See {self.log_file}' if self.log_file else ''))
+            try:
+                client.noop()
+                break
+            except RcloneError:
+                if time.time() > end_time:
+                    self.stop()
+                    raise RcloneError(f'rclone daemon did not respond within {self.startup_secs} seconds')
+                time.sleep(0.1)
+        client.close()
+
+    def renice(self, niceness):
+        """lower the daemon's cpu priority to the given niceness. Priority can only be lowered, since raising it again
+        would need root, so a daemon that is already at (or below) this priority is left alone"""
+        if self.running and os.getpriority(os.PRIO_PROCESS, self.proc.pid) < niceness:
+            os.setpriority(os.PRIO_PROCESS, self.proc.pid, niceness)
+
+    def stop(self, timeout=10):
+        """ask the daemon to quit, killing it if it does not exit within timeout seconds"""
+        if not self.running:
+            self.proc = None
+            return
+        try:
+            self.client().call('core/quit')
+        except RcloneError:
+            pass
+        try:
+            self.proc.wait(timeout)
+        except sp.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
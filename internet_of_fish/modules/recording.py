@@ -0,0 +1,290 @@
+"""tools for working with the continuous h264 recording made by the CollectorWorker. The collector maintains a
+SegmentIndex alongside the recording, which maps wall-clock time ranges to the segment files they were recorded in, so
+that full-framerate clips can later be cut from the recording by stream copying (i.e., without re-encoding). Segments
+are recorded as raw .h264 files, and are remuxed into .mp4 files once they are closed."""
+
+import json
+import os
+import shutil
+import subprocess as sp
+import tempfile
+from collections import namedtuple
+
+from internet_of_fish.modules.utils import gen_utils
+
+Segment = namedtuple('Segment', ['path', 'start_ms', 'end_ms', 'start_frame', 'end_frame', 'framerate', 'marks'])
+Mark = namedtuple('Mark', ['time_ms', 'position', 'frame'])
+
+# h264 NAL unit types
+NAL_SLICE, NAL_IDR_SLICE, NAL_SEI, NAL_SPS, NAL_PPS, NAL_AUD = 1, 5, 6, 7, 8, 9
+
+
+def nal_headers(f, start_pos=0, chunk_size=1 << 20):
+    """
+    scan an annex-b h264 stream (such as the raw .h264 files written by picamera) for NAL units, without loading the
+    whole file into memory
+    :param f: file opened in binary mode
+    :param start_pos: byte offset to start scanning from
+    :type start_pos: int
+    :param chunk_size: number of bytes read at a time
+    :type chunk_size: int
+    :return: generator of (offset, nal_type, first_in_picture) tuples, where offset is the position of the NAL unit's
+        start code, and first_in_picture indicates (for slices) that the slice starts a new picture
+    :rtype: Iterator[tuple[int, int, bool]]
+    """
+    f.seek(start_pos)
+    buf, buf_pos = b'', start_pos
+    while True:
+        chunk = f.read(chunk_size)
+        buf += chunk
+        i = buf.find(b'\x00\x00\x01')
+        while i != -1 and i + 4 < len(buf):
+            # for slices, first_mb_in_slice is the first field of the slice header, and is zero (encoded as a single
+            # set bit) only for the first slice of a picture
+            yield buf_pos + i, buf[i + 3] & 0x1f, bool(buf[i + 4] & 0x80)
+            i = buf.find(b'\x00\x00\x01', i + 3)
+        if not chunk:
+            return
+        # keep the unprocessed tail, since a start code may straddle the chunk boundary
+        keep_from = i if i != -1 else max(0, len(buf) - 4)
+        buf, buf_pos = buf[keep_from:], buf_pos + keep_from
+
+
+def access_units(f, start_pos=0):
+    """
+    scan an annex-b h264 stream for access units (i.e., frames). Each access unit starts with any parameter set, SEI,
+    or delimiter NAL units that precede its first slice, so that a stream cut at an IDR access unit can be decoded on
+    its own
+    :param f: file opened in binary mode
+    :param start_pos: byte offset to start scanning from. Should be the start of a frame
+    :type start_pos: int
+    :return: generator of (offset, is_idr) tuples, one per frame
+    :rtype: Iterator[tuple[int, bool]]
+    """
+    prefix_start = None
+    for offset, nal_type, first_in_picture in nal_headers(f, start_pos):
+        if nal_type in (NAL_SEI, NAL_SPS, NAL_PPS, NAL_AUD):
+            if prefix_start is None:
+                prefix_start = offset
+        elif nal_type in (NAL_SLICE, NAL_IDR_SLICE):
+            if first_in_picture:
+                yield (prefix_start if prefix_start is not None else offset), nal_type == NAL_IDR_SLICE
+            prefix_start = None
+
+
+class SegmentIndex:
+    FILE_NAME = 'segments.jsonl'
+    # when cutting a clip, scanning starts from a mark at least this far ahead of the clip, so that the keyframe that
+    # precedes the clip is found. Should comfortably exceed the encoder's keyframe interval
+    KEYFRAME_LOOKBACK_MS = 10000
+
+    def __init__(self, vid_dir):
+        """
+        append-only index of recorded video segments, stored as one json record per line in vid_dir. A segment is
+        opened when the camera starts writing to a new file and closed when it stops (at a split, or at shutdown). In
+        between, the collector periodically marks the byte position of the frame being written at a given wall-clock
+        time, which lets clips be located without scanning whole segments. Records are only ever appended, so other
+        processes (e.g., the detector) can safely read the index while the collector is writing to it. Segments that
+        are still open have an end_ms of None.
+        :param vid_dir: directory holding the recorded segments
+        :type vid_dir: str
+        """
+        self.vid_dir = vid_dir
+        self.index_path = os.path.join(vid_dir, self.FILE_NAME)
+
+    def _append(self, record):
+        with open(self.index_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def open_segment(self, path, start_ms, framerate, start_frame=None):
+        """
+        record that the camera has started writing to a new segment
+        :param path: path to the segment file
+        :type path: str
+        :param start_ms: wall-clock time (in ms since the epoch, see gen_utils.current_time_ms) of the segment's first
+            frame
+        :type start_ms: int
+        :param framerate: recording framerate
+        :type framerate: float
+        :param start_frame: index of the segment's first frame within the overall recording, if known
+        :type start_frame: int
+        """
+        self._append({'event': 'open', 'path': os.path.basename(path), 'time_ms': start_ms, 'frame': start_frame,
+                      'framerate': framerate})
+
+    def mark(self, path, time_ms, position, frame=None):
+        """
+        record the byte position, within a segment, of the frame that was being written at a given time
+        :param path: path to the segment file
+        :type path: str
+        :param time_ms: wall-clock time, in ms since the epoch
+        :type time_ms: int
+        :param position: byte offset of the start of the frame within the segment file
+        :type position: int
+        :param frame: index of the frame within the overall recording, if known
+        :type frame: int
+        """
+        self._append({'event': 'mark', 'path': os.path.basename(path), 'time_ms': time_ms, 'position': position,
+                      'frame': frame})
+
+    def close_segment(self, path, end_ms, end_frame=None):
+        """
+        record that the camera has stopped writing to a segment
+        :param path: path to the segment file
+        :type path: str
+        :param end_ms: wall-clock time (in ms since the epoch) of the segment's last frame
+        :type end_ms: int
+        :param end_frame: index of the segment's last frame within the overall recording, if known
+        :type end_frame: int
+        """
+        self._append({'event': 'close', 'path': os.path.basename(path), 'time_ms': end_ms, 'frame': end_frame})
+
+    def rename_segment(self, path, new_path):
+        """
+        record that a segment file has been replaced by a new file holding the same frames (e.g., when a closed .h264
+        segment is remuxed into an .mp4)
+        :param path: original path to the segment file
+        :type path: str
+        :param new_path: new path to the segment file
+        :type new_path: str
+        """
+        self._append({'event': 'rename', 'path': os.path.basename(path), 'new_path': os.path.basename(new_path)})
+
+    def segments(self):
+        """
+        read the index
+        :return: all known segments whose files still exist, in recording order
+        :rtype: list[Segment]
+        """
+        if not os.path.exists(self.index_path):
+            return []
+        segments = {}
+        with open(self.index_path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # most likely a partially-written final line
+                    continue
+                name = record['path']
+                if record['event'] == 'open':
+                    segments[name] = Segment(name, record['time_ms'], None, record['frame'], None, record['framerate'],
+                                             [])
+                elif name not in segments:
+                    continue
+                elif record['event'] == 'mark':
+                    segments[name].marks.append(Mark(record['time_ms'], record['position'], record['frame']))
+                elif record['event'] == 'close':
+                    segments[name] = segments[name]._replace(end_ms=record['time_ms'], end_frame=record['frame'])
+                elif record['event'] == 'rename':
+                    segments[record['new_path']] = segments.pop(name)._replace(path=record['new_path'])
+        segments = [seg._replace(path=os.path.join(self.vid_dir, seg.path)) for seg in segments.values()]
+        return sorted([seg for seg in segments if os.path.exists(seg.path)], key=lambda seg: seg.start_ms)
+
+    def find(self, start_ms, end_ms):
+        """
+        find the segments that overlap a time range. Open segments are treated as extending to the present
+        :param start_ms: start of the range, in ms since the epoch
+        :type start_ms: int
+        :param end_ms: end of the range, in ms since the epoch
+        :type end_ms: int
+        :return: overlapping segments, in recording order
+        :rtype: list[Segment]
+        """
+        now = gen_utils.current_time_ms()
+        return [seg for seg in self.segments()
+                if seg.start_ms < end_ms and (seg.end_ms if seg.end_ms is not None else now) > start_ms]
+
+    def cut_clip(self, start_ms, end_ms, dest_path):
+        """
+        cut a full-framerate clip covering a wall-clock time range out of the recording, without re-encoding. The
+        relevant byte range of each overlapping segment is copied out as-is (starting from the keyframe that precedes
+        the range, so the clip may start slightly early), and the result is wrapped in an mp4 container. Segments
+        that have already been remuxed into .mp4 files are cut with ffmpeg instead, which also seeks to the preceding
+        keyframe
+        :param start_ms: start of the range, in ms since the epoch
+        :type start_ms: int
+        :param end_ms: end of the range, in ms since the epoch
+        :type end_ms: int
+        :param dest_path: path for the new clip. Should end in .mp4
+        :type dest_path: str
+        :return: dest_path, or None if no recorded segment covers the range
+        :rtype: str
+        """
+        segments = [seg for seg in self.find(start_ms, end_ms) if seg.path.endswith(('.h264', '.mp4'))]
+        if not segments:
+            return None
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # raw h264 streams can be joined by simple concatenation, as long as each part starts at a keyframe
+            raw_path = os.path.join(tmp_dir, 'clip.h264')
+            with open(raw_path, 'wb') as raw_file:
+                n_parts = sum(self._extract_mp4(seg, start_ms, end_ms, raw_file) if seg.path.endswith('.mp4')
+                              else self._extract(seg, start_ms, end_ms, raw_file) for seg in segments)
+            if not n_parts:
+                return None
+            framerate = segments[0].framerate
+            command = ['ffmpeg', '-y', '-loglevel', 'error', '-r', str(framerate), '-i', raw_path, '-c:v', 'copy',
+                       dest_path]
+            self._run(command, dest_path)
+        return dest_path
+
+    def _extract(self, seg, start_ms, end_ms, out_file):
+        """copy the frames of a segment that fall within a time range (plus any lead-in back to the preceding keyframe)
+        into out_file. Returns True if anything was copied"""
+        # frame numbers are counted from an anchor with a known time and byte position: either the start of the
+        # segment, or the latest mark that leaves enough room to find the preceding keyframe
+        anchor_ms, anchor_pos = seg.start_ms, 0
+        for mark in seg.marks:
+            if mark.time_ms <= start_ms - self.KEYFRAME_LOOKBACK_MS:
+                anchor_ms, anchor_pos = mark.time_ms, mark.position
+        first_frame = round((start_ms - anchor_ms) * seg.framerate / 1000)
+        last_frame = round((end_ms - anchor_ms) * seg.framerate / 1000)
+        clip_start, clip_end = None, None
+        with open(seg.path, 'rb') as f:
+            for n, (offset, is_idr) in enumerate(access_units(f, anchor_pos)):
+                if n > last_frame:
+                    clip_end = offset
+                    break
+                if is_idr and (n <= first_frame or clip_start is None):
+                    clip_start = offset
+            if clip_start is None:
+                return False
+            f.seek(clip_start)
+            remaining = clip_end - clip_start if clip_end is not None else None
+            while remaining is None or remaining > 0:
+                chunk = f.read(1 << 20 if remaining is None else min(1 << 20, remaining))
+                if not chunk:
+                    break
+                out_file.write(chunk)
+                if remaining is not None:
+                    remaining -= len(chunk)
+        return True
+
+    @staticmethod
+    def _extract_mp4(seg, start_ms, end_ms, out_file):
+        """stream copy the part of an mp4 segment that falls within a time range into out_file, converted back to a raw
+        annex-b stream so that it can be concatenated with other parts. Returns True if anything was copied"""
+        if not shutil.which('ffmpeg'):
+            raise FileNotFoundError('ffmpeg is required to cut clips from the recording')
+        # with -ss ahead of the input, ffmpeg seeks to the keyframe preceding the requested position when stream copying
+        offset_secs = max(0, start_ms - seg.start_ms) / 1000
+        duration_secs = (end_ms - seg.start_ms) / 1000 - offset_secs
+        command = ['ffmpeg', '-loglevel', 'error', '-ss', f'{offset_secs:.3f}', '-i', seg.path,
+                   '-t', f'{duration_secs:.3f}', '-an', '-c:v', 'copy', '-bsf:v', 'h264_mp4toannexb', '-f', 'h264', '-']
+        # ffmpeg writes straight to the underlying file descriptor, bypassing out_file's buffer
+        out_file.flush()
+        start_size = os.fstat(out_file.fileno()).st_size
+        out = sp.run(command, stdout=out_file, stderr=sp.PIPE, encoding='utf-8')
+        if out.returncode:
+            raise Exception(out.stderr)
+        return os.fstat(out_file.fileno()).st_size > start_size
+
+    @staticmethod
+    def _run(command, dest_path):
+        if not shutil.which('ffmpeg'):
+            raise FileNotFoundError('ffmpeg is required to cut clips from the recording')
+        out = sp.run(command, capture_output=True, encoding='utf-8')
+        if out.returncode or not os.path.exists(dest_path):
+            if os.path.exists(dest_path):
+                os.remove(dest_path)
+            raise Exception(out.stderr)
@@ -8,8 +8,13 @@ from internet_of_fish.modules.utils import gen_utils
 from internet_of_fish.modules import uploader
 from internet_of_fish.modules import notifier
 from internet_of_fish.modules import definitions
+from internet_of_fish.modules import journal
+from internet_of_fish.modules import rclone
+from internet_of_fish.modules import storage
+from internet_of_fish.modules import archiver
 import time
 import datetime as dt
+import multiprocessing as mp
 import os
 import glob
 import subprocess as sp
@@ -33,6 +38,9 @@ class RunnerWorker(mptools.ProcWorker, metaclass=gen_utils.AutologMetaclass):
 
         self.main_ctx.Proc('NOTIFY', notifier.NotifierWorker, self.main_ctx.notification_q)
         self.secondary_ctx = None
+        self.conversion_pool = None
+        self.journal = None
+        self.rclone_daemon = None
 
         self.die_time = dt.datetime.combine(self.metadata['end_date'], self.metadata['end_time'])
         self.logger.debug(f"RunnerWorker.die_time set to {self.die_time}")
@@ -90,6 +98,10 @@ class RunnerWorker(mptools.ProcWorker, metaclass=gen_utils.AutologMetaclass):
 
     def shutdown(self):
         self.hard_shutdown()
+        if self.journal:
+            self.journal.close()
+        if self.rclone_daemon:
+            self.rclone_daemon.stop()
 
     def verify_mode(self):
         if self.curr_mode == 'active':
@@ -142,25 +154,68 @@ class RunnerWorker(mptools.ProcWorker, metaclass=gen_utils.AutologMetaclass):
 
     def active_mode(self):
         self.switch_mode('active')
+        img_q, detect_lag = None, None
         if not self.metadata['model_id']:
             self.logger.debug('model_id not set, initializing SimpleCollector')
             self.secondary_ctx.Proc('COLLECT', collector.SimpleCollectorWorker)
         else:
-            self.img_q = self.secondary_ctx.MPQueue(maxsize=30)
+            self.img_q = img_q = self.secondary_ctx.MPQueue(maxsize=30)
+            detect_lag = mp.Value('d', 0.0)
+            frame_ring = None
+            if self.defs.FRAME_RING_SLOTS:
+                frame_ring = self.secondary_ctx.FrameRing((self.defs.V_RESOLUTION, self.defs.H_RESOLUTION, 3),
+                                                          self.defs.FRAME_RING_SLOTS)
             if self.metadata['source']:
-                self.secondary_ctx.Proc('COLLECT', collector.SourceCollectorWorker, self.img_q, self.metadata['source'])
+                self.secondary_ctx.Proc('COLLECT', collector.SourceCollectorWorker, self.img_q, self.metadata['source'],
+                                        frame_ring)
             else:
-                self.secondary_ctx.Proc('COLLECT', collector.CollectorWorker, self.img_q)
-            self.secondary_ctx.Proc('DETECT', detector.DetectorWorker, self.img_q)
+                self.secondary_ctx.Proc('COLLECT', collector.CollectorWorker, self.img_q, frame_ring)
+            self.secondary_ctx.Proc('DETECT', detector.DetectorWorker, self.img_q, frame_ring, detect_lag)
+        if self.defs.TRICKLE_UPLOADS and not self.metadata['source']:
+            self.start_trickle_uploads(img_q, detect_lag)
+        if self.defs.ACTIVE_ARCHIVING and not self.metadata['source']:
+            self.start_active_archiving()
         self.logger.info('successfully entered active mode')
 
+    def start_trickle_uploads(self, img_q, detect_lag):
+        """
+        start a single, throttled upload worker alongside collection and detection (see TrickleUploaderWorker)
+        :param img_q: the detector's image queue, or None if there is no detector
+        :type img_q: mptools.MPQueue
+        :param detect_lag: shared value in which the detector reports how far (in seconds) it is running behind the
+            camera, or None if there is no detector
+        :type detect_lag: multiprocessing.Value
+        """
+        try:
+            backend = self.open_storage()
+        except (FileNotFoundError, storage.StorageError) as e:
+            self.logger.warning(f'could not start trickle uploads: {e}')
+            return
+        if self.rclone_daemon:
+            self.rclone_daemon.renice(self.defs.TRICKLE_NICENESS)
+        self.upload_q = self.secondary_ctx.MPQueue()
+        self.secondary_ctx.Proc('TRICKLE', uploader.TrickleUploaderWorker, self.upload_q, backend, img_q, detect_lag)
+
+    def start_active_archiving(self):
+        """start a low-priority worker that streams annotation images and rotated logs to storage in compressed
+        archives as they appear (see archiver.ArchiveWorker)"""
+        try:
+            backend = self.open_storage()
+        except (FileNotFoundError, storage.StorageError) as e:
+            self.logger.warning(f'could not start active archiving: {e}')
+            return
+        self.secondary_ctx.Proc('ARCHIVE', archiver.ArchiveWorker, backend)
+
     def passive_mode(self):
         self.switch_mode('passive')
         time.sleep(10)
         self.upload_q = self.secondary_ctx.MPQueue()
         n_workers = self.queue_uploads()
+        backend = self.open_upload_storage() if n_workers else None
+        if not backend:
+            n_workers = 0
         for i in range(n_workers):
-            self.secondary_ctx.Proc(f'UPLOAD{i+1}', uploader.UploaderWorker, self.upload_q)
+            self.secondary_ctx.Proc(f'UPLOAD{i+1}', uploader.UploaderWorker, self.upload_q, backend)
             time.sleep(0.02)
         self.logger.info('successfully entered passive mode')
 
@@ -171,6 +226,11 @@ class RunnerWorker(mptools.ProcWorker, metaclass=gen_utils.AutologMetaclass):
         self.logger.info(f'Program exiting')
 
     def soft_shutdown(self):
+        if self.conversion_pool:
+            # conversions that have not yet started are left in the journal as converting. release_claims returns them
+            # to pending, and queue_uploads then submits them to the pool again
+            self.conversion_pool.shutdown(cancel=True)
+            self.conversion_pool = None
         tries_left = self.defs.MAX_TRIES
         if not self.secondary_ctx:
             self.logger.debug('secondary context has already been shut down')
@@ -181,6 +241,7 @@ class RunnerWorker(mptools.ProcWorker, metaclass=gen_utils.AutologMetaclass):
                 try:
                     self.secondary_ctx.stop_all_procs()
                     self.secondary_ctx.stop_all_queues()
+                    self.secondary_ctx.stop_all_rings()
                 except Exception as e:
                     self.logger.warning(f'soft shutdown failed with error {e}. Trying {tries_left} more times before '
                                         f'executing a hard shutdown')
@@ -231,29 +292,130 @@ class RunnerWorker(mptools.ProcWorker, metaclass=gen_utils.AutologMetaclass):
         proj_img_dir = definitions.PROJ_IMG_DIR(proj_id, analysis_state)
         proj_anno_dir = definitions.PROJ_ANNO_DIR(proj_id, analysis_state)
         proj_hit_record_dir = definitions.PROJ_HIT_RECORD_DIR(proj_id, analysis_state)
-        self.logger.debug('tarring annotation directory')
-        tar_dest = file_utils.tar_directory(proj_anno_dir, new_name=str(dt.date.today()))
-        self.logger.debug(f'annotation directory tarred into {tar_dest}')
+        self.archive_leftovers(proj_id, analysis_state)
 
         upload_list = []
         upload_list.extend(glob.glob(os.path.join(proj_dir, '*.json')))
         upload_list.extend(glob.glob(os.path.join(proj_hit_record_dir, '*.csv')))
         upload_list.extend(glob.glob(os.path.join(proj_anno_dir, '*.tar')))
-        upload_list.extend(glob.glob(os.path.join(proj_vid_dir, '*.h264')))
         upload_list.extend(glob.glob(os.path.join(proj_vid_dir, '*.mp4')))
         upload_list.extend(glob.glob(os.path.join(proj_vid_dir, '*.avi')))
         upload_list.extend(glob.glob(os.path.join(proj_img_dir, '*.mp4')))
         upload_list.extend(glob.glob(os.path.join(self.defs.LOG_DIR, '*.log.*')))
         upload_list.extend(glob.glob(os.path.join(self.defs.LOG_DIR, '*.log')))
-        n_workers = min(self.MAX_UPLOAD_WORKERS, len(upload_list))
+        h264_list = glob.glob(os.path.join(proj_vid_dir, '*.h264'))
+        if not self.journal:
+            self.journal = journal.UploadJournal(max_tries=self.defs.MAX_TRIES)
+        # uploads are only ever queued before the upload workers start, so any claims left in the journal are from a
+        # previous run that was interrupted
+        n_released = self.journal.release_claims()
+        if n_released:
+            self.logger.info(f'resuming {n_released} interrupted uploads')
+        # the upload workers claim their work from the journal, which skips anything that was already uploaded
+        upload_list = [f for f in upload_list if self.journal.add(f)]
+        # pending h264s (e.g., conversions cancelled at the last shutdown) go back to the pool too, so that the upload
+        # workers never have to convert them inline
+        h264_list = [f for f in h264_list if self.journal.add(f, state=journal.CONVERTING) or
+                     self.journal.start_conversion(f)]
+        n_pending = self.journal.counts()[journal.PENDING]
+        n_workers = min(self.MAX_UPLOAD_WORKERS, n_pending + len(h264_list))
         if upload_list:
-            [self.upload_q.safe_put(upload) for upload in upload_list]
             self.logger.debug('upload list contains:')
             [self.logger.debug(f'{os.path.basename(f)}') for f in upload_list]
+        if h264_list:
+            # h264s are converted concurrently, and each mp4 is added to the journal as soon as it is ready
+            self.logger.debug(f'converting {len(h264_list)} h264 files before upload')
+            if not self.conversion_pool:
+                self.conversion_pool = file_utils.ConversionPool(self.defs.FRAMERATE, self.defs.MAX_CONVERSION_WORKERS,
+                                                                 logger=self.logger)
+            for h264 in h264_list:
+                self.conversion_pool.submit(h264, self.queue_converted)
         if queue_end_signals:
-            [self.upload_q.safe_put('END') for _ in range(n_workers)]
+            pool = self.conversion_pool
+
+            def put_end_signals():
+                if pool:
+                    self.logger.info(pool.summary())
+                for _ in range(n_workers):
+                    self.upload_q.safe_put('END')
+
+            if pool:
+                # the upload workers exit when they receive an END signal, so wait for the conversions to finish first
+                pool.after_pending(put_end_signals)
+            else:
+                put_end_signals()
         return n_workers
 
+    def archive_leftovers(self, proj_id, analysis_state):
+        """
+        stream any annotation images and rotated logs that were not archived during active mode to storage, in
+        compressed archives (see archiver.StreamingArchiver). Anything that fails to archive stays where it is, and is
+        either archived next time or uploaded individually (along with any tarballs left by older versions)
+        """
+        try:
+            backend = self.open_storage()
+            archivers = archiver.open_archivers(backend, proj_id, analysis_state, self.defs, logger=self.logger)
+        except (FileNotFoundError, storage.StorageError) as e:
+            self.logger.warning(f'could not archive annotations and logs: {e}')
+            return
+        n_added = archiver.archive_files(archivers)
+        for _, stream_archiver in archivers:
+            stream_archiver.close()
+        if n_added:
+            self.logger.debug(f'archived {sum(a.n_files for _, a in archivers)} of {n_added} annotation images and '
+                              f'logs into {sum(a.n_archives for _, a in archivers)} archives')
+        backend.close()
+
+    def open_storage(self):
+        """
+        :return: the storage backend selected by STORAGE_BACKEND, which can be passed to the upload workers
+        :rtype: storage.StorageBackend
+        """
+        if self.defs.STORAGE_BACKEND == 'rclone':
+            return storage.make_backend('rclone', client=self.start_rclone_daemon())
+        return storage.make_backend(self.defs.STORAGE_BACKEND, self.defs)
+
+    def open_upload_storage(self):
+        """
+        open the storage backend for a batch of upload workers. If it cannot be opened (e.g., because rclone is missing
+        or its daemon will not start), the uploads are left pending in the journal, to be retried next time
+        :return: the storage backend, or None if it could not be opened
+        :rtype: storage.StorageBackend
+        """
+        try:
+            return self.open_storage()
+        except (FileNotFoundError, storage.StorageError) as e:
+            self.logger.warning(f'could not open storage, so no upload workers were started: {e}')
+            return None
+
+    def start_rclone_daemon(self):
+        """
+        start the device's rclone daemon, if it is not already running. The daemon outlives individual passive
+        sessions, and is shared by all upload workers
+        :return: a client for the daemon
+        :rtype: rclone.RcloneClient
+        """
+        if not self.rclone_daemon:
+            self.rclone_daemon = rclone.RcloneDaemon(log_file=os.path.join(self.defs.LOG_DIR, 'RCLONE.log'))
+        if not self.rclone_daemon.running:
+            self.logger.debug('starting rclone daemon')
+            self.rclone_daemon.start()
+        client = self.rclone_daemon.client()
+        # lift any bandwidth cap left behind by trickle uploads
+        client.set_bwlimit('off')
+        return client
+
+    def queue_converted(self, result):
+        """add the product of a conversion to the upload journal. If the conversion failed, the raw h264 is queued
+        instead, and the uploader will make one more attempt to convert it"""
+        if result.mp4_path:
+            self.journal.finish_conversion(result.h264_path, result.mp4_path)
+        elif result.error:
+            self.journal.release(result.h264_path)
+        else:
+            # the h264 was a fragment, and was deleted
+            self.journal.forget(result.h264_path)
+
     def end_mode(self):
         if self.curr_mode == 'passive' and self.secondary_ctx:
             self.logger.info('allowing current upload to finish')
@@ -272,9 +434,12 @@ class RunnerWorker(mptools.ProcWorker, metaclass=gen_utils.AutologMetaclass):
         sp.run(['echo', 'uploading' 'data' 'for:'] + proj_ids)
         [self.queue_uploads(pid, ast, False) for pid, ast in list(zip(proj_ids[:-1], analysis_states[:-1]))]
         self.queue_uploads(proj_ids[-1], analysis_states[-1])
-        upload_procs = [self.secondary_ctx.Proc(f'UPLOAD{i + 1}', uploader.EndUploaderWorker, self.upload_q)
-                        for i in range(self.MAX_UPLOAD_WORKERS)]
-        self.secondary_ctx.stop_procs(upload_procs, stop_wait_secs=3600)
+        backend = self.open_upload_storage()
+        if backend:
+            upload_procs = [self.secondary_ctx.Proc(f'UPLOAD{i + 1}', uploader.EndUploaderWorker, self.upload_q,
+                                                    backend)
+                            for i in range(self.MAX_UPLOAD_WORKERS)]
+            self.secondary_ctx.stop_procs(upload_procs, stop_wait_secs=3600)
         self.secondary_ctx.stop_all_procs()
         file_utils.remove_empty_dirs(self.defs.DATA_DIR)
         sp.run(['echo', 'upload', 'complete.', 'exiting'])
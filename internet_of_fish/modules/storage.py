@@ -0,0 +1,660 @@
+"""storage backends used for uploads. Each backend stores files at cloud paths of the form produced by
+file_utils.local_to_cloud (e.g., "cichlidVideo:COS/.../Videos/0001.mp4"), and exposes the same small interface (put,
+stat, list, get, move, and delete, plus batch forms of put and stat), so that uploads
+can target Dropbox through rclone, a local or network-mounted directory, or an S3-compatible object store, and so that
+upload throughput can be tested and benchmarked without the real remote. The local and s3 backends also make chunked,
+resumable uploads, which rely on joining the chunks in storage. rclone has no way to join files on the remote, so the
+rclone backend always uploads files in one piece."""
+
+import os
+import posixpath
+import shutil
+import tempfile
+import time
+from collections import namedtuple
+from concurrent import futures
+
+from internet_of_fish.modules.utils import file_utils
+
+BACKENDS = ['rclone', 'local', 's3']
+
+BenchmarkResult = namedtuple('BenchmarkResult', ['backend', 'n_files', 'n_bytes', 'secs', 'n_errors'])
+
+# appended to the cloud path of a file, followed by the chunk's starting offset, to name the chunks of a chunked upload
+# while they are staged in the cloud (e.g., 0001.mp4.chunk-67108864)
+CHUNK_SUFFIX = '.chunk-'
+
+
+class StorageError(Exception):
+    """raised when a storage backend fails to complete an operation"""
+
+
+def split_cloud_path(cloud_path):
+    """
+    split a cloud path into its remote name and the path within the remote
+    :param cloud_path: cloud path, e.g., "cichlidVideo:COS/file.txt"
+    :type cloud_path: str
+    :return: remote name (e.g., "cichlidVideo") and path within the remote (e.g., "COS/file.txt")
+    :rtype: tuple[str, str]
+    """
+    remote, _, path = cloud_path.rpartition(':')
+    return remote, path.strip('/')
+
+
+class StorageBackend:
+    # True if the backend can join the chunks of a chunked upload into a single stored file (see assemble()), which
+    # put_resumable() requires
+    JOINS_CHUNKS = False
+
+    def __init__(self, max_workers=4):
+        """
+        base class for storage backends. Every operation takes full cloud paths, and stat() and list() describe files
+        with rclone's field names (Path, Name, Size, and ModTime), so that code written against one backend works with
+        the others
+        :param max_workers: max number of transfers that put_many runs at once
+        :type max_workers: int
+        """
+        self.max_workers = max_workers
+
+    def put(self, local_path, cloud_path, progress_fn=None, shutdown_event=None):
+        """
+        copy a local file to a cloud path, blocking until the copy finishes
+        :param local_path: path to the local file
+        :type local_path: str
+        :param cloud_path: destination path (see file_utils.local_to_cloud)
+        :type cloud_path: str
+        :param progress_fn: if given, called periodically with the transfer statistics (bytes, totalBytes, and speed)
+        :type progress_fn: Callable[[dict], None]
+        :param shutdown_event: if given, the transfer is abandoned (and StorageError raised) once this event is set
+        :type shutdown_event: multiprocessing.Event
+        """
+        raise NotImplementedError(f"{self.__class__.__name__}.put is not implemented")
+
+    def put_stream(self, fileobj, cloud_path, shutdown_event=None):
+        """
+        copy the contents of a readable binary file object to a cloud path, blocking until it is exhausted. Used to
+        upload data that is generated on the fly (see archiver.StreamingArchiver), without staging it in a local file
+        :param fileobj: object to read from, until it returns b''
+        :type fileobj: io.BufferedIOBase
+        :param cloud_path: destination path (see file_utils.local_to_cloud)
+        :type cloud_path: str
+        :param shutdown_event: see put()
+        :type shutdown_event: multiprocessing.Event
+        """
+        raise NotImplementedError(f"{self.__class__.__name__}.put_stream is not implemented")
+
+    def stat(self, cloud_path, with_hash=False):
+        """
+        :param cloud_path: cloud path of the file
+        :type cloud_path: str
+        :param with_hash: if True, include the file's content hash (see file_utils.file_hash) as
+            Hashes[file_utils.CONTENT_HASH_TYPE], if the backend can provide it
+        :type with_hash: bool
+        :return: details of a stored file (see list()), or None if it does not exist
+        :rtype: dict
+        """
+        raise NotImplementedError(f"{self.__class__.__name__}.stat is not implemented")
+
+    def list(self, cloud_dir, recurse=False):
+        """
+        list the files in a cloud directory
+        :param cloud_dir: cloud directory
+        :type cloud_dir: str
+        :param recurse: if True, list the files in subdirectories as well
+        :type recurse: bool
+        :return: details of each file, with Path relative to cloud_dir. Empty if the directory does not exist
+        :rtype: list[dict]
+        """
+        raise NotImplementedError(f"{self.__class__.__name__}.list is not implemented")
+
+    def get(self, cloud_path, local_path):
+        """copy a stored file to a local path, creating the local directory if necessary"""
+        raise NotImplementedError(f"{self.__class__.__name__}.get is not implemented")
+
+    def delete(self, cloud_path):
+        """delete a stored file"""
+        raise NotImplementedError(f"{self.__class__.__name__}.delete is not implemented")
+
+    def move(self, src_cloud_path, dst_cloud_path):
+        """move a stored file to another cloud path, replacing any file already there"""
+        raise NotImplementedError(f"{self.__class__.__name__}.move is not implemented")
+
+    def exists(self, cloud_path):
+        return self.stat(cloud_path) is not None
+
+    def verify(self, cloud_path, size, content_hash):
+        """
+        confirm that a stored file has the expected size and content hash. The hash is compared whenever the backend can
+        provide one (see stat())
+        :param cloud_path: cloud path of the file
+        :type cloud_path: str
+        :param size: expected size, in bytes
+        :type size: int
+        :param content_hash: expected content hash (see file_utils.file_hash)
+        :type content_hash: str
+        :raises StorageError: if the file is missing or does not match
+        """
+        item = self.stat(cloud_path, with_hash=True)
+        if item is None:
+            raise StorageError(f'{cloud_path} is missing from the cloud')
+        if item['Size'] != size:
+            raise StorageError(f'{cloud_path} is {item["Size"]} bytes in the cloud, expected {size}')
+        remote_hash = item.get('Hashes', {}).get(file_utils.CONTENT_HASH_TYPE)
+        if remote_hash is not None and remote_hash != content_hash:
+            raise StorageError(f'{cloud_path} has the wrong content hash in the cloud')
+
+    def put_resumable(self, local_path, cloud_path, checkpoint, chunk_size, content_hash=None, progress_fn=None,
+                      shutdown_event=None):
+        """
+        copy a local file to a cloud path in chunks, so that an interrupted copy resumes from the last confirmed chunk
+        rather than starting over. Each chunk is staged in the cloud next to cloud_path (see CHUNK_SUFFIX), verified by
+        its content hash, and recorded in checkpoint, which persists across attempts. Once every chunk is in place, the
+        chunks are assembled into the stored file (see assemble())
+        :param local_path: path to the local file
+        :type local_path: str
+        :param cloud_path: destination path (see file_utils.local_to_cloud)
+        :type cloud_path: str
+        :param checkpoint: record of the chunks confirmed so far
+        :type checkpoint: internet_of_fish.modules.journal.ChunkCheckpoint
+        :param chunk_size: chunk size, in bytes. Rounded up to a whole number of content hash blocks, so that the hash
+            of each chunk can be compared with the hash the cloud reports for it
+        :type chunk_size: int
+        :param content_hash: content hash of the local file (see file_utils.file_hash), if already known
+        :type content_hash: str
+        :param progress_fn: see put(). Reports progress through the whole file, rather than the current chunk
+        :type progress_fn: Callable[[dict], None]
+        :param shutdown_event: see put(). Chunks confirmed before shutdown are kept for the next attempt
+        :type shutdown_event: multiprocessing.Event
+        :raises StorageError: if a chunk fails to upload or verify. Chunks confirmed so far are kept for the next
+            attempt
+        """
+        if not self.JOINS_CHUNKS:
+            raise NotImplementedError(f"{self.__class__.__name__} cannot join chunks, so does not support resumable "
+                                      f"uploads")
+        block_size = file_utils.CONTENT_HASH_BLOCK_SIZE
+        chunk_size = max(1, -(-chunk_size // block_size)) * block_size
+        total_bytes = os.path.getsize(local_path)
+        content_hash = content_hash if content_hash else file_utils.file_hash(local_path)
+        confirmed = checkpoint.confirmed(local_path, content_hash, chunk_size)
+        # a confirmed chunk is only skipped if it is still staged in the cloud
+        staged = {item['Name']: item['Size'] for item in self.list(posixpath.dirname(cloud_path))} if confirmed else {}
+        chunk_cloud_paths = []
+        for start in range(0, total_bytes, chunk_size):
+            end = min(start + chunk_size, total_bytes)
+            chunk_cloud_path = f'{cloud_path}{CHUNK_SUFFIX}{start}'
+            chunk_cloud_paths.append(chunk_cloud_path)
+            if start in confirmed and staged.get(posixpath.basename(chunk_cloud_path)) == end - start:
+                continue
+            if shutdown_event is not None and shutdown_event.is_set():
+                raise StorageError(f'copy of {local_path} stopped by shutdown')
+            chunk_progress_fn = None
+            if progress_fn:
+                def chunk_progress_fn(stats, offset=start):
+                    progress_fn({**stats, 'bytes': offset + stats['bytes'], 'totalBytes': total_bytes})
+            fd, chunk_path = tempfile.mkstemp(prefix=os.path.basename(local_path) + CHUNK_SUFFIX)
+            os.close(fd)
+            try:
+                file_utils.write_tail(local_path, start, end, tail_path=chunk_path)
+                chunk_hash = file_utils.file_hash(chunk_path)
+                self.put(chunk_path, chunk_cloud_path, progress_fn=chunk_progress_fn, shutdown_event=shutdown_event)
+            finally:
+                os.remove(chunk_path)
+            self.verify(chunk_cloud_path, end - start, chunk_hash)
+            checkpoint.confirm(local_path, content_hash, chunk_size, start, chunk_hash)
+        self.assemble(chunk_cloud_paths, cloud_path, content_hash)
+        self.verify(cloud_path, total_bytes, content_hash)
+        checkpoint.clear(local_path)
+
+    def assemble(self, chunk_cloud_paths, cloud_path, content_hash):
+        """
+        join the staged chunks of a chunked upload (see put_resumable()) into the stored file, and remove the chunks.
+        Only implemented by backends that set JOINS_CHUNKS
+        :param chunk_cloud_paths: cloud paths of the staged chunks, in order
+        :type chunk_cloud_paths: list[str]
+        :param cloud_path: destination path
+        :type cloud_path: str
+        :param content_hash: content hash of the whole file
+        :type content_hash: str
+        """
+        raise NotImplementedError(f"{self.__class__.__name__}.assemble is not implemented")
+
+    def put_many(self, transfers, shutdown_event=None):
+        """
+        copy several local files to the cloud at once. The default implementation runs put() in a pool of max_workers
+        threads; backends that can queue transfers themselves override this
+        :param transfers: (local_path, cloud_path) pairs
+        :type transfers: list[tuple[str, str]]
+        :param shutdown_event: see put()
+        :type shutdown_event: multiprocessing.Event
+        :return: for each transfer, in order, None if it succeeded or the error message if it failed
+        :rtype: list[str]
+        """
+        def put_one(transfer):
+            try:
+                self.put(*transfer, shutdown_event=shutdown_event)
+            except (StorageError, OSError) as e:
+                return str(e)
+
+        with futures.ThreadPoolExecutor(max(1, self.max_workers)) as pool:
+            return list(pool.map(put_one, transfers))
+
+    def stat_many(self, cloud_paths):
+        """
+        stat several files, using one listing per cloud directory rather than one query per file
+        :param cloud_paths: cloud paths of the files
+        :type cloud_paths: list[str]
+        :return: details of each file (see stat()), or None for files that do not exist, in the order given
+        :rtype: list[dict]
+        """
+        listings = {}
+        results = []
+        for cloud_path in cloud_paths:
+            cloud_dir = posixpath.dirname(cloud_path)
+            if cloud_dir not in listings:
+                listings[cloud_dir] = {item['Name']: item for item in self.list(cloud_dir)}
+            results.append(listings[cloud_dir].get(posixpath.basename(cloud_path)))
+        return results
+
+    def set_bwlimit(self, rate):
+        """
+        cap the bandwidth used by this backend's transfers. Backends that cannot limit their bandwidth ignore this
+        :param rate: limit in rclone's notation (e.g., "512k" for 512 KiB/s), or "off" to remove the cap
+        :type rate: str
+        :return: the new limit in bytes per second (-1 if there is no limit), or None if the backend cannot limit it
+        :rtype: int
+        """
+        return None
+
+    def close(self):
+        pass
+
+
+class RcloneBackend(StorageBackend):
+
+    def __init__(self, client, poll_secs=5, **kwargs):
+        """
+        stores files through a running rclone daemon, which handles all the remotes configured in rclone
+        :param client: client for the daemon (see rclone.RcloneDaemon.client)
+        :type client: internet_of_fish.modules.rclone.RcloneClient
+        :param poll_secs: max time between checks on a transfer in progress
+        :type poll_secs: float
+        """
+        super().__init__(**kwargs)
+        self.client = client
+        self.poll_secs = poll_secs
+
+    def put(self, local_path, cloud_path, progress_fn=None, shutdown_event=None):
+        self.client.copyfile(local_path, cloud_path, progress_fn=progress_fn, poll_secs=self.poll_secs,
+                             shutdown_event=shutdown_event)
+
+    def put_stream(self, fileobj, cloud_path, shutdown_event=None):
+        self.client.uploadfile(fileobj, cloud_path, shutdown_event=shutdown_event)
+
+    def put_many(self, transfers, shutdown_event=None):
+        """queue every transfer with the daemon up front (which runs them with its own concurrency), then wait for
+        each in turn"""
+        jobs = []
+        for local_path, cloud_path in transfers:
+            try:
+                jobs.append(self.client.submit_copy(local_path, cloud_path))
+            except StorageError as e:
+                jobs.append(e)
+        errors = []
+        for job in jobs:
+            if isinstance(job, StorageError):
+                errors.append(str(job))
+                continue
+            try:
+                self.client.wait(job, poll_secs=self.poll_secs, shutdown_event=shutdown_event)
+                errors.append(None)
+            except StorageError as e:
+                errors.append(str(e))
+        return errors
+
+    def stat(self, cloud_path, with_hash=False):
+        return self.client.stat(cloud_path, file_utils.CONTENT_HASH_TYPE if with_hash else None)
+
+    def list(self, cloud_dir, recurse=False):
+        return self.client.list(cloud_dir, recurse=recurse)
+
+    def get(self, cloud_path, local_path):
+        os.makedirs(os.path.dirname(os.path.abspath(local_path)), exist_ok=True)
+        self.client.fetchfile(cloud_path, local_path)
+
+    def delete(self, cloud_path):
+        self.client.deletefile(cloud_path)
+
+    def move(self, src_cloud_path, dst_cloud_path):
+        self.client.movefile(src_cloud_path, dst_cloud_path)
+
+    def set_bwlimit(self, rate):
+        return self.client.set_bwlimit(rate)
+
+    def close(self):
+        self.client.close()
+
+
+class LocalBackend(StorageBackend):
+    # files are copied in chunks of this many bytes, checking for shutdown and reporting progress in between
+    CHUNK_SIZE = 1 << 20
+    JOINS_CHUNKS = True
+
+    def __init__(self, root_dir, **kwargs):
+        """
+        stores files in a local directory, such as a mounted NAS share or a temporary directory during tests. The path
+        within the remote (see split_cloud_path) is stored relative to root_dir, and the remote name is ignored
+        :param root_dir: directory that stands in for the root of the remote. Created if it does not exist
+        :type root_dir: str
+        """
+        super().__init__(**kwargs)
+        self.root_dir = os.path.abspath(root_dir)
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def local_path(self, cloud_path):
+        """:return: the path where the file at cloud_path is stored"""
+        return os.path.join(self.root_dir, *split_cloud_path(cloud_path)[1].split('/'))
+
+    @staticmethod
+    def describe(path, rel_path):
+        stat = os.stat(path)
+        return {'Path': rel_path, 'Name': os.path.basename(path), 'Size': stat.st_size,
+                'ModTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(stat.st_mtime))}
+
+    def put(self, local_path, cloud_path, progress_fn=None, shutdown_event=None):
+        total_bytes = os.path.getsize(local_path)
+        with open(local_path, 'rb') as src:
+            tmp_path = self._write(src, cloud_path, progress_fn, shutdown_event, total_bytes)
+            shutil.copystat(local_path, tmp_path)
+        os.replace(tmp_path, self.local_path(cloud_path))
+
+    def put_stream(self, fileobj, cloud_path, shutdown_event=None):
+        os.replace(self._write(fileobj, cloud_path, shutdown_event=shutdown_event), self.local_path(cloud_path))
+
+    def _write(self, src, cloud_path, progress_fn=None, shutdown_event=None, total_bytes=None):
+        """
+        copy the contents of src to a temporary file next to the destination, which the caller renames into place, so
+        that an interrupted copy never leaves a partial file
+        :return: path to the temporary file
+        :rtype: str
+        """
+        dest = self.local_path(cloud_path)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        n_bytes, start = 0, time.time()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.' + os.path.basename(dest))
+        try:
+            with os.fdopen(fd, 'wb') as dst:
+                for chunk in iter(lambda: src.read(self.CHUNK_SIZE), b''):
+                    if shutdown_event is not None and shutdown_event.is_set():
+                        raise StorageError(f'copy to {cloud_path} stopped by shutdown')
+                    dst.write(chunk)
+                    n_bytes += len(chunk)
+                    if progress_fn:
+                        progress_fn({'bytes': n_bytes, 'totalBytes': total_bytes,
+                                     'speed': n_bytes / max(time.time() - start, 1e-6)})
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return tmp_path
+
+    def stat(self, cloud_path, with_hash=False):
+        path = self.local_path(cloud_path)
+        if not os.path.isfile(path):
+            return None
+        item = self.describe(path, os.path.basename(path))
+        if with_hash:
+            item['Hashes'] = {file_utils.CONTENT_HASH_TYPE: file_utils.file_hash(path)}
+        return item
+
+    def list(self, cloud_dir, recurse=False):
+        root = self.local_path(cloud_dir)
+        if not os.path.isdir(root):
+            return []
+        items = []
+        for dir_path, dir_names, file_names in os.walk(root):
+            if not recurse:
+                dir_names.clear()
+            for name in file_names:
+                if name.startswith('.'):
+                    # temporary files left by copies in progress
+                    continue
+                path = os.path.join(dir_path, name)
+                items.append(self.describe(path, os.path.relpath(path, root).replace(os.sep, '/')))
+        return items
+
+    def get(self, cloud_path, local_path):
+        os.makedirs(os.path.dirname(os.path.abspath(local_path)), exist_ok=True)
+        try:
+            shutil.copy2(self.local_path(cloud_path), local_path)
+        except FileNotFoundError:
+            raise StorageError(f'{cloud_path} not found')
+
+    def delete(self, cloud_path):
+        try:
+            os.remove(self.local_path(cloud_path))
+        except FileNotFoundError:
+            raise StorageError(f'{cloud_path} not found')
+
+    def move(self, src_cloud_path, dst_cloud_path):
+        dest = self.local_path(dst_cloud_path)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        try:
+            os.replace(self.local_path(src_cloud_path), dest)
+        except FileNotFoundError:
+            raise StorageError(f'{src_cloud_path} not found')
+
+    def assemble(self, chunk_cloud_paths, cloud_path, content_hash):
+        dest = self.local_path(cloud_path)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.' + os.path.basename(dest))
+        try:
+            with os.fdopen(fd, 'wb') as dst:
+                for chunk_cloud_path in chunk_cloud_paths:
+                    with open(self.local_path(chunk_cloud_path), 'rb') as src:
+                        shutil.copyfileobj(src, dst)
+            os.replace(tmp_path, dest)
+        except FileNotFoundError as e:
+            raise StorageError(f'chunk missing while assembling {cloud_path}: {e}')
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        for chunk_cloud_path in chunk_cloud_paths:
+            os.remove(self.local_path(chunk_cloud_path))
+
+
+class S3Backend(StorageBackend):
+    JOINS_CHUNKS = True
+    # object stores have no equivalent of the content hash, so it is stored with each object as user metadata
+    HASH_METADATA_KEY = 'content-hash'
+
+    def __init__(self, bucket, endpoint_url=None, prefix='', **kwargs):
+        """
+        stores files in an S3-compatible object store (e.g., AWS S3, MinIO, or a local stand-in server), using boto3.
+        Credentials are found the usual boto3 way (environment variables, ~/.aws/credentials, etc.). The path within
+        the remote (see split_cloud_path) becomes the object key, and the remote name is ignored
+        :param bucket: name of the bucket
+        :type bucket: str
+        :param endpoint_url: url of the object store, or None for AWS
+        :type endpoint_url: str
+        :param prefix: prefix added to every object key
+        :type prefix: str
+        """
+        super().__init__(**kwargs)
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url
+        self.prefix = prefix.strip('/')
+        self._client = None
+
+    def __getstate__(self):
+        # boto3 clients cannot be pickled, so each process creates its own on first use
+        state = self.__dict__.copy()
+        state['_client'] = None
+        return state
+
+    @property
+    def client(self):
+        if self._client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise StorageError('boto3 is required for the s3 storage backend')
+            self._client = boto3.client('s3', endpoint_url=self.endpoint_url)
+        return self._client
+
+    def key(self, cloud_path):
+        return posixpath.join(self.prefix, split_cloud_path(cloud_path)[1]).strip('/')
+
+    def call(self, method, *args, **kwargs):
+        """call a boto3 client method, translating its errors into StorageErrors"""
+        from botocore.exceptions import BotoCoreError, ClientError
+        try:
+            return getattr(self.client, method)(*args, **kwargs)
+        except (BotoCoreError, ClientError) as e:
+            raise StorageError(f'{method} failed: {e}') from e
+
+    def put(self, local_path, cloud_path, progress_fn=None, shutdown_event=None):
+        total_bytes = os.path.getsize(local_path)
+        n_bytes, start = 0, time.time()
+
+        def callback(chunk_bytes):
+            nonlocal n_bytes
+            # raising from the callback aborts the transfer
+            if shutdown_event is not None and shutdown_event.is_set():
+                raise StorageError(f'copy of {local_path} stopped by shutdown')
+            n_bytes += chunk_bytes
+            if progress_fn:
+                progress_fn({'bytes': n_bytes, 'totalBytes': total_bytes,
+                             'speed': n_bytes / max(time.time() - start, 1e-6)})
+
+        self.call('upload_file', local_path, self.bucket, self.key(cloud_path), Callback=callback,
+                  ExtraArgs={'Metadata': {self.HASH_METADATA_KEY: file_utils.file_hash(local_path)}})
+
+    def put_stream(self, fileobj, cloud_path, shutdown_event=None):
+        def callback(_):
+            if shutdown_event is not None and shutdown_event.is_set():
+                raise StorageError(f'upload to {cloud_path} stopped by shutdown')
+
+        self.call('upload_fileobj', fileobj, self.bucket, self.key(cloud_path), Callback=callback)
+
+    def stat(self, cloud_path, with_hash=False):
+        key = self.key(cloud_path)
+        try:
+            head = self.call('head_object', Bucket=self.bucket, Key=key)
+        except StorageError as e:
+            if getattr(e.__cause__, 'response', {}).get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+                return None
+            raise
+        item = {'Path': posixpath.basename(key), 'Name': posixpath.basename(key), 'Size': head['ContentLength'],
+                'ModTime': head['LastModified'].strftime('%Y-%m-%dT%H:%M:%SZ')}
+        if with_hash and self.HASH_METADATA_KEY in head.get('Metadata', {}):
+            item['Hashes'] = {file_utils.CONTENT_HASH_TYPE: head['Metadata'][self.HASH_METADATA_KEY]}
+        return item
+
+    def list(self, cloud_dir, recurse=False):
+        prefix = self.key(cloud_dir)
+        prefix = prefix + '/' if prefix else ''
+        params = {'Bucket': self.bucket, 'Prefix': prefix}
+        if not recurse:
+            params['Delimiter'] = '/'
+        items = []
+        while True:
+            page = self.call('list_objects_v2', **params)
+            for obj in page.get('Contents', []):
+                rel_path = obj['Key'][len(prefix):]
+                items.append({'Path': rel_path, 'Name': posixpath.basename(rel_path), 'Size': obj['Size'],
+                              'ModTime': obj['LastModified'].strftime('%Y-%m-%dT%H:%M:%SZ')})
+            if not page.get('IsTruncated'):
+                return items
+            params['ContinuationToken'] = page['NextContinuationToken']
+
+    def get(self, cloud_path, local_path):
+        os.makedirs(os.path.dirname(os.path.abspath(local_path)), exist_ok=True)
+        self.call('download_file', self.bucket, self.key(cloud_path), local_path)
+
+    def delete(self, cloud_path):
+        self.call('delete_object', Bucket=self.bucket, Key=self.key(cloud_path))
+
+    def move(self, src_cloud_path, dst_cloud_path):
+        self.call('copy_object', Bucket=self.bucket, Key=self.key(dst_cloud_path),
+                  CopySource={'Bucket': self.bucket, 'Key': self.key(src_cloud_path)})
+        self.delete(src_cloud_path)
+
+    def assemble(self, chunk_cloud_paths, cloud_path, content_hash):
+        """join the chunks server-side, as the parts of a multipart upload. S3 requires every part but the last to be at
+        least 5 MiB"""
+        key = self.key(cloud_path)
+        upload_id = self.call('create_multipart_upload', Bucket=self.bucket, Key=key,
+                              Metadata={self.HASH_METADATA_KEY: content_hash})['UploadId']
+        try:
+            parts = []
+            for part_number, chunk_cloud_path in enumerate(chunk_cloud_paths, start=1):
+                result = self.call('upload_part_copy', Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                   PartNumber=part_number,
+                                   CopySource={'Bucket': self.bucket, 'Key': self.key(chunk_cloud_path)})
+                parts.append({'PartNumber': part_number, 'ETag': result['CopyPartResult']['ETag']})
+            self.call('complete_multipart_upload', Bucket=self.bucket, Key=key, UploadId=upload_id,
+                      MultipartUpload={'Parts': parts})
+        except StorageError:
+            self.call('abort_multipart_upload', Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+        for chunk_cloud_path in chunk_cloud_paths:
+            self.delete(chunk_cloud_path)
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+def make_backend(backend, defs=None, **kwargs):
+    """
+    instantiate a storage backend by name
+    :param backend: one of 'rclone', 'local', or 's3'
+    :type backend: str
+    :param defs: frozen definitions (see gen_utils.freeze_definitions), used to fill in backend-specific settings
+    :type defs: types.SimpleNamespace
+    :param kwargs: additional keyword arguments passed to the backend constructor, overriding values from defs. The
+        rclone backend requires a client for a running daemon (see rclone.RcloneDaemon.client)
+    :return: the new backend
+    :rtype: StorageBackend
+    """
+    if backend == 'rclone':
+        return RcloneBackend(**kwargs)
+    if backend == 'local':
+        if defs is not None:
+            kwargs.setdefault('root_dir', defs.STORAGE_LOCAL_DIR)
+        return LocalBackend(**kwargs)
+    if backend == 's3':
+        if defs is not None:
+            kwargs.setdefault('bucket', defs.S3_BUCKET)
+            kwargs.setdefault('endpoint_url', defs.S3_ENDPOINT_URL)
+        return S3Backend(**kwargs)
+    raise ValueError(f'unknown storage backend {backend}. Valid options are {", ".join(BACKENDS)}')
+
+
+def benchmark(backends, local_paths, cloud_dir):
+    """
+    upload the same set of files to each backend with put_many, confirm that they arrived with stat_many, then delete
+    them again
+    :param backends: backends to compare, by name
+    :type backends: dict[str, StorageBackend]
+    :param local_paths: files to upload
+    :type local_paths: list[str]
+    :param cloud_dir: scratch cloud directory that the files are uploaded to
+    :type cloud_dir: str
+    :return: one result per backend. n_errors counts files that failed to upload or did not arrive intact
+    :rtype: list[BenchmarkResult]
+    """
+    n_bytes = sum(os.path.getsize(path) for path in local_paths)
+    results = []
+    for name, backend in backends.items():
+        cloud_paths = [posixpath.join(cloud_dir, f'{i}_{os.path.basename(path)}') for i, path in enumerate(local_paths)]
+        start = time.time()
+        errors = backend.put_many(list(zip(local_paths, cloud_paths)))
+        secs = time.time() - start
+        stats = backend.stat_many(cloud_paths)
+        n_errors = sum(bool(error) or stat is None or stat['Size'] != os.path.getsize(path)
+                       for error, stat, path in zip(errors, stats, local_paths))
+        for cloud_path, stat in zip(cloud_paths, stats):
+            if stat is not None:
+                backend.delete(cloud_path)
+        results.append(BenchmarkResult(name, len(local_paths), n_bytes, secs, n_errors))
+    return results
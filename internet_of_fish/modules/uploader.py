@@ -1,57 +1,286 @@
 import time
 
 from internet_of_fish.modules.mptools import QueueProcWorker
-from internet_of_fish.modules.utils import file_utils
+from internet_of_fish.modules import journal
+from internet_of_fish.modules import rclone
+from internet_of_fish.modules import storage
+from internet_of_fish.modules.utils import file_utils, gen_utils
+import glob
 import os
-import subprocess
+import posixpath
 import shutil
+from collections import Counter, namedtuple
+
+# a file that has been copied to the cloud, but not yet confirmed to be there. target is the file that was actually
+# uploaded (the journal file itself, a snapshot of it, or a tail of new data), and size is target's size. hash and
+# content_size describe the journal file as uploaded. delete says whether the journal file is deleted once verified,
+# and scratch lists temporary files that are deleted either way
+CopiedFile = namedtuple('CopiedFile', ['journal_path', 'target', 'cloud_path', 'size', 'hash', 'content_size', 'delete',
+                                       'scratch'])
 
 
 class UploaderWorker(QueueProcWorker):
+    # how long to wait for new work to appear in the journal before checking again
+    POLL_SECS = 5
+    # how often to log the progress of a long upload
+    PROGRESS_SECS = 60
+    # max number of copied files to hold before verifying them
+    VERIFY_BATCH_SIZE = 20
+
+    def init_args(self, args):
+        self.work_q, self.storage = args
+
+    def startup(self):
+        self.journal = journal.UploadJournal(max_tries=self.defs.MAX_TRIES)
+        self.hash_index = journal.HashIndex()
+        self.checkpoint = journal.ChunkCheckpoint()
+        self.remote_listing = rclone.RemoteListingCache(self.storage.list)
+        self.copied = []
+        # number of retries scheduled, by error class (see journal.RETRY_POLICIES)
+        self.n_retries = Counter()
+        # a copied video stays claimed until it is verified, so it continues to count against the limit until then
+        self.class_limits = {'video': self.defs.MAX_VIDEO_UPLOAD_WORKERS}
+
+    def main_loop(self):
+        """
+        claims files from the upload journal and uploads them one at a time, highest priority first (see
+        journal.UPLOAD_CLASSES), while keeping the number of simultaneous video uploads within
+        MAX_VIDEO_UPLOAD_WORKERS. The work queue only carries END signals, which tell the worker to exit once nothing is
+        left to claim (including files waiting to be retried). Copied files are verified in batches, whenever enough
+        have accumulated or the worker runs out of work
+        """
+        ending = False
+        while not self.shutdown_event.is_set():
+            entry = self.journal.claim(self.name, self.class_limits)
+            if entry:
+                self.main_func(entry.path)
+                if len(self.copied) >= self.VERIFY_BATCH_SIZE:
+                    self.verify_copies()
+                continue
+            if self.copied:
+                # verification may hand files back to the journal, so check for work again afterwards
+                self.verify_copies()
+            elif ending:
+                next_retry = self.journal.next_retry()
+                if next_retry is None:
+                    break
+                # wait for the next retry to come due
+                self.shutdown_event.wait(min(self.POLL_SECS, max(0.0, next_retry - time.time())))
+            elif self.work_q.safe_get(timeout=self.POLL_SECS) == 'END':
+                ending = True
 
     def main_func(self, target, end_of_proj=False):
         """
-        takes items (file paths) in sequence from the upload_list and either uploads or processes them. If the file has
-        a .h264 extension, it is converted to an mp4, and the mp4 added to the end of the upload_list. Otherwise, the
-        file is uploaded to Dropbox using rclone. This function will attempt to upload/process a given item
-        self.MAX_TRIES number of times before failing, but will not throw an exception that might halt the program.
-        :param item: path to file to process/upload. Ideally a full path
+        uploads or processes a single file claimed from the upload journal. If the file has a .h264 extension, it is
+        converted to an mp4, and the mp4 takes its place in the journal. The file is then uploaded through the storage
+        backend (see STORAGE_BACKEND), and held (still claimed) until verify_copies confirms that it arrived. Files
+        whose content (per the hash index) is already in the cloud are not uploaded again, and append-only files (see
+        journal.APPEND_ONLY_CLASSES) that have only grown since their last upload have just their new data uploaded,
+        as a tail file (see file_utils.join_tails). Files larger than CHUNKED_UPLOAD_MB are uploaded in chunks, so that
+        a retry resumes from the last confirmed chunk, on the storage backends that can join the chunks back into a
+        single stored file (local and s3). Each call makes a single attempt. A file that fails is handed
+        back to the journal to be retried later (see record_failure), up to self.MAX_TRIES times in all, so that the
+        worker can move straight on to the next file. This function will not throw an exception that might halt the
+        program.
+        :param target: path to file to process/upload. Ideally a full path
         :type target: str
         """
-        tries_left = self.defs.MAX_TRIES
-        while not self.shutdown_event.is_set() and tries_left:
-            if target.endswith('.h264'):
-                # delete tiny video fragments (~1 frame long) that are occasionally produced and will choke ffmpeg
-                if os.path.getsize(target) < 100:
-                    os.remove(target)
-                    break
-                mp4_path = self.h264_to_mp4(target)
-                if mp4_path:
-                    target = mp4_path
-            if target.endswith('.log'):
-                target = shutil.copy(target, self.defs.PROJ_LOG_DIR)
-            try:
-                self.logger.debug(f'uploading {target} to {file_utils.local_to_cloud(target)}')
-                cmnd = ['rclone', 'copyto', target, file_utils.local_to_cloud(target)]
-                out = subprocess.run(cmnd, capture_output=True, encoding='utf-8')
-                if file_utils.exists_cloud(target):
-                    self.logger.debug(f'successfully uploaded {target}')
-                    if ((not target.endswith('.json')) and (target != self.metadata['source'])) or end_of_proj:
-                        self.logger.debug(f'deleting {target}')
-                        os.remove(target)
-                    break
-                else:
-                    self.logger.debug(f'failed to upload {os.path.basename(target)}: {out.stderr}')
-            except Exception as e:
-                self.logger.debug(f'unexpected exception {e}')
-            tries_left -= 1
-            time.sleep(60)
+        journal_path = target
+        if target.endswith('.h264'):
+            # delete tiny video fragments (~1 frame long) that are occasionally produced and will choke ffmpeg
+            if os.path.getsize(target) < 100:
+                os.remove(target)
+                self.journal.forget(target)
+                return
+            mp4_path = self.h264_to_mp4(target)
+            if mp4_path:
+                self.journal.finish_conversion(target, mp4_path, claimed_by=self.name)
+                target = journal_path = mp4_path
+        scratch = []
+        if journal_path.endswith('.log'):
+            # snapshot the log, which is still being written to
+            target = shutil.copy(journal_path, self.defs.PROJ_LOG_DIR)
+            scratch.append(target)
+        try:
+            self.upload(journal_path, target, scratch, end_of_proj)
+            return
+        except storage.StorageError as e:
+            error = str(e)
+            self.logger.debug(f'failed to upload {os.path.basename(target)}: {error}')
+        except Exception as e:
+            error = f'unexpected exception {e}'
+            self.logger.debug(error)
+        self.remove_files(scratch)
+        if self.shutdown_event.is_set():
+            # interrupted by shutdown, so hand the file back to the journal to be picked up next time
+            self.journal.release(journal_path)
+            return
+        self.record_failure(journal_path, error)
 
+    def upload(self, journal_path, target, scratch, end_of_proj=False):
+        """
+        make one attempt to upload a file (see main_func)
+        :param journal_path: path to the file in the upload journal
+        :type journal_path: str
+        :param target: path to the file to upload (either journal_path, or a snapshot of it)
+        :type target: str
+        :param scratch: temporary files that should be deleted once the upload has been verified (or has failed). Any
+            temporary files made during the upload are added to it
+        :type scratch: list[str]
+        :raises storage.StorageError: if the upload fails
+        """
+        cloud_path = file_utils.local_to_cloud(target)
+        append_only = journal.classify(journal_path).name in journal.APPEND_ONLY_CLASSES
+        entry = self.hash_index.get(target, append_only, key=journal_path)
+        delete = target == journal_path and (
+            ((not target.endswith('.json')) and (target != self.metadata['source'])) or end_of_proj)
+        if append_only and entry.remote_size == entry.size and entry.remote_hash == entry.hash:
+            self.logger.debug(f'nothing new in {target} since it was last uploaded')
+            self.finish_copy(CopiedFile(journal_path, target, cloud_path, 0, entry.hash, entry.size, delete, scratch))
+            return
+        if self.in_cloud(cloud_path, entry):
+            self.logger.debug(f'{target} is already in the cloud. Skipping upload')
+            self.finish_copy(CopiedFile(journal_path, target, cloud_path, entry.size, entry.hash, entry.size, delete,
+                                        scratch))
+            return
+        upload_path = self.write_tail(target, entry) if append_only else None
+        if upload_path:
+            scratch.append(upload_path)
+            cloud_path = file_utils.local_to_cloud(upload_path)
+        else:
+            upload_path = target
+            if append_only and entry.remote_size:
+                self.remove_remote_tails(cloud_path)
+        chunk_size = self.defs.CHUNKED_UPLOAD_MB * 1024 ** 2
+        # resumable uploads need the backend to join the chunks in storage, which rclone cannot do, so the rclone
+        # backend always gets the file in one piece
+        if chunk_size and self.storage.JOINS_CHUNKS and os.path.getsize(upload_path) > chunk_size:
+            # each chunk is verified by its hash as it goes, so there is nothing left for verify_copies to check
+            self.logger.debug(f'uploading {upload_path} to {cloud_path} in chunks')
+            self.remote_listing.note_upload(cloud_path)
+            self.storage.put_resumable(upload_path, cloud_path, self.checkpoint, chunk_size,
+                                       content_hash=entry.hash if upload_path == target else None,
+                                       progress_fn=self.progress_logger(upload_path),
+                                       shutdown_event=self.shutdown_event)
+            self.logger.debug(f'successfully uploaded {upload_path}')
+            self.finish_copy(CopiedFile(journal_path, upload_path, cloud_path, os.path.getsize(upload_path),
+                                        entry.hash, entry.size, delete, scratch))
+            return
+        self.logger.debug(f'uploading {upload_path} to {cloud_path}')
+        # rclone verifies the size and (where the remote supports it) the hash of each transfer, and reports the job as
+        # failed if the copy did not check out. The other backends are checked by verify_copies alone
+        self.remote_listing.note_upload(cloud_path)
+        self.storage.put(upload_path, cloud_path, progress_fn=self.progress_logger(upload_path),
+                         shutdown_event=self.shutdown_event)
+        self.logger.debug(f'successfully uploaded {upload_path}')
+        self.copied.append(CopiedFile(journal_path, upload_path, cloud_path, os.path.getsize(upload_path), entry.hash,
+                                      entry.size, delete, scratch))
+
+    def record_failure(self, journal_path, error):
+        """hand a file that failed to upload back to the journal, to be retried once the delay set by the error's retry
+        policy (see journal.RETRY_POLICIES) has passed. Meanwhile, the worker moves on to other files"""
+        policy = journal.retry_policy(error)
+        self.n_retries[policy.name] += 1
+        if self.journal.record_failure(journal_path, error, retry=True):
+            self.logger.debug(f'will retry {os.path.basename(journal_path)} later ({policy.name} error)')
         else:
-            # this else clause should only execute if the while loop exited because it ran out of tries
-            # (tries_left = 0). If the loop instead hits a break statement (due to a successful upload or conversion)
-            # this clause gets skipped.
-            self.logger.warning(f'failed three times to process {os.path.basename(target)}. Moving on')
+            self.logger.warning(f'failed {self.defs.MAX_TRIES} times to process {os.path.basename(journal_path)}. '
+                                f'Moving on')
+
+    def verify_copies(self):
+        """
+        confirm that the copied files are present in the cloud with the expected size, using one listing per cloud
+        directory rather than one query per file. Verified files are marked as uploaded in the journal (and deleted
+        locally, where appropriate). Files that are missing are handed back to the journal to be uploaded again
+        """
+        copied, self.copied = self.copied, []
+        for copy in copied:
+            try:
+                verified = self.remote_listing.matches(copy.cloud_path, copy.size)
+                error = None if verified else 'file missing from the cloud (or the wrong size) after upload'
+            except storage.StorageError as e:
+                verified, error = False, f'could not verify upload: {e}'
+            if verified:
+                self.finish_copy(copy)
+            else:
+                self.logger.warning(f'{os.path.basename(copy.target)}: {error}')
+                self.remove_files(copy.scratch)
+                self.record_failure(copy.journal_path, error)
+        self.logger.debug(f'verified {len(copied)} uploads using {self.remote_listing.n_listings} listings so far')
+
+    def finish_copy(self, copy):
+        """record a verified upload in the journal and the hash index, and clean up after it"""
+        self.journal.complete(copy.journal_path, copy.hash)
+        self.hash_index.record_upload(copy.journal_path, copy.content_size, copy.hash)
+        self.remove_files(copy.scratch)
+        if copy.delete:
+            self.logger.debug(f'deleting {copy.journal_path}')
+            os.remove(copy.journal_path)
+            self.hash_index.forget(copy.journal_path)
+
+    def remove_files(self, paths):
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def in_cloud(self, cloud_path, entry):
+        """
+        :param cloud_path: where the file would be uploaded to
+        :type cloud_path: str
+        :param entry: the file's entry in the hash index
+        :type entry: journal.HashEntry
+        :return: True if the cloud already holds a file with the same content
+        :rtype: bool
+        """
+        remote = self.storage.stat(cloud_path, with_hash=True)
+        if remote is None or remote['Size'] != entry.size:
+            return False
+        remote_hash = remote.get('Hashes', {}).get(file_utils.CONTENT_HASH_TYPE)
+        if remote_hash is None and entry.remote_size == entry.size:
+            # the backend cannot report hashes, so fall back on the index's record of what we last uploaded there
+            remote_hash = entry.remote_hash
+        return remote_hash == entry.hash
+
+    def write_tail(self, target, entry):
+        """
+        if an append-only file has only grown since it was last uploaded (i.e., the part already in the cloud is
+        unchanged), write the new data to a tail file
+        :param target: path to the file (or a snapshot of it)
+        :type target: str
+        :param entry: the file's entry in the hash index
+        :type entry: journal.HashEntry
+        :return: path to the tail file, or None if the whole file needs uploading
+        :rtype: str
+        """
+        if not entry.remote_size or entry.size <= entry.remote_size:
+            return None
+        if self.hash_index.prefix_hash(target, entry.remote_size, key=entry.path) != entry.remote_hash:
+            return None
+        return file_utils.write_tail(target, entry.remote_size, entry.size)
+
+    def remove_remote_tails(self, cloud_path):
+        """delete the tails of a previous version of an append-only file from the cloud, before the file is replaced
+        with a fresh upload"""
+        cloud_dir, name = posixpath.split(cloud_path)
+        for tail_name in self.remote_listing.listing(cloud_dir):
+            if tail_name.startswith(name + file_utils.TAIL_SUFFIX):
+                self.storage.delete(posixpath.join(cloud_dir, tail_name))
+        self.remote_listing.invalidate(cloud_dir)
+
+    def progress_logger(self, target):
+        """make a progress_fn for RcloneClient.copyfile that logs the progress of an upload every PROGRESS_SECS"""
+        last_log = time.time()
+
+        def log_progress(stats):
+            nonlocal last_log
+            if time.time() - last_log < self.PROGRESS_SECS or not stats.get('totalBytes'):
+                return
+            last_log = time.time()
+            self.logger.debug(f'uploading {os.path.basename(target)}: {stats["bytes"] / 1024 ** 2:.1f} of '
+                              f'{stats["totalBytes"] / 1024 ** 2:.1f} MB at '
+                              f'{stats.get("speed", 0) / 1024 ** 2:.2f} MB/s')
+
+        return log_progress
 
     def h264_to_mp4(self, h264_path):
         """convert a .h264 video to a .mp4 video
@@ -74,6 +303,16 @@ class UploaderWorker(QueueProcWorker):
         prints some debugging information to the log before the process shuts down, especially if there are unprocessed
         items in the upload_list.
         """
+        if self.copied:
+            self.verify_copies()
+        if self.n_retries:
+            self.logger.info(f'scheduled {sum(self.n_retries.values())} upload retries ('
+                             f'{", ".join(f"{n} after {name} errors" for name, n in self.n_retries.items())}). '
+                             f'Journal retry status: {self.journal.retry_stats()}')
+        self.journal.close()
+        self.hash_index.close()
+        self.checkpoint.close()
+        self.storage.close()
         self.event_q.close()
         self.work_q.close()
 
@@ -81,15 +320,121 @@ class UploaderWorker(QueueProcWorker):
 class EndUploaderWorker(UploaderWorker):
     """identical to UploaderWorker, except that it will delete the json file after uploading it"""
 
+    def main_func(self, target, end_of_proj=True):
+        super().main_func(target, end_of_proj)
+
+
+class TrickleUploaderWorker(UploaderWorker):
+    """
+    uploads finished video segments and event clips during active mode, so that they do not pile up until passive mode.
+    Runs as a single process alongside the collector and detector, and keeps out of their way: transfers are capped at
+    TRICKLE_BWLIMIT_KBPS, the process runs at TRICKLE_NICENESS, and uploading is throttled to a crawl whenever the
+    detector falls behind, frames back up in the image queue, or the cpu runs hot
+    """
+    # how often to look for newly finished files
+    SCAN_SECS = 60
+    # files are left alone until they have gone unmodified for this long (or twice the pre-event buffer, if longer),
+    # which skips files that are still being written, and segments that an event clip may still be cut from
+    SETTLE_SECS = 300
+    # how often to check the load on the device
+    LOAD_CHECK_SECS = 5
+    # rclone cannot pause a transfer, so an upload in flight when the device gets busy is slowed to a crawl instead
+    THROTTLED_BWLIMIT = '1k'
+
+    def init_args(self, args):
+        self.work_q, self.storage, self.img_q, self.detect_lag = args
+
+    def startup(self):
+        super().startup()
+        os.nice(self.defs.TRICKLE_NICENESS)
+        self.min_age_secs = max(self.SETTLE_SECS, 2 * self.defs.IMG_BUFFER_SECS)
+        self.bwlimit = f'{self.defs.TRICKLE_BWLIMIT_KBPS}k' if self.defs.TRICKLE_BWLIMIT_KBPS else 'off'
+        if self.storage.set_bwlimit(self.bwlimit) is None:
+            self.logger.info(f'the {self.defs.STORAGE_BACKEND} storage backend cannot limit its bandwidth, so trickle '
+                             f'uploads are limited by load checks alone')
+        self.throttled = False
+        self.last_load_check = 0
+        self.last_scan = 0
+        # this is the only upload worker in active mode, so any claims in the journal were left by an interrupted run
+        self.journal.release_claims()
+
     def main_loop(self):
-        while not self.shutdown_event.is_set():
-            item = self.work_q.safe_get()
-            if not item:
+        """
+        periodically registers newly finished files in the upload journal, then claims and uploads them one at a time
+        for as long as the device has cycles to spare. Runs until shutdown (i.e., the end of active mode) or an END
+        signal
+        """
+        while not self.shutdown_event.is_set() and self.work_q.safe_get() != 'END':
+            if time.time() - self.last_scan >= self.SCAN_SECS:
+                self.scan()
+            if self.check_load():
+                self.shutdown_event.wait(self.LOAD_CHECK_SECS)
                 continue
-            # str_item = str(item)
-            # str_item = str_item if len(str_item) < 10 else str_item[:10] + '...'
-            # self.logger.debug(f"QueueProcWorker.main_loop received '{str_item}' message")
-            if item == "END":
-                break
+            entry = self.journal.claim(self.name, self.class_limits)
+            if entry:
+                self.main_func(entry.path)
+                if len(self.copied) >= self.VERIFY_BATCH_SIZE:
+                    self.verify_copies()
+            elif self.copied:
+                self.verify_copies()
             else:
-                self.main_func(item, True)
+                self.shutdown_event.wait(self.POLL_SECS)
+
+    def scan(self):
+        """add the project's settled mp4s (i.e., completed segments and event clips) to the upload journal"""
+        self.last_scan = time.time()
+        n_added = 0
+        for path in glob.glob(os.path.join(self.defs.PROJ_VID_DIR, '*.mp4')):
+            try:
+                if self.last_scan - os.path.getmtime(path) < self.min_age_secs or path == self.metadata['source']:
+                    continue
+                n_added += self.journal.add(path)
+            except FileNotFoundError:
+                # removed (e.g., renamed by the segment remuxer) since the glob
+                continue
+        if n_added:
+            self.logger.debug(f'queued {n_added} finished videos for trickle upload')
+
+    def check_load(self):
+        """
+        check (at most once every LOAD_CHECK_SECS) whether collection or detection is under strain, and throttle or
+        restore the upload bandwidth accordingly
+        :return: True if uploads are currently throttled
+        :rtype: bool
+        """
+        if time.time() - self.last_load_check < self.LOAD_CHECK_SECS:
+            return self.throttled
+        self.last_load_check = time.time()
+        reason = self.overload_reason()
+        if reason and not self.throttled:
+            self.logger.debug(f'throttling trickle uploads: {reason}')
+            self.storage.set_bwlimit(self.THROTTLED_BWLIMIT)
+        elif not reason and self.throttled:
+            self.logger.debug('resuming trickle uploads')
+            self.storage.set_bwlimit(self.bwlimit)
+        self.throttled = bool(reason)
+        return self.throttled
+
+    def overload_reason(self):
+        """
+        :return: a description of the first load threshold that is exceeded, or None if the device has cycles to spare
+        :rtype: str
+        """
+        if self.detect_lag is not None and self.detect_lag.value > self.defs.TRICKLE_MAX_DETECT_LAG_SECS:
+            return f'detection is running {self.detect_lag.value:.1f}s behind the camera'
+        if self.img_q is not None and self.img_q.qsize() > self.defs.TRICKLE_MAX_QUEUE_DEPTH:
+            return f'{self.img_q.qsize()} frames are waiting for the detector'
+        temp = gen_utils.cpu_temp()
+        if temp is not None and temp > self.defs.TRICKLE_MAX_CPU_TEMP:
+            return f'cpu temperature is {temp:.1f}C'
+        return None
+
+    def progress_logger(self, target):
+        """in addition to logging progress, keep checking the load while an upload is in flight"""
+        log_progress = super().progress_logger(target)
+
+        def log_progress_and_check_load(stats):
+            log_progress(stats)
+            self.check_load()
+
+        return log_progress_and_check_load
@@ -26,3 +26,28 @@ def jpgs_to_mp4(img_paths, dest_dir, fps):
         time.sleep(0.1)
     video.release()
     return vid_path
+
+
+def frames_to_mp4(frames, vid_path, fps):
+    """create a video directly from in-memory frames
+
+    :param frames: BGR images, all the same size. May be a generator, so that frames can be prepared as they are written
+    :type frames: Iterable[np.ndarray]
+    :param vid_path: path for the new video
+    :type vid_path: str
+    :param fps: framerate (frames per second) for the new video
+    :type fps: float
+    :return vid_path: path to newly created video, or None if there were no frames
+    :rtype: str
+    """
+    video = None
+    for frame in frames:
+        if video is None:
+            height, width = frame.shape[:2]
+            fourcc = cv2.VideoWriter_fourcc('m', 'p', '4', 'v')
+            video = cv2.VideoWriter(vid_path, fourcc, fps, (width, height))
+        video.write(frame)
+    if video is None:
+        return None
+    video.release()
+    return vid_path
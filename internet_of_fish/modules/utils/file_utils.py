@@ -1,31 +1,20 @@
 import datetime
+import hashlib
+import logging
 import os
 import pathlib
+import posixpath
+import shutil
 import subprocess as sp
 import json
-from glob import glob
-import tarfile
+import threading
+import time
+from collections import namedtuple
+from concurrent import futures
+from glob import glob, escape as glob_escape
 from internet_of_fish.modules import definitions
 
 
-def tar_directory(dir_path, new_name=None):
-    dir_path = pathlib.Path(dir_path)
-    if not dir_path.exists() or not dir_path.is_dir() or not any(dir_path.iterdir()):
-        return
-    if not new_name:
-        new_name = dir_path.name + '.tar'
-    elif not new_name.endswith('.tar'):
-        new_name = new_name + '.tar'
-    new_name = dir_path / new_name
-    with tarfile.open(new_name, 'w') as tarball:
-        for f in dir_path.iterdir():
-            if f.suffix == '.tar':
-                continue
-            tarball.add(f, arcname=f.name)
-            f.unlink()
-    return new_name
-
-
 def locate_newest_json():
     potential_jsons = glob(os.path.join(definitions.DATA_DIR, '**', '*.json'), recursive=True)
     json_path = sorted(potential_jsons, key=os.path.getctime)[-1]
@@ -59,7 +48,31 @@ def create_project_tree(proj_id, analysis_state):
             os.makedirs(path)
 
 
-def upload(local_path, progress=False):
+def list_local_files(local_path):
+    """
+    :return: [local_path] if local_path is a file, every file beneath it if it is a directory, or [] if it does not
+        exist
+    :rtype: list[str]
+    """
+    if os.path.isfile(local_path):
+        return [local_path]
+    return sorted(f for f in glob(os.path.join(local_path, '**', '*'), recursive=True) if os.path.isfile(f))
+
+
+def upload(local_path, progress=False, backend=None):
+    """
+    upload a file or directory to the corresponding cloud location (see local_to_cloud)
+    :param local_path: path to a local file or directory
+    :type local_path: str
+    :param progress: if True, show rclone's progress output. Ignored if a backend is given
+    :type progress: bool
+    :param backend: if given, upload through this storage backend (see storage.make_backend) rather than the rclone
+        command line
+    :type backend: internet_of_fish.modules.storage.StorageBackend
+    :return: the completed rclone process or, if a backend was given, the error (or None) for each file uploaded
+    """
+    if backend is not None:
+        return backend.put_many([(f, local_to_cloud(f)) for f in list_local_files(local_path)])
     rel = os.path.relpath(local_path, definitions.HOME_DIR)
     cloud_path = str(pathlib.PurePosixPath(definitions.CLOUD_HOME_DIR) / pathlib.PurePath(rel))
     if os.path.isfile(local_path):
@@ -74,8 +87,19 @@ def upload(local_path, progress=False):
     return out
 
 
-def upload_and_delete(local_path, progress=False, delete_jsons=True):
+def upload_and_delete(local_path, progress=False, delete_jsons=True, backend=None):
+    """like upload, but deletes the local copy of each file once it has been uploaded. If delete_jsons is False, json
+    files are skipped entirely"""
     print(f'uploading {os.path.basename(local_path)}')
+    if backend is not None:
+        local_files = [f for f in list_local_files(local_path) if delete_jsons or not f.endswith('.json')]
+        errors = backend.put_many([(f, local_to_cloud(f)) for f in local_files])
+        for f, error in zip(local_files, errors):
+            if error:
+                print(f'failed to upload {os.path.basename(f)} with error {error}')
+            else:
+                os.remove(f)
+        return errors
     rel = os.path.relpath(local_path, definitions.HOME_DIR)
     cloud_path = str(pathlib.PurePosixPath(definitions.CLOUD_HOME_DIR) / pathlib.PurePath(rel))
     cmnd = ['rclone', 'moveto', local_path, cloud_path]
@@ -89,7 +113,9 @@ def upload_and_delete(local_path, progress=False, delete_jsons=True):
     return out
 
 
-def download(cloud_path=None):
+def download(cloud_path=None, backend=None):
+    """download a cloud file or directory to the corresponding local location. If cloud_path is not given, the user
+    is asked for it. If a backend is given, the download goes through it rather than the rclone command line"""
     if not cloud_path:
         rel = input(f'complete the below path stub to indicate the location of the file:'
                            f'\n{definitions.CLOUD_HOME_DIR}/')
@@ -100,12 +126,18 @@ def download(cloud_path=None):
     if not os.path.exists(os.path.dirname(local_path)):
         os.makedirs(os.path.dirname(local_path))
     print('downloading, please wait')
+    if backend is not None:
+        return download_with_backend(cloud_path, local_path, backend)
     if os.path.splitext(local_path)[1]:
-        # if it's a file:
-        out = sp.run(['rclone', 'copy', cloud_path, os.path.dirname(local_path)], capture_output=True, encoding='utf-8')
+        # if it's a file, along with any tails it was uploaded in:
+        name = os.path.basename(cloud_path)
+        out = sp.run(['rclone', 'copy', os.path.dirname(cloud_path), os.path.dirname(local_path), '--include', name,
+                      '--include', name + TAIL_SUFFIX + '*'], capture_output=True, encoding='utf-8')
+        join_tails(local_path)
     else:
         # if it's a directory:
         out = sp.run(['rclone', 'copy', cloud_path, local_path], capture_output=True, encoding='utf-8')
+        join_all_tails(local_path)
     if out.stderr:
         print(f'download error: {out.stderr}')
     else:
@@ -113,24 +145,159 @@ def download(cloud_path=None):
     return out
 
 
-def download_json(proj_id=None, analysis_state=None):
+def download_with_backend(cloud_path, local_path, backend):
+    """download a file or directory through a storage backend (see download)"""
+    try:
+        if os.path.splitext(local_path)[1]:
+            cloud_dir, name = posixpath.split(cloud_path)
+            for item in backend.list(cloud_dir):
+                if item['Name'] == name or item['Name'].startswith(name + TAIL_SUFFIX):
+                    backend.get(posixpath.join(cloud_dir, item['Name']),
+                                os.path.join(os.path.dirname(local_path), item['Name']))
+            join_tails(local_path)
+        else:
+            for item in backend.list(cloud_path, recurse=True):
+                backend.get(posixpath.join(cloud_path, item['Path']), os.path.join(local_path, item['Path']))
+            join_all_tails(local_path)
+    except Exception as e:
+        print(f'download error: {e}')
+        return e
+    print('download complete')
+
+
+def download_json(proj_id=None, analysis_state=None, backend=None):
+    """
+    download the .json file for a project, along with the source video it names (if any). If proj_id is not given, the
+    user is asked for it until they name a project that exists in the cloud
+    :param backend: if given, existence checks and downloads go through this storage backend (e.g., one backed by the
+        rclone daemon, see ui_utils.download_json) rather than one rclone command line process each
+    :type backend: internet_of_fish.modules.storage.StorageBackend
+    :return: path to the downloaded .json file
+    :rtype: str
+    """
     if not proj_id:
         proj_id = input('enter the project id:  ')
         analysis_state = input('enter the analysis state:  ')
-        while not exists_cloud(definitions.PROJ_JSON_FILE(proj_id, analysis_state)):
+        while not exists_cloud(definitions.PROJ_JSON_FILE(proj_id, analysis_state), backend=backend):
             print('invalid project id analysis state pair, please try again')
             proj_id = input('enter the project id:  ')
             analysis_state = input('enter the analysis state:  ')
     local_json_path = definitions.PROJ_JSON_FILE(proj_id, analysis_state)
-    download(local_to_cloud(local_json_path))
+    download(local_to_cloud(local_json_path), backend=backend)
     with open(local_json_path, 'r') as f:
         source = json.load(f)['source']
         if source and source != 'None':
             print(f'json specifies source as {source}. Downloading')
-            download(local_to_cloud(source))
+            download(local_to_cloud(source), backend=backend)
     return local_json_path
 
-def exists_cloud(local_path):
+# files are hashed the way Dropbox hashes them (the sha256 of the concatenated sha256 digests of each 4 MiB block), so
+# that local hashes can be compared directly with the hashes rclone reports for files in the cloud
+CONTENT_HASH_TYPE = 'dropbox'
+CONTENT_HASH_BLOCK_SIZE = 4 * 1024 ** 2
+
+
+def block_hashes(path, start_block=0, n_bytes=None):
+    """
+    compute the sha256 digest of each CONTENT_HASH_BLOCK_SIZE block of a file, reading one block at a time so that
+    large videos are never fully loaded into memory
+    :param path: path to the file
+    :type path: str
+    :param start_block: index of the first block to hash. Earlier blocks are skipped
+    :type start_block: int
+    :param n_bytes: if given, only the first n_bytes of the file are hashed
+    :type n_bytes: int
+    :return: digest of each block, starting from start_block
+    :rtype: list[bytes]
+    """
+    digests = []
+    with open(path, 'rb') as f:
+        f.seek(start_block * CONTENT_HASH_BLOCK_SIZE)
+        remaining = n_bytes - start_block * CONTENT_HASH_BLOCK_SIZE if n_bytes is not None else None
+        while remaining is None or remaining > 0:
+            block = f.read(CONTENT_HASH_BLOCK_SIZE if remaining is None else min(remaining, CONTENT_HASH_BLOCK_SIZE))
+            if not block:
+                break
+            digests.append(hashlib.sha256(block).digest())
+            if remaining is not None:
+                remaining -= len(block)
+    return digests
+
+
+def combine_block_hashes(digests):
+    """:return: the content hash of a file, given the digests of its blocks (see block_hashes)"""
+    return hashlib.sha256(b''.join(digests)).hexdigest()
+
+
+def file_hash(path, n_bytes=None):
+    """
+    compute the content hash of a file (see CONTENT_HASH_TYPE)
+    :param path: path to the file
+    :type path: str
+    :param n_bytes: if given, hash only the first n_bytes of the file
+    :type n_bytes: int
+    :return: hex digest
+    :rtype: str
+    """
+    return combine_block_hashes(block_hashes(path, n_bytes=n_bytes))
+
+
+# appended to the name of a file holding the data appended to an append-only file since its previous upload, followed
+# by the offset at which that data starts (e.g., DETECT.log.tail-1048576)
+TAIL_SUFFIX = '.tail-'
+
+
+def write_tail(path, start, end, tail_path=None):
+    """
+    copy bytes start to end of a file into a tail file next to it (see TAIL_SUFFIX)
+    :param tail_path: if given, the bytes are written here instead
+    :type tail_path: str
+    :return: path to the tail file
+    :rtype: str
+    """
+    tail_path = tail_path if tail_path else f'{path}{TAIL_SUFFIX}{start}'
+    remaining = end - start
+    with open(path, 'rb') as src, open(tail_path, 'wb') as dst:
+        src.seek(start)
+        while remaining > 0:
+            chunk = src.read(min(remaining, 1 << 20))
+            if not chunk:
+                break
+            dst.write(chunk)
+            remaining -= len(chunk)
+    return tail_path
+
+
+def join_tails(path):
+    """
+    rebuild a downloaded append-only file by appending the tail files that were downloaded alongside it, in order. Each
+    tail is joined (and then deleted) only if it starts exactly at the current end of the file. Any others were left
+    over from an older version of the file, and are left in place
+    :param path: path to the downloaded file
+    :type path: str
+    :return: number of tails joined
+    :rtype: int
+    """
+    tails = sorted(glob(glob_escape(path) + TAIL_SUFFIX + '*'), key=lambda t: int(t.rsplit(TAIL_SUFFIX, 1)[1]))
+    n_joined = 0
+    for tail_path in tails:
+        if int(tail_path.rsplit(TAIL_SUFFIX, 1)[1]) != os.path.getsize(path):
+            continue
+        with open(tail_path, 'rb') as src, open(path, 'ab') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(tail_path)
+        n_joined += 1
+    return n_joined
+
+
+def join_all_tails(local_dir):
+    """join the tails of every append-only file beneath a downloaded directory (see join_tails)"""
+    for path in list_local_files(local_dir):
+        if TAIL_SUFFIX not in os.path.basename(path):
+            join_tails(path)
+
+
+def exists_cloud(local_path, backend=None):
     """
     simple helper function that returns True if a file exists on Dropbox, false otherwise. May behave strangely if
     local_path is a directory rather than file. For consistency with other class methods, this function expects
@@ -138,9 +305,13 @@ def exists_cloud(local_path):
     method. It is not, however, necessary for the local file to actually exist for this function to be used.
     :param local_path: path to local file
     :type local_path: str
+    :param backend: if given, check through this storage backend rather than the rclone command line
+    :type backend: internet_of_fish.modules.storage.StorageBackend
     :return: True if local_path exists, false otherwise
     :rtype: bool
     """
+    if backend is not None:
+        return backend.exists(local_to_cloud(local_path))
     cmnd = ['rclone', 'lsf', local_to_cloud(local_path)]
     return sp.run(cmnd, capture_output=True, encoding='utf-8').stdout != ''
 
@@ -169,39 +340,207 @@ def exists_local(local_path):
     return os.path.exists(local_path)
 
 
-def convert_all_h264s_to_mp4(parent_dir, framerate):
+def convert_all_h264s_to_mp4(parent_dir, framerate, max_workers=None):
     """
-    attempts to convert all h264 files in parent_dir to mp4's and delete the h264 if successful
+    attempts to convert all h264 files in parent_dir to mp4's and delete the h264 if successful. Files are converted
+    concurrently, using a ConversionPool
+    :param max_workers: max number of simultaneous conversions. Defaults to the number of cpu cores
+    :type max_workers: int
+    :return: paths to the new mp4 files, and [h264_path, exception] pairs for any failed conversions
+    :rtype: tuple[list[str], list[list]]
     """
     h264_paths = glob(os.path.join(parent_dir, '*.h264'))
     mp4_paths = []
     failed_conversions = []
-    for h264_p in h264_paths:
-        print(f'converting {os.path.basename(h264_p)}')
-        if os.path.getsize(h264_p) < 100:
-            print(f'{os.path.basename(h264_p)} is a fragment. Deleting')
-            os.remove(h264_p)
-            continue
+    pool = ConversionPool(framerate, max_workers)
+    print(f'converting {len(h264_paths)} h264 files using {pool.max_workers} workers')
+    for result in pool.convert_all(h264_paths):
+        if result.error:
+            failed_conversions.append([result.h264_path, result.error])
+        elif result.mp4_path:
+            mp4_paths.append(result.mp4_path)
+            print(f'{os.path.basename(result.h264_path)} converted successfully in {result.secs:.1f} seconds')
+        else:
+            print(f'{os.path.basename(result.h264_path)} is a fragment. Deleted')
+    pool.shutdown()
+    if h264_paths:
+        print(pool.summary())
+    return mp4_paths, failed_conversions
+
+
+ConversionResult = namedtuple('ConversionResult', ['h264_path', 'mp4_path', 'n_bytes', 'secs', 'error'])
+
+
+class ConversionPool:
+
+    def __init__(self, framerate, max_workers=None, niceness=10, ionice_class=3, logger=None):
+        """
+        converts h264 files to mp4 concurrently, using a bounded pool of threads that each drive one ffmpeg process.
+        Since the conversion is a stream copy, each process is largely io-bound, and the ffmpeg processes run at low cpu
+        and io priority so that they yield to anything time-sensitive. The size, conversion time, and throughput of
+        each file are tracked and logged
+        :param framerate: framerate of the h264 files
+        :type framerate: float
+        :param max_workers: max number of simultaneous conversions. Defaults to the number of cpu cores
+        :type max_workers: int
+        :param niceness: niceness increment for the ffmpeg processes
+        :type niceness: int
+        :param ionice_class: io scheduling class for the ffmpeg processes (3 is idle, see man ionice)
+        :type ionice_class: int
+        :param logger: logger to report to
+        :type logger: logging.Logger
+        """
+        self.framerate = framerate
+        self.max_workers = max_workers if max_workers else (os.cpu_count() or 1)
+        self.niceness = niceness
+        self.ionice_class = ionice_class
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.executor = futures.ThreadPoolExecutor(self.max_workers, thread_name_prefix='convert')
+        self.pending = set()
+        self.results = []
+        self.lock = threading.Lock()
+        self.closed = False
+        self.start_time = None
+        self.end_time = None
+
+    def submit(self, h264_path, callback=None):
+        """
+        queue a file for conversion
+        :param h264_path: path to the h264 file
+        :type h264_path: str
+        :param callback: if given, called with the file's ConversionResult as soon as the conversion finishes
+        :type callback: Callable[[ConversionResult], None]
+        :return: future that resolves to the file's ConversionResult
+        :rtype: futures.Future
+        """
+        if self.start_time is None:
+            self.start_time = time.time()
+        future = self.executor.submit(self.convert, h264_path)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self._discard)
+        if callback:
+            future.add_done_callback(lambda f: self._run_callback(callback, f))
+        return future
+
+    def convert_all(self, h264_paths):
+        """
+        convert a batch of files
+        :param h264_paths: paths to the h264 files
+        :type h264_paths: list[str]
+        :return: generator of ConversionResults, in order of completion
+        :rtype: Iterator[ConversionResult]
+        """
+        for future in futures.as_completed([self.submit(path) for path in h264_paths]):
+            yield future.result()
+
+    def after_pending(self, func):
+        """
+        call func (with no arguments) once every conversion submitted so far has finished. Returns immediately. func is
+        not called if the pool is shut down first
+        """
+        with self.lock:
+            pending = list(self.pending)
+
+        def wait_then_call():
+            futures.wait(pending)
+            if not self.closed:
+                func()
+
+        threading.Thread(target=wait_then_call, daemon=True).start()
+
+    def convert(self, h264_path):
+        """convert a single file, returning its ConversionResult. Never raises"""
+        start = time.time()
         try:
-            mp4_p = h264_to_mp4(h264_p, framerate)
-            mp4_paths.append(mp4_p)
-            print(f'{os.path.basename(h264_p)} converted successfully')
+            n_bytes = os.path.getsize(h264_path)
+            if n_bytes < 100:
+                # tiny video fragments (~1 frame long) are occasionally produced, and will choke ffmpeg
+                os.remove(h264_path)
+                result = ConversionResult(h264_path, None, n_bytes, time.time() - start, None)
+            else:
+                mp4_path = h264_to_mp4(h264_path, self.framerate, self.niceness, self.ionice_class)
+                result = ConversionResult(h264_path, mp4_path, n_bytes, time.time() - start, None)
+                self.logger.debug(f'converted {os.path.basename(h264_path)} ({n_bytes / 1024 ** 2:.1f} MB) in '
+                                  f'{result.secs:.1f} seconds ({self.throughput(result):.1f} MB/s)')
         except Exception as e:
-            failed_conversions.append([h264_p, e])
-    return mp4_paths, failed_conversions
+            result = ConversionResult(h264_path, None, 0, time.time() - start, e)
+            self.logger.warning(f'failed to convert {os.path.basename(h264_path)}.\n{e}')
+        with self.lock:
+            self.results.append(result)
+            self.end_time = time.time()
+        return result
+
+    def _discard(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    def _run_callback(self, callback, future):
+        if self.closed or future.cancelled():
+            return
+        try:
+            callback(future.result())
+        except Exception as e:
+            self.logger.warning(f'conversion callback failed with error {e}')
+
+    @staticmethod
+    def throughput(result):
+        """conversion throughput for a single file, in MB/s"""
+        return result.n_bytes / 1024 ** 2 / result.secs if result.secs else 0.0
+
+    def summary(self):
+        """
+        summarize the conversions completed so far
+        :return: human-readable summary
+        :rtype: str
+        """
+        with self.lock:
+            results = list(self.results)
+        converted = [r for r in results if r.mp4_path]
+        n_failed = sum(1 for r in results if r.error)
+        n_mb = sum(r.n_bytes for r in converted) / 1024 ** 2
+        elapsed = self.end_time - self.start_time if self.end_time else 0
+        per_file = sum(r.secs for r in converted) / len(converted) if converted else 0
+        return (f'converted {len(converted)} files ({n_mb:.1f} MB) in {elapsed:.1f} seconds. '
+                f'{per_file:.1f} seconds per file, {n_mb / elapsed if elapsed else 0:.1f} MB/s overall. '
+                f'{n_failed} failed')
+
+    def shutdown(self, wait=True, cancel=False):
+        """
+        stop accepting conversions, and (if wait is True) wait for the accepted ones to finish. If cancel is True,
+        conversions that have not yet started are cancelled, and no further callbacks are made
+        """
+        if cancel:
+            self.closed = True
+            with self.lock:
+                pending = list(self.pending)
+            for future in pending:
+                future.cancel()
+        self.executor.shutdown(wait=wait)
 
 
-def h264_to_mp4(h264_path, framerate):
+def h264_to_mp4(h264_path, framerate, niceness=None, ionice_class=None):
     """convert a .h264 video to a .mp4 video
     :param h264_path: path to h264 file
     :type h264_path: str
+    :param niceness: if given, run ffmpeg at this (lowered) scheduling priority, so that the conversion does not compete
+        with time-sensitive processes
+    :type niceness: int
+    :param ionice_class: if given, run ffmpeg in this io scheduling class (e.g., 3 for idle)
+    :type ionice_class: int
     :return: path to newly-created mp4 file, or None if the conversion failed
     :rtype: str
     """
     mp4_path = h264_path.replace('.h264', '.mp4')
-    command = ['ffmpeg', '-analyzeduration', '100M', '-probesize', '100M', '-r',
-               str(framerate), '-i', h264_path, '-threads', '1', '-c:v', 'copy', '-r',
+    # the video stream is copied rather than re-encoded, so ffmpeg needs little cpu. Parallelism comes from converting
+    # several files at once (see ConversionPool)
+    command = ['ffmpeg', '-y', '-analyzeduration', '100M', '-probesize', '100M', '-r',
+               str(framerate), '-i', h264_path, '-c:v', 'copy', '-r',
                str(framerate), mp4_path]
+    if ionice_class is not None and shutil.which('ionice'):
+        command = ['ionice', '-c', str(ionice_class)] + command
+    if niceness is not None:
+        command = ['nice', '-n', str(niceness)] + command
     out = sp.run(command, capture_output=True, encoding='utf-8')
     if os.path.exists(mp4_path) and (os.path.getsize(mp4_path) > os.path.getsize(h264_path)):
         os.remove(h264_path)
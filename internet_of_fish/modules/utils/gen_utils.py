@@ -220,6 +220,19 @@ def get_ip():
     return IP
 
 
+def cpu_temp():
+    """
+    read the cpu temperature from the kernel's thermal interface
+    :return: cpu temperature in degrees C, or None if it could not be read (e.g., on a machine with no thermal zones)
+    :rtype: float
+    """
+    try:
+        with open('/sys/class/thermal/thermal_zone0/temp') as f:
+            return int(f.read()) / 1000
+    except (OSError, ValueError):
+        return None
+
+
 def strfmt_func_call(fname, *args, **kwargs):
     arg_str = [str(arg) for arg in args]
     arg_str = [arg[:10] + '...' if len(arg) > 10 else arg for arg in arg_str]
@@ -3,6 +3,9 @@ import os
 
 from internet_of_fish.modules.utils import file_utils
 from internet_of_fish.modules import definitions
+from internet_of_fish.modules import journal
+from internet_of_fish.modules import rclone
+from internet_of_fish.modules import storage
 from internet_of_fish.modules import metadata
 from internet_of_fish.modules import runner
 from internet_of_fish.modules.utils import gen_utils
@@ -13,6 +16,7 @@ import shutil
 import time
 import subprocess as sp
 import platform
+import tempfile
 from glob import glob
 
 def check_running_in_screen():
@@ -145,6 +149,97 @@ def inject_override(event_type: str):
             pass
 
 
+def get_upload_journal_summary():
+    if not os.path.exists(definitions.UPLOAD_JOURNAL_FILE):
+        return {}
+    upload_journal = journal.UploadJournal()
+    summary = upload_journal.counts()
+    summary.update({f'{key} ({error_class} errors)': n for key, counts in upload_journal.retry_stats().items()
+                    for error_class, n in counts.items()})
+    next_retry = upload_journal.next_retry()
+    if next_retry is not None:
+        summary['next retry'] = dt.datetime.fromtimestamp(next_retry).isoformat(timespec='seconds')
+    upload_journal.close()
+    return summary
+
+
+def benchmark_storage_backends(n_files=4, file_mb=16):
+    """upload the same set of scratch files through each available storage backend and print the throughput of each.
+    The rclone backend uploads to a scratch directory on the real remote, and the local and s3 backends are included if
+    the user names a directory or bucket to test against. The scratch files are deleted from each backend afterwards"""
+    local_dir = input('directory to benchmark the local backend against (leave blank to skip):  ').strip()
+    bucket = input('s3 bucket to benchmark (leave blank to skip):  ').strip()
+    endpoint_url = input('s3 endpoint url (leave blank for AWS):  ').strip() if bucket else ''
+    backends = {}
+    daemon = None
+    if shutil.which('rclone'):
+        daemon = rclone.RcloneDaemon()
+        daemon.start()
+        backends['rclone'] = storage.make_backend('rclone', client=daemon.client())
+    if local_dir:
+        backends['local'] = storage.make_backend('local', root_dir=local_dir)
+    if bucket:
+        backends['s3'] = storage.make_backend('s3', bucket=bucket, endpoint_url=endpoint_url or None)
+    if not backends:
+        print('no storage backends to benchmark')
+        return
+    print(f'uploading {n_files} files of {file_mb}MB through {", ".join(backends)}. Please wait')
+    cloud_dir = file_utils.local_to_cloud(os.path.join(definitions.HOME_DIR, 'CichlidPiData', '__Benchmark'))
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            local_paths = [os.path.join(tmp_dir, f'{i}.bin') for i in range(n_files)]
+            for path in local_paths:
+                with open(path, 'wb') as f:
+                    f.write(os.urandom(file_mb * 1024 ** 2))
+            results = storage.benchmark(backends, local_paths, cloud_dir)
+    finally:
+        for backend in backends.values():
+            backend.close()
+        if daemon:
+            daemon.stop()
+    for result in results:
+        print(f'{result.backend}: {result.n_bytes / 1024 ** 2:.0f}MB in {result.secs:.1f}s '
+              f'({result.n_bytes / 1024 ** 2 / result.secs:.2f}MB/s), {result.n_errors} errors')
+
+
+def download_json(proj_id=None, analysis_state=None):
+    """download a project's .json file (and its source video) through a temporary rclone daemon, so that checking
+    each project id the user enters is a request to the daemon rather than a new rclone process (see
+    file_utils.download_json)"""
+    if not shutil.which('rclone'):
+        return file_utils.download_json(proj_id, analysis_state)
+    daemon = rclone.RcloneDaemon()
+    daemon.start()
+    backend = storage.make_backend('rclone', client=daemon.client())
+    try:
+        return file_utils.download_json(proj_id, analysis_state, backend=backend)
+    finally:
+        backend.close()
+        daemon.stop()
+
+
+def print_upload_journal_entries(state=None):
+    if not os.path.exists(definitions.UPLOAD_JOURNAL_FILE):
+        print('no uploads have been recorded on this device')
+        return
+    if state is None:
+        state = gen_utils.finput('enter the upload state to view', options=journal.STATES)
+    upload_journal = journal.UploadJournal()
+    entries = upload_journal.entries(state)
+    upload_journal.close()
+    if not entries:
+        print(f'no {state} uploads')
+    for entry in entries:
+        updated = dt.datetime.fromtimestamp(entry.updated).isoformat(timespec='seconds')
+        retry = ''
+        if entry.state == journal.PENDING and entry.next_attempt:
+            retry = f', next retry at {dt.datetime.fromtimestamp(entry.next_attempt).isoformat(timespec="seconds")}'
+        print(f'{os.path.relpath(entry.path, definitions.HOME_DIR)} ({entry.upload_class}): {entry.attempts} failed '
+              f'attempts, last updated '
+              f'{updated}{retry}' + (f'\n\tlast error ({entry.error_class}): {entry.last_error.strip()}'
+                                     if entry.last_error else ''))
+
+
 def clear_logs():
     for log in glob(os.path.join(definitions.LOG_DIR, '*.log*')):
         os.remove(log)
@@ -157,7 +157,7 @@ class UI:
         utils_menu.update(Opt('pause the currently running project without exiting', ui_utils.pause_project))
         utils_menu.update(Opt('download a file or directory from dropbox', file_utils.download))
         utils_menu.update(Opt('download the .json file for a particular project, and "source" if specified',
-                              file_utils.download_json))
+                              ui_utils.download_json))
         utils_menu.update(Opt('clear the log files', ui_utils.clear_logs))
         utils_menu.update(Opt('capture and upload a short video clip', self.quick_clip))
 
@@ -166,6 +166,12 @@ class UI:
         upload_menu.update(Opt('upload all data from this device and delete local copies, but keep .json files', self.upload_data, delete_jsons=False))
         upload_menu.update(Opt('upload data from a specific project and delete local copies', self.upload_data, delete_jsons=False, query_user=True))
         upload_menu.update(Opt('upload data from a specific project and delete local copies, but keep.json files', self.upload_data, delete_jsons=False, query_user=True))
+        upload_menu.update(Opt('view a summary of the upload journal', gen_utils.dict_print,
+                               ui_utils.get_upload_journal_summary))
+        upload_menu.update(Opt('view failed uploads', ui_utils.print_upload_journal_entries, 'failed'))
+        upload_menu.update(Opt('view uploads in a particular state', ui_utils.print_upload_journal_entries))
+        upload_menu.update(Opt('benchmark upload throughput of the storage backends',
+                               ui_utils.benchmark_storage_backends))
 
         main_menu = OptDict(stepout_opt=False)
         main_menu.update(Opt('exit the application', self.goodbye))
@@ -209,7 +215,7 @@ class UI:
             return
         self.main_ctx = mptools.MainContext(metadata.MetaDataHandler(new_proj=False).simplify())
         if self.main_ctx.metadata['source']:
-            file_utils.download_json(self.main_ctx.metadata['proj_id'], self.main_ctx.metadata['analysis_state'])
+            ui_utils.download_json(self.main_ctx.metadata['proj_id'], self.main_ctx.metadata['analysis_state'])
         mptools.init_signals(self.main_ctx.shutdown_event, mptools.default_signal_handler, mptools.default_signal_handler)
         self.main_ctx.Proc('RUN', runner.RunnerWorker, self.main_ctx)
         print(f'{self.main_ctx.metadata["proj_id"]} is now running in the background')
@@ -0,0 +1,128 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+import context
+from internet_of_fish.modules import archiver
+from internet_of_fish.modules import storage
+
+
+@pytest.fixture
+def anno_files(tmp_path):
+    anno_dir = tmp_path / 'anno'
+    anno_dir.mkdir()
+    paths = []
+    for i in range(6):
+        path = anno_dir / f'{i}.jpg'
+        path.write_bytes(os.urandom(50000))
+        paths.append(str(path))
+    return paths
+
+
+def read_archives(backend, cloud_dir, tmp_path):
+    members = {}
+    for item in sorted(backend.list(cloud_dir), key=lambda item: item['Name']):
+        local_path = str(tmp_path / 'download' / item['Name'])
+        backend.get(f'{cloud_dir}/{item["Name"]}', local_path)
+        with tarfile.open(local_path) as tar:
+            members.update({member.name: tar.extractfile(member).read() for member in tar.getmembers()})
+    return members
+
+
+class BrokenStreamBackend(storage.LocalBackend):
+
+    def __init__(self, root_dir, read_all):
+        """local backend whose streamed uploads fail, either straight away, or after reading the whole stream"""
+        super().__init__(root_dir)
+        self.read_all = read_all
+
+    def put_stream(self, fileobj, cloud_path, shutdown_event=None):
+        if self.read_all:
+            fileobj.read()
+        raise storage.StorageError('connection reset by peer')
+
+
+def test_archives_are_split_and_files_deleted(anno_files, tmp_path):
+    backend = storage.LocalBackend(str(tmp_path / 'remote'))
+    contents = {os.path.basename(path): open(path, 'rb').read() for path in anno_files}
+    archivers = [(archiver.ArchiveSource('annotations_', os.path.join(os.path.dirname(anno_files[0]), '*'),
+                                         'cichlidVideo:proj/Annotations', False),
+                  archiver.StreamingArchiver(backend, 'cichlidVideo:proj/Annotations', 'annotations_', 'gzip',
+                                             max_bytes=120000))]
+    assert archiver.archive_files(archivers) == 6
+    archivers[0][1].close()
+    # random data does not compress, so each archive fits two files
+    names = [item['Name'] for item in backend.list('cichlidVideo:proj/Annotations')]
+    assert len(names) == 3 and all(name.startswith('annotations_') and name.endswith('.tar.gz') for name in names)
+    assert all(item['Size'] <= 120000 for item in backend.list('cichlidVideo:proj/Annotations'))
+    assert read_archives(backend, 'cichlidVideo:proj/Annotations', tmp_path) == contents
+    assert not any(os.path.exists(path) for path in anno_files)
+    assert archivers[0][1].n_files == 6 and archivers[0][1].n_archives == 3
+
+
+def test_failed_archive_keeps_files(anno_files, tmp_path):
+    # the upload fails before the archive is finished, so adding a file too big to fit in the pipe's buffer fails
+    big_path = tmp_path / 'anno' / 'big.jpg'
+    big_path.write_bytes(os.urandom(1 << 20))
+    backend = BrokenStreamBackend(str(tmp_path / 'remote'), read_all=False)
+    stream_archiver = archiver.StreamingArchiver(backend, 'cichlidVideo:proj/Annotations', compression='gzip')
+    assert not stream_archiver.add(str(big_path))
+    assert stream_archiver.close()
+    # the upload fails once the whole archive has been sent, so the files are added, but the archive is not finished
+    backend = BrokenStreamBackend(str(tmp_path / 'remote'), read_all=True)
+    stream_archiver = archiver.StreamingArchiver(backend, 'cichlidVideo:proj/Annotations', compression='gzip')
+    assert all(stream_archiver.add(path) for path in anno_files)
+    assert not stream_archiver.close()
+    assert big_path.exists() and all(os.path.exists(path) for path in anno_files)
+    assert stream_archiver.n_files == 0 and not stream_archiver.pending
+    assert backend.list('cichlidVideo:proj/Annotations') == []
+
+
+def test_changed_files_are_kept(anno_files, tmp_path):
+    backend = storage.LocalBackend(str(tmp_path / 'remote'))
+    stream_archiver = archiver.StreamingArchiver(backend, 'cichlidVideo:proj/Logs', compression='gzip')
+    assert stream_archiver.add(anno_files[0], 'a.log.1') and stream_archiver.add(anno_files[1])
+    assert stream_archiver.pending == set(anno_files[:2])
+    with open(anno_files[1], 'ab') as f:
+        f.write(b'more')
+    assert stream_archiver.close()
+    assert not os.path.exists(anno_files[0]) and os.path.exists(anno_files[1])
+    assert sorted(read_archives(backend, 'cichlidVideo:proj/Logs', tmp_path)) == ['1.jpg', 'a.log.1']
+
+
+def test_zstd_archive(anno_files, tmp_path):
+    zstandard = pytest.importorskip('zstandard')
+    backend = storage.LocalBackend(str(tmp_path / 'remote'))
+    stream_archiver = archiver.StreamingArchiver(backend, 'cichlidVideo:proj/Annotations', compression='zstd')
+    assert stream_archiver.add(anno_files[0]) and stream_archiver.close()
+    item, = backend.list('cichlidVideo:proj/Annotations')
+    assert item['Name'].endswith('.tar.zst')
+    with open(backend.local_path(f'cichlidVideo:proj/Annotations/{item["Name"]}'), 'rb') as f:
+        data = zstandard.ZstdDecompressor().stream_reader(f).read()
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        assert tar.getnames() == ['0.jpg']
+
+
+def test_rotated_logs_are_archived_once(tmp_path):
+    log_dir = tmp_path / 'logs'
+    log_dir.mkdir()
+    (log_dir / 'RUNNER.log.1').write_text('first rotation\n' * 100)
+    backend = storage.LocalBackend(str(tmp_path / 'remote'))
+    archivers = [(archiver.ArchiveSource('logs_', str(log_dir / '*.log.*'), 'cichlidVideo:proj/Logs', True),
+                  archiver.StreamingArchiver(backend, 'cichlidVideo:proj/Logs', 'logs_', 'gzip'))]
+    assert archiver.archive_files(archivers) == 1
+    # the log rolls over while its archive is still open, so the file that was added is renamed before it can be
+    # deleted, and a new log takes its old name
+    (log_dir / 'RUNNER.log.1').rename(log_dir / 'RUNNER.log.2')
+    (log_dir / 'RUNNER.log.1').write_text('second rotation\n' * 200)
+    assert archiver.archive_files(archivers) == 1
+    assert archivers[0][1].close()
+    assert os.listdir(log_dir) == ['RUNNER.log.2']
+    # the renamed log is recognized by its content, and deleted rather than archived again
+    assert archiver.archive_files(archivers) == 0
+    assert os.listdir(log_dir) == []
+    members = read_archives(backend, 'cichlidVideo:proj/Logs', tmp_path)
+    assert sorted(members.values()) == [b'first rotation\n' * 100, b'second rotation\n' * 200]
+    assert all(name.startswith('RUNNER.log.') and len(name) == len('RUNNER.log.') + 16 for name in members)
@@ -0,0 +1,204 @@
+import os
+import shutil
+import sys
+import time
+import types
+
+import numpy as np
+import pytest
+
+import context
+
+cv2 = pytest.importorskip('cv2')
+try:
+    import picamera
+except ImportError:
+    # collector.py imports picamera at module level, but the code under test only needs its exception type, so stand
+    # in for it off the Pi. Cameras are always faked below
+    picamera = types.ModuleType('picamera')
+    picamera.PiCamera = None
+    picamera.PiCameraError = type('PiCameraError', (Exception,), {})
+    sys.modules['picamera'] = picamera
+from internet_of_fish.modules import collector, recording
+
+
+@pytest.fixture
+def video_file(tmp_path):
+    # 30 frames at 10 fps, where the brightness of each frame encodes its index
+    path = str(tmp_path / 'source.avi')
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 10, (64, 48))
+    for i in range(30):
+        writer.write(np.full((48, 64, 3), i * 8, np.uint8))
+    writer.release()
+    return path
+
+
+def read_all(sampler):
+    frames = []
+    while True:
+        ret, img = sampler.read()
+        if not ret:
+            break
+        frames.append((int(round(img.mean() / 8)), sampler.pos_msec))
+    sampler.release()
+    return frames
+
+
+@pytest.mark.parametrize('strategy', ['grab', 'seek', 'ffmpeg'])
+def test_frame_sampler_strategies(video_file, strategy):
+    if strategy == 'ffmpeg' and shutil.which('ffmpeg') is None:
+        pytest.skip('ffmpeg is not installed')
+    sampler = collector.FrameSampler(video_file, 0.5, strategy)
+    assert (sampler.resolution, sampler.framerate, sampler.cap_rate) == ((64, 48), 10, 5)
+    frames = read_all(sampler)
+    assert [index for index, _ in frames] == [0, 5, 10, 15, 20, 25]
+    assert [pos_msec for _, pos_msec in frames] == pytest.approx([0, 500, 1000, 1500, 2000, 2500], abs=1)
+    assert sampler.sampled_count == 6
+
+
+def test_frame_sampler_falls_back_when_ffmpeg_fails(video_file, tmp_path, monkeypatch, caplog):
+    # an ffmpeg that writes two (blank) sampled frames, then fails the way an unsupported option or a decode error would
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    fake_ffmpeg = bin_dir / 'ffmpeg'
+    write_frames = 'import sys; sys.stdout.buffer.write(bytes(2 * 64 * 48 * 3))'
+    fake_ffmpeg.write_text(f'#!/bin/sh\n{sys.executable} -c "{write_frames}"\n'
+                           f'echo "Error while decoding stream" >&2\nexit 1\n')
+    fake_ffmpeg.chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_dir), prepend=os.pathsep)
+    sampler = collector.FrameSampler(video_file, 0.5)
+    assert sampler.strategy == 'ffmpeg'
+    frames = read_all(sampler)
+    # the grab strategy picks up from the frame where ffmpeg stopped, rather than ending the video early
+    assert [index for index, _ in frames] == [0, 0, 10, 15, 20, 25]
+    assert [pos_msec for _, pos_msec in frames] == pytest.approx([0, 500, 1000, 1500, 2000, 2500], abs=1)
+    assert sampler.strategy == 'grab' and 'Error while decoding stream' in caplog.text
+
+
+def test_frame_sampler_strategy_choice(video_file):
+    assert collector.FrameSampler(video_file, 0.1).strategy == 'grab'
+    assert collector.FrameSampler(video_file, 20).strategy == 'seek'
+    sampler = collector.FrameSampler(video_file, 0.5, 'grab')
+    # containers that do not report a framerate fall back to the frame index, rather than dividing by zero
+    sampler.framerate = 0
+    assert sampler.frame_msec(15) == 15.0
+
+
+class FakeFrame:
+
+    def __init__(self, index, position):
+        self.index = index
+        self.position = position
+
+
+class FakeCamera:
+
+    def __init__(self, split_delay=0):
+        """stand-in for picamera.PiCamera's recording api, where each call to write_frames appends frames to the
+        current segment. Like picamera, a split waits for the next keyframe, which arrives split_delay frames after it
+        is requested, and returns once that keyframe is written to the new segment"""
+        self.path = None
+        self.frame = None
+        self.n_frames = 0
+        self.key_frame_requested = False
+        self.split_delay = split_delay
+        self.frame_bytes = 200
+
+    def start_recording(self, path):
+        self.path = path
+        open(path, 'wb').close()
+
+    def write_frames(self, n):
+        with open(self.path, 'ab') as f:
+            for _ in range(n):
+                self.frame = FakeFrame(self.n_frames, f.tell())
+                f.write(b'\x00' * self.frame_bytes)
+                self.n_frames += 1
+
+    def request_key_frame(self):
+        self.key_frame_requested = True
+
+    def split_recording(self, path):
+        assert self.key_frame_requested
+        self.key_frame_requested = False
+        self.write_frames(self.split_delay)
+        self.start_recording(path)
+        self.write_frames(1)
+
+    def stop_recording(self):
+        self.path = None
+
+
+UNREMUXABLE = ['3.h264']
+
+
+class NumberedSegmentManager(collector.SegmentManager):
+    # segments are named by the second they start in, so number them instead to allow several splits per second
+    n_segments = 0
+
+    def generate_vid_path(self):
+        self.n_segments += 1
+        return os.path.join(self.vid_dir, f'{self.n_segments}.h264')
+
+
+def fake_remux(h264_path, framerate, niceness=None):
+    if os.path.basename(h264_path) in UNREMUXABLE:
+        raise Exception('invalid data found when processing input')
+    mp4_path = h264_path.replace('.h264', '.mp4')
+    os.rename(h264_path, mp4_path)
+    return mp4_path
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_segment_manager(tmp_path, monkeypatch):
+    # the real remux needs ffmpeg, which the camera's raw stream would otherwise be handed to
+    monkeypatch.setattr(collector.file_utils, 'h264_to_mp4', fake_remux)
+    cam = FakeCamera(split_delay=2)
+    manager = NumberedSegmentManager(cam, str(tmp_path), 10, max_bytes=1000)
+    manager.start()
+    cam.write_frames(3)
+    manager.update(manager.last_mark + manager.MARK_INTERVAL_MS)
+    assert manager.vid_path.endswith('1.h264')
+    # segments are split once they reach max_bytes, at the keyframe that follows, and remuxed in the background
+    cam.write_frames(3)
+    cam.frame_bytes = 50
+    manager.update(manager.last_mark)
+    assert manager.vid_path.endswith('2.h264')
+    wait_for(lambda: os.path.exists(tmp_path / '1.mp4'))
+    # tiny fragments are dropped, and segments that fail to remux are kept as .h264
+    cam.split_delay = 0
+    manager.split()
+    cam.frame_bytes = 200
+    cam.split_delay = 2
+    cam.write_frames(6)
+    manager.update(manager.last_mark)
+    wait_for(lambda: manager.remux_q.empty() and not os.path.exists(tmp_path / '2.h264'))
+    cam.write_frames(1)
+    manager.stop()
+    assert not manager.remux_thread.is_alive()
+    assert sorted(os.listdir(tmp_path)) == ['1.mp4', '3.h264', '4.h264', 'segments.jsonl']
+    segments = manager.segment_index.segments()
+    assert [(os.path.basename(seg.path), seg.start_frame, seg.end_frame) for seg in segments] == \
+           [('1.mp4', 0, 7), ('3.h264', 9, 17), ('4.h264', 18, 19)]
+    assert segments[0].marks == [recording.Mark(segments[0].start_ms + manager.MARK_INTERVAL_MS, 400, 2)]
+    assert all(seg.end_ms is not None for seg in segments)
+
+
+def test_segment_manager_splits_on_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(collector.file_utils, 'h264_to_mp4', fake_remux)
+    cam = FakeCamera()
+    manager = NumberedSegmentManager(cam, str(tmp_path), 10, max_secs=0.05)
+    manager.start()
+    cam.write_frames(1)
+    manager.update(manager.last_mark)
+    assert manager.vid_path.endswith('1.h264')
+    time.sleep(0.06)
+    manager.update(manager.last_mark)
+    assert manager.vid_path.endswith('2.h264')
+    manager.stop()
@@ -0,0 +1,193 @@
+import logging
+
+import cv2
+import numpy as np
+import pytest
+
+import context
+from internet_of_fish.modules import detector, inference
+
+
+def noise(seed, shape=(120, 160, 3)):
+    return np.random.default_rng(seed).integers(0, 255, shape, dtype=np.uint8)
+
+
+def test_motion_gate():
+    gate = detector.MotionGate(threshold=5, max_skip=3)
+    static = noise(0)
+    # the first frame sets the background, so it always runs
+    assert gate.check(static) and gate.last_score is None
+    # a static scene is skipped, but never for more than max_skip frames in a row
+    assert [gate.check(static) for _ in range(5)] == [False, False, False, True, False]
+    assert gate.last_score == 0
+    assert gate.check(noise(1)) and gate.last_score > 5
+    gate.reset()
+    assert gate.check(static) and gate.n_skipped == 0
+    # a threshold of 0 disables the gate
+    disabled = detector.MotionGate(threshold=0)
+    assert all(disabled.check(static) for _ in range(3))
+
+
+def test_fish_tracker_association():
+    tracker = detector.FishTracker(detect_every=3, min_hits=2, max_missed=1)
+    gray = noise(0)[..., 0]
+    # the tracker starts stale, so the first frame is detected, then every third frame
+    assert [tracker.schedule_detection() for _ in range(7)] == [True, False, False, True, False, False, True]
+    tracker.update(inference.Detections([[10, 10, 30, 30], [60, 60, 80, 80]], [0.9, 0.8]), gray)
+    assert [t.id for t in tracker.tracks] == [0, 1] and tracker.stable_count() == 0
+    # an overlapping box is matched by IoU, and a fast fish whose box no longer overlaps by centroid distance
+    tracker.update(inference.Detections([[62, 62, 82, 82], [22, 10, 42, 30]], [0.7, 0.6]), gray)
+    assert [(t.id, t.hits) for t in tracker.tracks] == [(0, 2), (1, 2)] and tracker.stable_count() == 2
+    assert tracker.detections().boxes.tolist() == [[22, 10, 42, 30], [62, 62, 82, 82]]
+    # unmatched detections start new tracks, and tracks that go unmatched too often are dropped
+    tracker.update(inference.Detections([[100, 20, 120, 40]], [0.9]), gray)
+    assert [(t.id, t.missed) for t in tracker.tracks] == [(0, 1), (1, 1), (2, 0)]
+    tracker.update(inference.Detections(), gray)
+    assert [t.id for t in tracker.tracks] == [2]
+    tracker.reset()
+    assert len(tracker.detections()) == 0 and tracker.schedule_detection()
+
+
+def test_fish_tracker_optical_flow():
+    tracker = detector.FishTracker(detect_every=10)
+    background = cv2.GaussianBlur(noise(0)[..., 0], (5, 5), 0)
+    tracker.schedule_detection()
+    tracker.update(inference.Detections([[40, 40, 80, 80]], [0.9]), background)
+    # the whole scene shifts 3 pixels right and 2 down, and the track follows it without a fresh detection
+    shifted = np.roll(background, (2, 3), axis=(0, 1))
+    tracker.propagate(shifted)
+    assert not tracker.stale
+    assert tracker.tracks[0].box == pytest.approx([43, 42, 83, 82], abs=0.5)
+    assert not tracker.schedule_detection()
+    # a frame of a different size cannot be tracked, so the next frame gets a fresh detection
+    tracker.propagate(shifted[:60])
+    assert tracker.stale and tracker.schedule_detection()
+
+
+def test_pipe_locator():
+    results = [inference.Detections([[20, 10, 120, 90], [0, 0, 10, 10]], [0.9, 0.4])]
+    locator = detector.PipeLocator(lambda img: results[-1], logging.getLogger('test'), niceness=0)
+    try:
+        assert locator.wants_frame()
+        # the background thread publishes the first location straight away
+        locator.submit(noise(0))
+        roi = locator.wait_for_roi(timeout=5)
+        assert roi == detector.PipeROI((20, 10, 120, 90), pytest.approx(0.9), [50.0, 40.0], 40.0)
+        locator.stop()
+        # then asks for another frame to confirm it, and only publishes a moved pipe once two localizations agree
+        assert locator.requested
+        locator.requested = False
+        locator.localize(None)
+        assert locator.roi is roi and not locator.requested
+        results.append(inference.Detections([[30, 10, 130, 90]], [0.8]))
+        locator.localize(None)
+        assert locator.roi is roi and locator.requested
+        locator.localize(None)
+        assert locator.roi.box == (30, 10, 130, 90)
+        # the last good location is kept while the pipe cannot be found
+        results.append(inference.Detections())
+        locator.localize(None)
+        assert locator.roi.box == (30, 10, 130, 90) and locator.requested
+    finally:
+        locator.stop()
+
+
+def test_frame_buffer_raw():
+    frame_bytes = 48 * 64 * 3
+    buffer = detector.FrameBuffer(capacity=10, max_bytes=3 * frame_bytes)
+    dets = inference.Detections()
+    for i in range(5):
+        buffer.append(i, noise(i, (48, 64, 3)), dets)
+    # the memory budget only fits 3 frames, so the oldest are overwritten
+    assert buffer.full and len(buffer) == 3 and buffer.nbytes == 3 * frame_bytes
+    entries = buffer.drain()
+    assert [be.cap_time for be in entries] == [2, 3, 4]
+    assert np.array_equal(entries[0].img, noise(2, (48, 64, 3)))
+    assert len(buffer) == 0 and not buffer.full
+    # smaller crops share the preallocated slots, and larger ones reallocate them
+    buffer.append(5, noise(5, (40, 60, 3)), dets)
+    assert buffer.drain()[0].img.shape == (40, 60, 3)
+    buffer.append(6, noise(0, (48, 64, 3)), dets)
+    buffer.append(7, noise(7, (60, 80, 3)), dets)
+    assert [be.cap_time for be in buffer.drain()] == [7] and buffer.n_slots == 1
+
+
+def test_frame_buffer_jpeg():
+    buffer = detector.FrameBuffer(capacity=4, max_bytes=10 ** 6, mode='jpeg')
+    flat = np.full((48, 64, 3), 100, np.uint8)
+    for i in range(6):
+        buffer.append(i, flat, inference.Detections())
+    assert len(buffer) == 4 and buffer.full and not buffer.evicted
+    entries = buffer.drain()
+    assert [be.cap_time for be in entries] == [2, 3, 4, 5]
+    img = cv2.imdecode(np.frombuffer(entries[0].img, np.uint8), cv2.IMREAD_COLOR)
+    assert img.shape == (48, 64, 3) and abs(int(img.mean()) - 100) <= 2
+    # noisy frames compress poorly, so the oldest are evicted to stay within the budget
+    frame_size = len(cv2.imencode('.jpg', noise(0, (48, 64, 3)))[1])
+    buffer = detector.FrameBuffer(capacity=10, max_bytes=int(2.5 * frame_size), mode='jpeg')
+    for i in range(4):
+        buffer.append(i, noise(i, (48, 64, 3)), inference.Detections())
+    assert buffer.evicted and buffer.full and 1 < len(buffer) < 4 and buffer.nbytes <= buffer.max_bytes
+    with pytest.raises(ValueError):
+        detector.FrameBuffer(4, 10 ** 6, mode='png')
+
+
+class FakeSegmentIndex:
+
+    def __init__(self, fail):
+        self.fail = fail
+        self.cuts = []
+
+    def cut_clip(self, start, end, vid_path):
+        self.cuts.append((start, end))
+        if self.fail:
+            raise OSError('recording is gone')
+        return vid_path.replace('.mp4', '_cut.mp4')
+
+
+def clip_request(time_range=None):
+    dets = inference.Detections([[4, 4, 20, 20]], [0.9])
+    entries = [detector.BufferEntry(1000 + i, noise(i, (48, 64, 3)), dets) for i in range(4)]
+    # the pipe moved partway through, and one frame was buffered as jpeg bytes
+    entries[2] = detector.BufferEntry(1002, noise(2, (50, 66, 3)), dets)
+    entries[3] = detector.BufferEntry(1003, cv2.imencode('.jpg', noise(3, (48, 64, 3)))[1].tobytes(), dets)
+    return detector.ClipRequest(entries, [32, 24], 20, 10, 'fish detected', time_range)
+
+
+def test_clip_builder(tmp_path):
+    notified = []
+    builder = detector.ClipBuilder(str(tmp_path), lambda msg, vid_path: notified.append((msg, vid_path)),
+                                   logging.getLogger('test'))
+    builder.submit(clip_request())
+    builder.stop()
+    assert not builder.thread.is_alive()
+    assert notified == [('fish detected', str(tmp_path / '1000_event.mp4'))]
+    # frames are resized to match the first, since the encoder needs a fixed frame size
+    cap = cv2.VideoCapture(notified[0][1])
+    assert cap.get(cv2.CAP_PROP_FRAME_COUNT) == 4
+    assert (cap.get(cv2.CAP_PROP_FRAME_WIDTH), cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) == (64, 48)
+    cap.release()
+    # a clip that fails to build is logged and skipped, without stopping the builder
+    notified.clear()
+    builder = detector.ClipBuilder(str(tmp_path), lambda msg, vid_path: notified.append((msg, vid_path)),
+                                   logging.getLogger('test'))
+    builder.submit(detector.ClipRequest([], [0, 0], 0, 10, 'empty', None))
+    builder.submit(clip_request())
+    builder.stop()
+    assert [msg for msg, _ in notified] == ['fish detected']
+
+
+@pytest.mark.parametrize('fail', [False, True])
+def test_clip_builder_cuts_from_recording(tmp_path, fail):
+    notified = []
+    segment_index = FakeSegmentIndex(fail)
+    builder = detector.ClipBuilder(str(tmp_path), lambda msg, vid_path: notified.append((msg, vid_path)),
+                                   logging.getLogger('test'), segment_index=segment_index)
+    builder.submit(clip_request(time_range=(1000, 1003)))
+    # requests without a time range always use the buffered frames
+    builder.submit(clip_request())
+    builder.stop()
+    assert segment_index.cuts == [(1000, 1003)]
+    # clips fall back to the buffered frames if the recording cannot be cut
+    first_clip = '1000_event.mp4' if fail else '1000_event_cut.mp4'
+    assert [vid_path for _, vid_path in notified] == [str(tmp_path / first_clip), str(tmp_path / '1000_event.mp4')]
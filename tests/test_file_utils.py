@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+
+import context
+from internet_of_fish.modules.utils import file_utils
+
+
+class FakeRemux:
+
+    def __init__(self, fail_names=(), gate=None):
+        """
+        stand-in for file_utils.h264_to_mp4 that renames the h264 file instead of running ffmpeg, and records how many
+        conversions ran at once. If gate is given, each conversion waits for it to be set before finishing
+        """
+        self.fail_names = fail_names
+        self.gate = gate
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, h264_path, framerate, niceness=None, ionice_class=None):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            if self.gate:
+                assert self.gate.wait(5)
+            if os.path.basename(h264_path) in self.fail_names:
+                raise Exception('invalid data found when processing input')
+            mp4_path = h264_path.replace('.h264', '.mp4')
+            os.rename(h264_path, mp4_path)
+            return mp4_path
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+def make_h264(tmp_path, name, n_bytes=1000):
+    path = tmp_path / name
+    path.write_bytes(b'\x00' * n_bytes)
+    return str(path)
+
+
+def test_conversion_pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(file_utils, 'h264_to_mp4', FakeRemux(fail_names=['bad.h264']))
+    paths = [make_h264(tmp_path, 'good.h264'), make_h264(tmp_path, 'tiny.h264', 10), make_h264(tmp_path, 'bad.h264')]
+    pool = file_utils.ConversionPool(30, max_workers=2)
+    results = {os.path.basename(r.h264_path): r for r in pool.convert_all(paths)}
+    assert results['good.h264'].mp4_path == str(tmp_path / 'good.mp4') and results['good.h264'].n_bytes == 1000
+    # tiny fragments are dropped without an error, and failures are reported rather than raised
+    assert results['tiny.h264'].mp4_path is None and results['tiny.h264'].error is None
+    assert results['bad.h264'].mp4_path is None and results['bad.h264'].error is not None
+    assert sorted(os.listdir(tmp_path)) == ['bad.h264', 'good.mp4']
+    assert pool.summary().startswith('converted 1 files') and pool.summary().endswith('1 failed')
+    pool.shutdown()
+
+
+def test_conversion_pool_is_bounded(tmp_path, monkeypatch):
+    gate = threading.Event()
+    remux = FakeRemux(gate=gate)
+    monkeypatch.setattr(file_utils, 'h264_to_mp4', remux)
+    pool = file_utils.ConversionPool(30, max_workers=2)
+    converted = []
+    futures = [pool.submit(make_h264(tmp_path, f'{i}.h264'), callback=lambda r: converted.append(r.mp4_path))
+               for i in range(4)]
+    all_done = threading.Event()
+    pool.after_pending(all_done.set)
+    # a failing callback is logged, and does not stop the others
+    pool.submit(make_h264(tmp_path, '4.h264'), callback=lambda r: 1 / 0)
+    assert not all_done.wait(0.1)
+    gate.set()
+    assert all_done.wait(5)
+    assert all(future.done() for future in futures)
+    assert sorted(converted) == [str(tmp_path / f'{i}.mp4') for i in range(4)]
+    pool.shutdown()
+    assert remux.max_running == 2
+
+
+def test_conversion_pool_cancel(tmp_path, monkeypatch):
+    gate = threading.Event()
+    remux = FakeRemux(gate=gate)
+    monkeypatch.setattr(file_utils, 'h264_to_mp4', remux)
+    pool = file_utils.ConversionPool(30, max_workers=1)
+    converted = []
+    futures = [pool.submit(make_h264(tmp_path, f'{i}.h264'), callback=converted.append) for i in range(3)]
+    called_after = threading.Event()
+    pool.after_pending(called_after.set)
+    while not remux.running:
+        time.sleep(0.01)
+    # conversions that have not started are cancelled, and no callbacks are made once the pool is closed
+    threading.Timer(0.1, gate.set).start()
+    pool.shutdown(cancel=True)
+    assert futures[0].done() and not futures[0].cancelled()
+    assert futures[1].cancelled() and futures[2].cancelled()
+    assert converted == [] and not called_after.wait(0.1)
+    assert sorted(os.listdir(tmp_path)) == ['0.mp4', '1.h264', '2.h264']
+
+
+def test_conversion_pool_keeps_unconvertible_files(tmp_path):
+    # without the fake, the junk file goes through ffmpeg (or fails to find it), and is kept for a later attempt
+    path = make_h264(tmp_path, 'junk.h264')
+    pool = file_utils.ConversionPool(30, max_workers=1)
+    result = pool.submit(path).result(timeout=60)
+    pool.shutdown()
+    assert result.mp4_path is None and result.error is not None
+    assert os.listdir(tmp_path) == ['junk.h264']
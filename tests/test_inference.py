@@ -0,0 +1,165 @@
+import numpy as np
+import pytest
+
+import context
+from internet_of_fish.modules import inference
+
+
+class FakeInterpreter:
+
+    def __init__(self, size=(32, 24), max_batch=None, dtype=np.uint8, input_range=(0, 255)):
+        """
+        stand-in for a tflite interpreter running an SSD-style detection model. Each image gets a single detection,
+        covering the middle of the image, whose score is the image's mean brightness, relative to the range of input
+        values the model expects (e.g., (-1, 1) for a float model). If max_batch is given, tensors cannot be allocated
+        for larger batches
+        """
+        width, height = size
+        self.max_batch = max_batch
+        self.dtype = dtype
+        self.input_range = input_range
+        self.shape = [1, height, width, 3]
+        self.allocated_shape = None
+        self.input = None
+        self.outputs = []
+
+    def get_input_details(self):
+        return [{'index': 0, 'shape': np.array(self.shape), 'dtype': self.dtype, 'quantization': (0.0, 0)}]
+
+    def get_output_details(self):
+        return [{'index': i} for i in range(len(self.outputs))]
+
+    def _get_full_signature_list(self):
+        return {}
+
+    def resize_tensor_input(self, index, shape):
+        self.shape = list(shape)
+
+    def allocate_tensors(self):
+        if self.max_batch and self.shape[0] > self.max_batch:
+            raise RuntimeError(f'cannot allocate tensors for a batch of {self.shape[0]}')
+        self.allocated_shape = list(self.shape)
+
+    def set_tensor(self, index, value):
+        if self.shape != self.allocated_shape or list(value.shape) != self.allocated_shape:
+            raise ValueError(f'cannot set tensor: got shape {list(value.shape)}, expected {self.allocated_shape}')
+        if value.dtype != self.dtype:
+            raise ValueError(f'cannot set tensor: got type {value.dtype}, expected {np.dtype(self.dtype)}')
+        self.input = value
+
+    def invoke(self):
+        n = len(self.input)
+        low, high = self.input_range
+        scores = (self.input.reshape(n, -1).mean(axis=1, keepdims=True) - low) / (high - low)
+        self.outputs = [np.tile(np.array([0.25, 0.25, 0.75, 0.75], np.float32), (n, 1, 1)), np.zeros((n, 1)), scores,
+                        np.ones(n)]
+
+    def get_tensor(self, index):
+        return self.outputs[index]
+
+
+class FakeCPUBackend(inference.CPUBackend):
+    max_batch = None
+
+    def make_interpreter(self):
+        return FakeInterpreter(max_batch=self.max_batch)
+
+
+class UnbatchableCPUBackend(FakeCPUBackend):
+    max_batch = 1
+
+
+class FloatCPUBackend(inference.CPUBackend):
+    input_range = (-1, 1)
+
+    def make_interpreter(self):
+        return FakeInterpreter(dtype=np.float32, input_range=self.input_range)
+
+
+class UnitFloatCPUBackend(FloatCPUBackend):
+    input_range = (0, 1)
+
+
+def test_tflite_backend_single_image():
+    backend = FakeCPUBackend('fish_ooi.tflite')
+    assert backend.input_size() == (32, 24)
+    backend.invoke(np.full((24, 32, 3), 153, np.uint8))
+    dets = backend.get_detections(0.5, image_scale=(0.5, 0.5))
+    assert len(dets) == 1 and dets.scores[0] == pytest.approx(0.6)
+    # boxes are scaled back to the original image, which was twice the size of the model input
+    assert dets.boxes[0].tolist() == [16, 12, 48, 36]
+    backend.invoke(np.zeros((24, 32, 3), np.uint8))
+    assert len(backend.get_detections(0.5)) == 0
+
+
+@pytest.mark.parametrize('backend_class', [FakeCPUBackend, UnbatchableCPUBackend])
+def test_cpu_backend_batches(backend_class):
+    backend = backend_class('fish_ooi.tflite')
+    batch = np.stack([np.full((24, 32, 3), value, np.uint8) for value in [51, 102, 204]])
+    dets = backend.infer_batch(batch, 0.1, [(1.0, 1.0)] * 3)
+    assert [score for d in dets for score in d.scores] == pytest.approx([0.2, 0.4, 0.8])
+    assert backend.supports_batching == (backend_class is FakeCPUBackend)
+    # models that cannot be batched fall back to one image at a time, and keep working on single images afterwards
+    backend.invoke(batch[2])
+    assert backend.get_detections(0.1).scores.tolist() == pytest.approx([0.8])
+    assert backend.batch_size == 1
+
+
+def test_cpu_backend_normalizes_float_input():
+    # float models without normalization metadata get pixel values scaled to [-1, 1]
+    backend = FloatCPUBackend('fish_ooi.tflite')
+    assert inference.read_input_norm('fish_ooi.tflite') is None
+    backend.invoke(np.full((24, 32, 3), 153, np.uint8))
+    assert backend.get_detections(0.1).scores.tolist() == pytest.approx([0.6])
+    # other normalizations can be given explicitly, e.g., scaling to [0, 1]
+    backend = UnitFloatCPUBackend('fish_ooi.tflite', input_norm=(0, 255))
+    batch = np.stack([np.full((24, 32, 3), value, np.uint8) for value in [51, 204]])
+    dets = backend.infer_batch(batch, 0.1, [(1.0, 1.0)] * 2)
+    assert [score for d in dets for score in d.scores] == pytest.approx([0.2, 0.8])
+
+
+def test_mock_backend():
+    backend = inference.make_backend('mock', None, latency_ms=0, n_dets=3, size=(100, 50))
+    assert backend.input_size() == (100, 50)
+    dets = backend.infer_batch(np.zeros((2, 50, 100, 3), np.uint8), 0.5, [(1.0, 1.0), (0.5, 0.5)])
+    assert [len(d) for d in dets] == [3, 3]
+    assert np.all(dets[0].boxes[:, 2] <= 100) and np.all(dets[0].boxes[:, 3] <= 50)
+    assert np.allclose(dets[1].boxes, 2 * dets[0].boxes, atol=1)
+    assert len(backend.get_detections(0.895)) == 1
+    with pytest.raises(ValueError):
+        inference.make_backend('gpu', None)
+
+
+def test_select_model():
+    paths = ['/models/pipe_roi.tflite', '/models/fish_ooi.tflite', '/models/fish_ooi_edgetpu.tflite']
+    assert inference.select_model(paths, 'ooi') == '/models/fish_ooi_edgetpu.tflite'
+    assert inference.select_model(paths, 'ooi', backend='cpu') == '/models/fish_ooi.tflite'
+    assert inference.select_model(paths, 'roi', backend='edgetpu') == '/models/pipe_roi.tflite'
+    assert inference.select_model(paths[2:], 'ooi', backend='cpu') is None
+    assert inference.select_model([], 'roi') is None
+
+
+def test_detections():
+    dets = inference.Detections([[0, 0, 10, 10], [5, 5, 15, 15], [40, 40, 60, 80]], [0.3, 0.9, 0.6], [1, 2, 3])
+    assert len(dets) == 3 and len(inference.Detections()) == 0
+    assert dets.sorted().scores.tolist() == pytest.approx([0.9, 0.6, 0.3])
+    top = dets.top_k(2)
+    assert top.class_ids.tolist() == [2, 3] and top.int_box(1) == (40, 40, 60, 80)
+    # indexing with an int still returns a Detections instance, as do masks
+    assert isinstance(dets[0], inference.Detections) and dets[0].boxes.shape == (1, 4)
+    assert dets[dets.scores > 0.5].class_ids.tolist() == [2, 3]
+    assert dets.centers[2].tolist() == [50, 60] and dets.sizes[2].tolist() == [20, 40]
+    assert dets.within_radius((8, 8), 5).class_ids.tolist() == [1, 2]
+    ious = dets.iou(dets[:2])
+    assert ious.shape == (3, 2)
+    assert ious[:, 0].tolist() == pytest.approx([1, 25 / 175, 0])
+    assert inference.box_iou(np.zeros((1, 4)), np.zeros((1, 4))).tolist() == [[0]]
+
+
+def test_detections_from_tensors():
+    # normalized (ymin, xmin, ymax, xmax) boxes, of which only the first count are valid
+    boxes = np.array([[0.1, 0.2, 0.5, 0.6], [0.0, 0.0, 1.0, 1.0], [0.2, 0.2, 0.4, 0.4]])
+    dets = inference.Detections.from_tensors(boxes, [4, 5, 6], [0.8, 0.3, 0.9], 2, (100, 50), 0.5,
+                                             image_scale=(0.5, 0.5))
+    assert len(dets) == 1 and dets.class_ids.tolist() == [4]
+    assert dets.boxes.tolist() == [[40, 10, 120, 50]]
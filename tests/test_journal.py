@@ -0,0 +1,187 @@
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import context
+from internet_of_fish.modules import journal
+
+
+@pytest.fixture
+def tmp_journal(tmp_path):
+    upload_journal = journal.UploadJournal(str(tmp_path / 'journal.sqlite'), max_tries=2)
+    yield upload_journal
+    upload_journal.close()
+
+
+def make_file(tmp_path, name, contents=b'data'):
+    path = tmp_path / name
+    path.write_bytes(contents)
+    return str(path)
+
+
+def test_add_skips_unchanged_uploads(tmp_path, tmp_journal):
+    path = make_file(tmp_path, 'a.mp4')
+    assert tmp_journal.add(path)
+    assert not tmp_journal.add(path)
+    entry = tmp_journal.claim('UPLOAD1')
+    tmp_journal.complete(entry.path, 'abc')
+    assert not tmp_journal.add(path)
+    make_file(tmp_path, 'a.mp4', b'new data')
+    assert tmp_journal.add(path)
+    assert tmp_journal.get(path).state == journal.PENDING
+
+
+def test_claims_are_exclusive(tmp_path, tmp_journal):
+    paths = [make_file(tmp_path, f'{i}.mp4') for i in range(20)]
+    for path in paths:
+        tmp_journal.add(path)
+    claimed = []
+
+    def worker(name):
+        # each worker opens its own connection, like the upload processes do
+        worker_journal = journal.UploadJournal(tmp_journal.db_path)
+        entry = worker_journal.claim(name)
+        while entry:
+            claimed.append(entry.path)
+            entry = worker_journal.claim(name)
+        worker_journal.close()
+
+    threads = [threading.Thread(target=worker, args=(f'UPLOAD{i}',)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(claimed) == sorted(paths)
+    assert tmp_journal.counts()[journal.UPLOADING] == 20
+
+
+def test_failures_and_recovery(tmp_path, tmp_journal):
+    path = make_file(tmp_path, 'a.mp4')
+    tmp_journal.add(path)
+    tmp_journal.claim('UPLOAD1')
+    assert tmp_journal.record_failure(path, 'timeout') == 1
+    assert tmp_journal.get(path).state == journal.UPLOADING
+    assert tmp_journal.record_failure(path, 'timeout') == 0
+    assert tmp_journal.get(path).state == journal.FAILED
+    assert tmp_journal.add(path)
+    tmp_journal.claim('UPLOAD1')
+    assert tmp_journal.release_claims() == 1
+    assert tmp_journal.get(path).attempts == 0
+
+
+def test_conversion_and_missing_files(tmp_path, tmp_journal):
+    h264_path = make_file(tmp_path, 'a.h264')
+    tmp_journal.add(h264_path, state=journal.CONVERTING)
+    assert tmp_journal.claim('UPLOAD1') is None
+    mp4_path = make_file(tmp_path, 'a.mp4')
+    os.remove(h264_path)
+    tmp_journal.finish_conversion(h264_path, mp4_path)
+    assert tmp_journal.get(h264_path).state == journal.CONVERTED
+    gone_path = make_file(tmp_path, 'b.mp4')
+    tmp_journal.add(gone_path)
+    os.remove(gone_path)
+    assert tmp_journal.claim('UPLOAD1').path == mp4_path
+    assert tmp_journal.claim('UPLOAD1') is None
+    assert tmp_journal.get(gone_path).state == journal.MISSING
+
+
+def test_cancelled_conversions_are_restarted(tmp_path, tmp_journal):
+    h264_path = make_file(tmp_path, 'a.h264')
+    assert tmp_journal.add(h264_path, state=journal.CONVERTING)
+    # the conversion was cancelled at shutdown, and the next run releases it
+    assert tmp_journal.release_claims() == 1
+    assert not tmp_journal.add(h264_path, state=journal.CONVERTING)
+    assert tmp_journal.start_conversion(h264_path)
+    assert tmp_journal.get(h264_path).state == journal.CONVERTING and tmp_journal.claim('UPLOAD1') is None
+    assert not tmp_journal.start_conversion(h264_path)
+
+
+def test_retries_are_scheduled_with_backoff(tmp_path, tmp_journal):
+    paths = [make_file(tmp_path, name) for name in ['a.mp4', 'b.mp4']]
+    for path in paths:
+        tmp_journal.add(path)
+    tmp_journal.claim('UPLOAD1')
+    start = time.time()
+    assert tmp_journal.record_failure(paths[0], 'connection reset by peer', retry=True) == 1
+    entry = tmp_journal.get(paths[0])
+    assert (entry.state, entry.claimed_by, entry.error_class) == (journal.PENDING, None, 'network')
+    assert start + 15 <= entry.next_attempt <= time.time() + 30
+    # the worker moves straight on to the next file, and the failed one is held back until its retry comes due
+    assert tmp_journal.claim('UPLOAD1').path == paths[1]
+    assert tmp_journal.claim('UPLOAD1') is None
+    assert tmp_journal.next_retry() == entry.next_attempt
+    assert tmp_journal.retry_stats() == {'retrying': {'network': 1}, 'failed': {}}
+    tmp_journal.conn.execute('UPDATE uploads SET next_attempt = ?', (time.time(),))
+    assert tmp_journal.claim('UPLOAD1').path == paths[0]
+    assert tmp_journal.record_failure(paths[0], '401 Unauthorized', retry=True) == 0
+    assert tmp_journal.get(paths[0]).state == journal.FAILED
+    assert tmp_journal.retry_stats() == {'retrying': {}, 'failed': {'auth': 1}}
+    assert tmp_journal.next_retry() is None
+
+
+def test_retry_policies():
+    assert journal.retry_policy("[Errno 28] No space left on device: '/tmp/a.mp4'").name == 'disk'
+    assert journal.retry_policy('could not reach the rclone daemon at localhost:5572').name == 'network'
+    assert journal.retry_policy('expired_access_token').name == 'auth'
+    assert journal.retry_policy('file missing from the cloud').name == 'other'
+    policy = journal.retry_policy('operation timed out')
+    delays = [journal.retry_delay(policy, attempts) for attempts in range(1, 10)]
+    assert policy.base_secs / 2 <= delays[0] <= policy.base_secs
+    assert delays[2] >= 2 * policy.base_secs
+    assert all(policy.max_secs / 2 <= delay <= policy.max_secs for delay in delays[-3:])
+
+
+def test_claim_order_and_class_limits(tmp_path, tmp_journal):
+    video_paths = [make_file(tmp_path, name, b'0' * size) for name, size in [('big.mp4', 300), ('small.mp4', 200)]]
+    log_path = make_file(tmp_path, 'DETECT.log', b'0' * 1000)
+    clip_path = make_file(tmp_path, '1650000000000_event.mp4', b'0' * 500)
+    record_path = make_file(tmp_path, 'hits.csv', b'0' * 10)
+    for path in video_paths + [log_path, clip_path, record_path]:
+        tmp_journal.add(path)
+    limits = {'video': 1}
+    claimed = [tmp_journal.claim('UPLOAD1', limits).path for _ in range(4)]
+    assert claimed == [record_path, clip_path, log_path, video_paths[1]]
+    assert tmp_journal.claim('UPLOAD2', limits) is None
+    tmp_journal.complete(video_paths[1], 'abc')
+    assert tmp_journal.claim('UPLOAD2', limits).path == video_paths[0]
+
+
+def test_migrates_old_journals(tmp_path):
+    db_path = str(tmp_path / 'old.sqlite')
+    conn = sqlite3.connect(db_path)
+    new_columns = ',\n            upload_class TEXT,\n            priority INTEGER'
+    old_schema = journal.UploadJournal.SCHEMA.replace(new_columns, '')
+    conn.execute(old_schema)
+    conn.execute("INSERT INTO uploads (path, size, state, added, updated) VALUES ('/a/hits.csv', 1, 'pending', 0, 0)")
+    conn.commit()
+    conn.close()
+    upload_journal = journal.UploadJournal(db_path)
+    assert upload_journal.get('/a/hits.csv').upload_class == 'record'
+    upload_journal.close()
+
+
+def test_hash_index_incremental_and_tails(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal.file_utils, 'CONTENT_HASH_BLOCK_SIZE', 4)
+    hash_index = journal.HashIndex(str(tmp_path / 'journal.sqlite'))
+    path = make_file(tmp_path, 'hits.csv', b'0123456789')
+    entry = hash_index.get(path, append_only=True)
+    assert entry.hash == journal.file_utils.file_hash(path) and entry.remote_size is None
+    hash_index.record_upload(path, entry.size, entry.hash)
+    with open(path, 'ab') as f:
+        f.write(b'abcdef')
+    entry = hash_index.get(path, append_only=True)
+    assert entry.hash == journal.file_utils.file_hash(path)
+    assert (entry.remote_size, entry.size) == (10, 16)
+    assert hash_index.prefix_hash(path, entry.remote_size) == entry.remote_hash
+    tail_path = journal.file_utils.write_tail(path, entry.remote_size, entry.size)
+    # the cloud holds the originally uploaded file, plus the tail
+    (tmp_path / 'cloud').mkdir()
+    joined_path = make_file(tmp_path / 'cloud', 'hits.csv', b'0123456789')
+    os.replace(tail_path, joined_path + journal.file_utils.TAIL_SUFFIX + '10')
+    journal.file_utils.join_all_tails(str(tmp_path / 'cloud'))
+    assert os.listdir(tmp_path / 'cloud') == ['hits.csv']
+    assert open(joined_path, 'rb').read() == b'0123456789abcdef'
+    hash_index.close()
@@ -0,0 +1,62 @@
+import multiprocessing as mp
+
+import numpy as np
+import pytest
+
+import context
+from internet_of_fish.modules import mptools
+
+
+@pytest.fixture
+def frame_ring():
+    ring = mptools.SharedFrameRing((100, 100, 3), 4)
+    yield ring
+    ring.unlink()
+
+
+def random_frame(shape=(100, 100, 3)):
+    return np.random.default_rng(0).integers(0, 255, shape, dtype=np.uint8)
+
+
+def invert_frame(ring, frame_ref, done_q):
+    # runs in a child process, which sees the same shared memory as the parent
+    img = ring.resolve(frame_ref)
+    img[:] = 255 - img
+    done_q.put(int(img.sum()))
+    ring.close()
+
+
+def test_frame_ring_round_trip(frame_ring):
+    img = random_frame()
+    frame_ref = frame_ring.put(img)
+    assert frame_ref is not None
+    assert np.array_equal(frame_ring.resolve(frame_ref), img)
+    # smaller frames fit in a slot too, and keep their own shape
+    small_ref = frame_ring.put(img[:50, :20])
+    assert frame_ring.resolve(small_ref).shape == (50, 20, 3)
+
+
+def test_frame_ring_exhaustion(frame_ring):
+    img = random_frame()
+    refs = [frame_ring.put(img) for _ in range(4)]
+    assert len({ref.slot for ref in refs}) == 4
+    assert frame_ring.put(img) is None
+    frame_ring.release(refs[0])
+    assert frame_ring.put(img).slot == refs[0].slot
+
+
+def test_frame_ring_rejects_oversized_frames(frame_ring):
+    assert not frame_ring.fits((200, 200, 3))
+    assert frame_ring.put(np.zeros((200, 200, 3), dtype=np.uint8)) is None
+
+
+def test_frame_ring_is_shared_between_processes(frame_ring):
+    img = random_frame()
+    frame_ref = frame_ring.put(img)
+    done_q = mp.Queue()
+    proc = mp.Process(target=invert_frame, args=(frame_ring, frame_ref, done_q))
+    proc.start()
+    assert done_q.get(timeout=10) == int((255 - img).sum())
+    proc.join(10)
+    # the child wrote into the slot in place, without any pixels passing through the queue
+    assert np.array_equal(frame_ring.resolve(frame_ref), 255 - img)
@@ -0,0 +1,119 @@
+import http.server
+import shutil
+import threading
+
+import pytest
+
+import context
+from internet_of_fish.modules import rclone
+
+requires_rclone = pytest.mark.skipif(shutil.which('rclone') is None, reason='rclone is not installed')
+
+
+@pytest.fixture(scope='module')
+def rclone_client():
+    daemon = rclone.RcloneDaemon()
+    daemon.start()
+    client = daemon.client()
+    yield client
+    client.close()
+    daemon.stop()
+
+
+@pytest.fixture
+def local_remote(tmp_path):
+    # rclone accepts plain local paths wherever it accepts a remote, so a temporary directory stands in for the cloud
+    src_dir, remote_dir = tmp_path / 'src', tmp_path / 'remote'
+    src_dir.mkdir()
+    (src_dir / 'a.json').write_text('{}')
+    (src_dir / 'b.mp4').write_bytes(b'0' * 100000)
+    yield src_dir, remote_dir
+
+
+@requires_rclone
+def test_copyfile_and_stat(rclone_client, local_remote):
+    src_dir, remote_dir = local_remote
+    rclone_client.copyfile(str(src_dir / 'b.mp4'), str(remote_dir / 'proj' / 'Videos' / 'b.mp4'))
+    assert (remote_dir / 'proj' / 'Videos' / 'b.mp4').read_bytes() == (src_dir / 'b.mp4').read_bytes()
+    assert rclone_client.stat(str(remote_dir / 'proj' / 'Videos' / 'b.mp4'))['Size'] == 100000
+    assert rclone_client.stat(str(remote_dir / 'proj' / 'missing.mp4')) is None
+
+
+@requires_rclone
+def test_concurrent_copies_and_listing(rclone_client, local_remote):
+    src_dir, remote_dir = local_remote
+    jobs = [rclone_client.submit_copy(str(src_dir / 'a.json'), str(remote_dir / f'{i}' / 'a.json')) for i in range(5)]
+    assert all(rclone_client.wait(job)['success'] for job in jobs)
+    listing = rclone_client.list(str(remote_dir), recurse=True)
+    assert sorted(item['Path'] for item in listing) == [f'{i}/a.json' for i in range(5)]
+    assert rclone_client.list(str(remote_dir / 'missing')) == []
+
+
+@requires_rclone
+def test_failed_copy_raises(rclone_client, local_remote):
+    src_dir, remote_dir = local_remote
+    with pytest.raises(rclone.RcloneError):
+        rclone_client.copyfile(str(src_dir / 'missing.json'), str(remote_dir / 'missing.json'))
+
+
+def test_listing_cache():
+    calls = []
+    remote = {'remote:proj/Videos': [{'Name': 'a.mp4', 'Size': 10}, {'Name': 'b.mp4', 'Size': 20}]}
+
+    def lister(cloud_dir):
+        calls.append(cloud_dir)
+        return remote.get(cloud_dir, [])
+
+    cache = rclone.RemoteListingCache(lister)
+    assert cache.matches('remote:proj/Videos/a.mp4', 10)
+    assert not cache.matches('remote:proj/Videos/b.mp4', 10)
+    assert not cache.exists('remote:proj/Videos/c.mp4')
+    assert calls == ['remote:proj/Videos']
+    remote['remote:proj/Videos'].append({'Name': 'c.mp4', 'Size': 30})
+    cache.note_upload('remote:proj/Videos/c.mp4')
+    assert cache.matches('remote:proj/Videos/c.mp4', 30)
+    assert not cache.exists('remote:proj/a.json')
+    assert calls == ['remote:proj/Videos', 'remote:proj/Videos', 'remote:proj']
+
+
+class DroppingHandler(http.server.BaseHTTPRequestHandler):
+    """reads each request, and drops the connection without responding to the first one for each method, as if the
+    daemon had closed an idle keep-alive connection just as the request arrived"""
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.requests.append(self.path)
+        if self.requests.count(self.path) == 1:
+            self.close_connection = True
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+def test_only_idempotent_calls_are_retried():
+    server = http.server.HTTPServer(('127.0.0.1', 0), DroppingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = rclone.RcloneClient(f'127.0.0.1:{server.server_address[1]}')
+    try:
+        assert client.job_status(1) == {}
+        # a copy that may already have started is not submitted again
+        with pytest.raises(rclone.RcloneError):
+            client.submit_copy(__file__, 'remote:dir/file.txt')
+        assert DroppingHandler.requests == ['/job/status', '/job/status', '/operations/copyfile']
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+
+@requires_rclone
+def test_bwlimit(rclone_client):
+    assert rclone_client.set_bwlimit('512k') == 512 * 1024
+    assert rclone_client.set_bwlimit('off') == -1
@@ -0,0 +1,104 @@
+import io
+import os
+import shutil
+
+import pytest
+
+import context
+from internet_of_fish.modules import recording
+
+
+def nal(header, *payload):
+    return b'\x00\x00\x01' + bytes([header, *payload]) + bytes([0xaa] * 20)
+
+
+def frame(n, idr=False, n_slices=1):
+    """synthetic access unit: a delimiter, parameter sets for keyframes, then slices whose payload encodes n"""
+    data = nal(0x09, 0xf0)
+    if idr:
+        data += nal(0x67, n) + nal(0x68, n)
+    # only the first slice of a picture has first_mb_in_slice == 0, i.e., the top bit set
+    data += nal(0x65 if idr else 0x41, 0x80, n)
+    for _ in range(n_slices - 1):
+        data += nal(0x65 if idr else 0x41, 0x40, n)
+    return data
+
+
+@pytest.fixture
+def stream():
+    # 10 frames with keyframes at 0 and 5, and a frame split into two slices
+    frames = [frame(n, idr=n % 5 == 0, n_slices=2 if n == 3 else 1) for n in range(10)]
+    offsets = [sum(len(f) for f in frames[:n]) for n in range(10)]
+    return frames, offsets
+
+
+@pytest.mark.parametrize('chunk_size', [7, 1 << 20])
+def test_nal_headers(stream, chunk_size):
+    frames, offsets = stream
+    headers = list(recording.nal_headers(io.BytesIO(b''.join(frames[:2])), chunk_size=chunk_size))
+    # start codes that straddle a chunk boundary are still found
+    assert headers == [(0, recording.NAL_AUD, True), (25, recording.NAL_SPS, False), (50, recording.NAL_PPS, False),
+                       (75, recording.NAL_IDR_SLICE, True), (offsets[1], recording.NAL_AUD, True),
+                       (offsets[1] + 25, recording.NAL_SLICE, True)]
+
+
+def test_access_units(stream):
+    frames, offsets = stream
+    f = io.BytesIO(b''.join(frames))
+    assert list(recording.access_units(f)) == [(offset, n % 5 == 0) for n, offset in enumerate(offsets)]
+    assert list(recording.access_units(f, offsets[4]))[:2] == [(offsets[4], False), (offsets[5], True)]
+
+
+def test_segment_index(tmp_path):
+    index = recording.SegmentIndex(str(tmp_path))
+    assert index.segments() == []
+    for name in ['a.h264', 'b.h264', 'gone.h264']:
+        (tmp_path / name).write_bytes(b'')
+    index.open_segment(str(tmp_path / 'a.h264'), 1000, 10, start_frame=0)
+    index.mark(str(tmp_path / 'a.h264'), 1500, 1234, frame=5)
+    index.close_segment(str(tmp_path / 'a.h264'), 1900, end_frame=9)
+    index.open_segment(str(tmp_path / 'gone.h264'), 1900, 10)
+    index.close_segment(str(tmp_path / 'gone.h264'), 2000)
+    index.open_segment(str(tmp_path / 'b.h264'), 2000, 10, start_frame=10)
+    os.remove(tmp_path / 'gone.h264')
+    # the closed segment is remuxed, and the collector is partway through writing a record
+    (tmp_path / 'a.mp4').write_bytes(b'')
+    index.rename_segment(str(tmp_path / 'a.h264'), str(tmp_path / 'a.mp4'))
+    with open(index.index_path, 'a') as f:
+        f.write('{"event": "mark", "pa')
+    a, b = index.segments()
+    assert a == recording.Segment(str(tmp_path / 'a.mp4'), 1000, 1900, 0, 9, 10, [recording.Mark(1500, 1234, 5)])
+    assert (b.path, b.end_ms, b.marks) == (str(tmp_path / 'b.h264'), None, [])
+    assert index.find(1200, 1300) == [a]
+    assert index.find(1950, 2050) == [b]
+    # open segments extend to the present
+    assert index.find(10 ** 15, 10 ** 15 + 1) == []
+    assert [seg.path for seg in index.find(1800, 10 ** 12)] == [a.path, b.path]
+
+
+def test_cut_clip(tmp_path, stream, monkeypatch):
+    frames, offsets = stream
+    seg_path = tmp_path / 'seg.h264'
+    seg_path.write_bytes(b''.join(frames))
+    index = recording.SegmentIndex(str(tmp_path))
+    index.open_segment(str(seg_path), 1000, 10)
+    index.close_segment(str(seg_path), 1900)
+    commands = []
+
+    def fake_run(command, dest_path):
+        # stand in for ffmpeg wrapping the raw stream in an mp4 container
+        commands.append(command)
+        shutil.copy(command[command.index('-i') + 1], dest_path)
+
+    monkeypatch.setattr(recording.SegmentIndex, '_run', staticmethod(fake_run))
+    dest_path = str(tmp_path / 'clip.mp4')
+    # frames 6-8 are requested, so the clip starts at the preceding keyframe and stops before frame 9
+    assert index.cut_clip(1600, 1800, dest_path) == dest_path
+    with open(dest_path, 'rb') as f:
+        assert f.read() == b''.join(frames[5:9])
+    assert commands[0][commands[0].index('-r') + 1] == '10'
+    # a range that runs past the end of the segment takes everything up to the end
+    index.cut_clip(1200, 5000, dest_path)
+    with open(dest_path, 'rb') as f:
+        assert f.read() == b''.join(frames)
+    assert index.cut_clip(3000, 4000, dest_path) is None
@@ -0,0 +1,161 @@
+import os
+import shutil
+import threading
+
+import pytest
+
+import context
+from internet_of_fish.modules import journal
+from internet_of_fish.modules import rclone
+from internet_of_fish.modules import storage
+from internet_of_fish.modules.utils import file_utils
+
+
+@pytest.fixture
+def src_files(tmp_path):
+    src_dir = tmp_path / 'src'
+    src_dir.mkdir()
+    paths = []
+    for i, size in enumerate([10, 100000, 3 << 20]):
+        path = src_dir / f'{i}.mp4'
+        path.write_bytes(bytes([i]) * size)
+        paths.append(str(path))
+    return paths
+
+
+def check_backend(backend, src_files, tmp_path):
+    cloud_dir = 'cichlidVideo:proj/Videos'
+    cloud_paths = [f'{cloud_dir}/{i}.mp4' for i in range(len(src_files))]
+    assert backend.put_many(list(zip(src_files, cloud_paths))) == [None] * len(src_files)
+    assert [stat['Size'] for stat in backend.stat_many(cloud_paths)] == [10, 100000, 3 << 20]
+    assert backend.stat(f'{cloud_dir}/missing.mp4') is None
+    assert backend.stat_many([f'{cloud_dir}/missing.mp4']) == [None]
+    backend.put(src_files[0], 'cichlidVideo:proj/Videos/sub/a.mp4')
+    assert sorted(item['Name'] for item in backend.list(cloud_dir)) == ['0.mp4', '1.mp4', '2.mp4']
+    assert 'sub/a.mp4' in [item['Path'] for item in backend.list(cloud_dir, recurse=True)]
+    assert backend.list('cichlidVideo:missing') == []
+    backend.get(cloud_paths[1], str(tmp_path / 'download' / '1.mp4'))
+    assert (tmp_path / 'download' / '1.mp4').read_bytes() == bytes([1]) * 100000
+    backend.delete(cloud_paths[1])
+    assert not backend.exists(cloud_paths[1])
+    with open(src_files[2], 'rb') as f:
+        backend.put_stream(f, 'cichlidVideo:proj/Logs/streamed.bin')
+    assert backend.stat('cichlidVideo:proj/Logs/streamed.bin')['Size'] == 3 << 20
+
+
+class FlakyBackend(storage.LocalBackend):
+
+    def __init__(self, root_dir, fail_on=(), corrupt_on=()):
+        """local backend whose transfers fail, or arrive corrupted, on the given (1-indexed) calls to put"""
+        super().__init__(root_dir)
+        self.fail_on, self.corrupt_on = set(fail_on), set(corrupt_on)
+        self.puts = []
+
+    def put(self, local_path, cloud_path, progress_fn=None, shutdown_event=None):
+        self.puts.append(cloud_path)
+        if len(self.puts) in self.fail_on:
+            raise storage.StorageError('connection reset by peer')
+        super().put(local_path, cloud_path, progress_fn, shutdown_event)
+        if len(self.puts) in self.corrupt_on:
+            with open(self.local_path(cloud_path), 'r+b') as f:
+                f.write(b'x')
+
+
+def check_resumable(backend, tmp_path, n_blocks):
+    block_size = file_utils.CONTENT_HASH_BLOCK_SIZE
+    src_path = tmp_path / 'big.mp4'
+    src_path.write_bytes(bytes(range(256)) * (n_blocks * block_size // 256) + b'end')
+    checkpoint = journal.ChunkCheckpoint(str(tmp_path / 'journal.sqlite'))
+    cloud_path = 'cichlidVideo:proj/Videos/big.mp4'
+    while True:
+        try:
+            backend.put_resumable(str(src_path), cloud_path, checkpoint, 2 * block_size)
+            break
+        except storage.StorageError:
+            pass
+    assert checkpoint.confirmed(str(src_path), file_utils.file_hash(str(src_path)), 2 * block_size) == {}
+    checkpoint.close()
+    return src_path, cloud_path
+
+
+def test_resumable_upload_resumes_after_failures(tmp_path, monkeypatch):
+    monkeypatch.setattr(file_utils, 'CONTENT_HASH_BLOCK_SIZE', 1024)
+    backend = FlakyBackend(str(tmp_path / 'remote'), fail_on=[3], corrupt_on=[5])
+    src_path, cloud_path = check_resumable(backend, tmp_path, 10)
+    # the third chunk failed and the fifth arrived corrupted, and each was sent again without resending the others
+    starts = [int(path.rsplit(storage.CHUNK_SUFFIX, 1)[1]) for path in backend.puts]
+    assert starts == [0, 2048, 4096, 4096, 6144, 6144, 8192, 10240]
+    assert open(backend.local_path(cloud_path), 'rb').read() == src_path.read_bytes()
+    assert [item['Name'] for item in backend.list('cichlidVideo:proj/Videos')] == ['big.mp4']
+
+
+def test_local_backend(src_files, tmp_path):
+    check_backend(storage.LocalBackend(str(tmp_path / 'remote')), src_files, tmp_path)
+
+
+def test_local_backend_stops_on_shutdown(src_files, tmp_path):
+    backend = storage.LocalBackend(str(tmp_path / 'remote'))
+    backend.CHUNK_SIZE = 1 << 16
+    shutdown_event = threading.Event()
+    progress = []
+
+    def progress_fn(stats):
+        progress.append(stats['bytes'])
+        if len(progress) == 3:
+            shutdown_event.set()
+
+    with pytest.raises(storage.StorageError):
+        backend.put(src_files[2], 'cichlidVideo:proj/2.mp4', progress_fn=progress_fn, shutdown_event=shutdown_event)
+    # nothing (including the partial copy) is left behind
+    assert backend.list('cichlidVideo:proj') == []
+    assert not list((tmp_path / 'remote' / 'proj').iterdir())
+
+
+@pytest.mark.skipif(shutil.which('rclone') is None, reason='rclone is not installed')
+def test_rclone_backend(src_files, tmp_path, monkeypatch):
+    # an rclone remote of type local, configured through the environment, that stores files relative to the cwd
+    monkeypatch.setenv('RCLONE_CONFIG_CICHLIDVIDEO_TYPE', 'local')
+    (tmp_path / 'remote').mkdir()
+    monkeypatch.chdir(tmp_path / 'remote')
+    daemon = rclone.RcloneDaemon()
+    daemon.start()
+    try:
+        backend = storage.make_backend('rclone', client=daemon.client(), poll_secs=0.1)
+        check_backend(backend, src_files, tmp_path)
+        assert backend.set_bwlimit('off') == -1
+        # rclone cannot join files in the cloud, so it does not make chunked uploads at all
+        assert not backend.JOINS_CHUNKS
+        with pytest.raises(NotImplementedError):
+            backend.put_resumable(src_files[0], 'cichlidVideo:proj/Videos/big.mp4', None, 1)
+        backend.close()
+    finally:
+        daemon.stop()
+
+
+def test_s3_backend(src_files, tmp_path, monkeypatch):
+    pytest.importorskip('boto3')
+    moto_server = pytest.importorskip('moto.server')
+    for key, value in [('AWS_ACCESS_KEY_ID', 'test'), ('AWS_SECRET_ACCESS_KEY', 'test'),
+                       ('AWS_DEFAULT_REGION', 'us-east-1')]:
+        monkeypatch.setenv(key, value)
+    server = moto_server.ThreadedMotoServer(port=0)
+    server.start()
+    try:
+        host, port = server.get_host_and_port()
+        backend = storage.S3Backend('uploads', endpoint_url=f'http://{host}:{port}', prefix='device1')
+        backend.client.create_bucket(Bucket='uploads')
+        check_backend(backend, src_files, tmp_path)
+        src_path, cloud_path = check_resumable(backend, tmp_path, 3)
+        backend.verify(cloud_path, src_path.stat().st_size, file_utils.file_hash(str(src_path)))
+        assert [item['Name'] for item in backend.list('cichlidVideo:proj/Videos')] == ['0.mp4', '2.mp4', 'big.mp4']
+        backend.close()
+    finally:
+        server.stop()
+
+
+def test_benchmark(src_files, tmp_path):
+    backends = {name: storage.LocalBackend(str(tmp_path / name)) for name in ['nas', 'usb']}
+    results = storage.benchmark(backends, src_files, 'cichlidVideo:benchmark')
+    assert [(result.backend, result.n_files, result.n_errors) for result in results] == [('nas', 3, 0), ('usb', 3, 0)]
+    assert all(result.n_bytes == 100010 + (3 << 20) for result in results)
+    assert backends['nas'].list('cichlidVideo:benchmark') == []